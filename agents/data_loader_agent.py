@@ -11,7 +11,6 @@ import logging
 
 from .base_agent import BaseAgent
 from dataset_classes.spider_dataset import SpiderDataset
-from dataset_classes.wikisql_dataset import WikiSQLDataset
 
 data_loader_properties = {
     'name': 'DataLoaderAgent',
@@ -29,6 +28,7 @@ class DataLoaderAgent(BaseAgent):
         self.description = data_loader_properties['description']
         self.input = data_loader_properties['input']
         self.output = data_loader_properties['output']
+        self.resource_registry = kwargs.get('resource_registry', None) ## datasets are shared through the registry if given
         
 
     def _initialize(self, properties=None):
@@ -48,9 +48,13 @@ class DataLoaderAgent(BaseAgent):
         ## if the dataset_dir_path is not provided, use the default path datasets/{dataset_name}
         if not dataset_dir_path:
             dataset_dir_path = os.path.join('../', os.path.dirname(__file__), 'datasets', dataset_name)
+        if self.resource_registry is not None:
+            return self.resource_registry.get_dataset(dataset_name, dataset_dir_path)
         if dataset_name == 'spider':
             dataset = SpiderDataset(dataset_dir_path)
         elif dataset_name == 'WikiSQL':
+            ## imported on demand, WikiSQL needs extra dependencies (records, nltk)
+            from dataset_classes.wikisql_dataset import WikiSQLDataset
             dataset = WikiSQLDataset(dataset_dir_path)
         else:
             raise ValueError(f"Invalid dataset name {dataset_name}")
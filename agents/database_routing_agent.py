@@ -8,12 +8,20 @@ import sqlite3
 import logging
 
 # sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-import torch
 
 from .base_agent import BaseAgent
-from dataset_classes.spider_dataset import SpiderDataset
-from dataset_classes.wikisql_dataset import WikiSQLDataset
-from utils.database_routing_utils import load_model, predict_db
+from utils.database_routing_utils import (
+    ROUTING_BACKENDS, load_model, load_label_map, quantize_model_dynamic, prepare_onnx_model, load_onnx_session,
+    predict_db, predict_db_batch, predict_db_batch_onnx
+)
+from utils.lexical_routing_utils import LexicalRouter
+from utils.cache_utils import LRUCache, normalize_question, get_model_fingerprint
+from utils.micro_batcher import MicroBatcher
+from utils.metrics_utils import get_metrics_registry
+
+ROUTING_MODES = ['model', 'lexical', 'cascade']
+## number of questions routed by BM25 and by the model
+routing_decision_counter = get_metrics_registry().counter("magesql_routing_decisions_total", "Database routing predictions by method (lexical, model)", ("method",))
 
 database_routing_properties = {
     'name': 'DatabaseRoutingAgent',
@@ -33,15 +41,88 @@ class DatabaseRoutingAgent(BaseAgent):
         self.output = database_routing_properties['output']
         
         self.model_path = model_path
-        try:
-            self.model, self.tokenizer, self.label_map = load_model(model_path)
-        except Exception as e:
-            raise ValueError(f"Error loading model at path {model_path}: {e}")
-        
+        ## inference backend, one of ROUTING_BACKENDS, the onnxruntime backend exports the model to <model_path>/onnx on first use
+        self.backend = kwargs.get('backend', 'torch')
+        if self.backend not in ROUTING_BACKENDS:
+            raise ValueError(f"Invalid backend {self.backend}, must be one of {ROUTING_BACKENDS}")
+        self.model = None
+        self.session = None
+        self.label_map = None
+        resource_registry = kwargs.get('resource_registry', None) ## share the model and tokenizer with other agents of the process if given
+
+        ## routing mode: 'model' (DistilBERT only), 'lexical' (BM25 only, the model is not loaded) or 'cascade' (BM25, DistilBERT when the BM25 margin is low)
+        self.routing_mode = kwargs.get('routing_mode', 'model')
+        if self.routing_mode not in ROUTING_MODES:
+            raise ValueError(f"Invalid routing mode {self.routing_mode}, must be one of {ROUTING_MODES}")
+        self.lexical_margin_threshold = kwargs.get('lexical_margin_threshold', 0.3)
+        self.lexical_router = None
+        if self.routing_mode != 'model':
+            self.lexical_router = kwargs.get('lexical_router', None)
+            if self.lexical_router is None:
+                dataset_dir_path = kwargs.get('dataset_dir_path', './datasets/spider')
+                if resource_registry is not None:
+                    self.lexical_router = resource_registry.get_lexical_router(dataset_dir_path)
+                else:
+                    from dataset_classes.spider_dataset import SpiderDataset
+                    dataset = SpiderDataset(dataset_dir_path)
+                    dataset.load_schema()
+                    self.lexical_router = LexicalRouter.from_dataset(dataset)
+        ## predictions keyed by the normalized question, in the namespace of the model (see get_routing_cache_namespace), a size of 0 disables it
+        self.routing_cache = LRUCache('routing', max_size=kwargs.get('routing_cache_size', 4096), persistent_path=kwargs.get('routing_cache_path', None))
+        if self.routing_mode != 'lexical':
+            self.load_routing_model(model_path, resource_registry, **kwargs)
+        self.routing_cache.set_namespace(self.get_routing_cache_namespace())
+
+        ## concurrent run_async calls are classified together, see MicroBatcher
+        self.micro_batcher = MicroBatcher(
+            self.predict_with_model_batch,
+            max_batch_size=kwargs.get('max_batch_size', 16),
+            max_wait_ms=kwargs.get('max_wait_ms', 5.0),
+            name='database_routing'
+        )
+
         ## load schema if provided
         if 'schema_path' in kwargs and kwargs['schema_path']:
             self.schema = self._load_schema(kwargs['schema_path'])
 
+    def load_routing_model(self, model_path:str, resource_registry=None, **kwargs):
+        try:
+            if self.backend == 'torch':
+                if resource_registry is not None:
+                    self.model, self.label_map = resource_registry.get_routing_model(model_path)
+                    self.tokenizer = resource_registry.get_tokenizer(model_path)
+                else:
+                    self.model, self.tokenizer, self.label_map = load_model(model_path)
+            elif self.backend == 'torch_dynamic_quant':
+                if resource_registry is not None:
+                    self.model, self.label_map = resource_registry.get_quantized_routing_model(model_path)
+                    self.tokenizer = resource_registry.get_tokenizer(model_path)
+                else:
+                    model, self.tokenizer, self.label_map = load_model(model_path)
+                    self.model = quantize_model_dynamic(model)
+            else:
+                onnx_path = kwargs.get('onnx_path') or prepare_onnx_model(model_path, flag_quantized=kwargs.get('flag_quantized', True))
+                num_threads = kwargs.get('num_threads', None)
+                if resource_registry is not None:
+                    self.session = resource_registry.get_onnx_session(onnx_path, num_threads=num_threads)
+                    self.tokenizer = resource_registry.get_tokenizer(model_path)
+                    self.label_map = resource_registry.get_json(os.path.join(model_path, "label_map.json"))
+                else:
+                    from transformers import DistilBertTokenizer
+                    self.session = load_onnx_session(onnx_path, num_threads=num_threads)
+                    self.tokenizer = DistilBertTokenizer.from_pretrained(model_path)
+                    self.label_map = load_label_map(model_path)
+        except Exception as e:
+            raise ValueError(f"Error loading model at path {model_path} with backend {self.backend}: {e}")
+        ## cached predictions of another model are not returned
+        self.model_path = model_path
+        self.routing_cache.set_namespace(self.get_routing_cache_namespace())
+
+    def get_routing_cache_namespace(self):
+        model_fingerprint = get_model_fingerprint(self.model_path) if self.routing_mode != 'lexical' else None
+        lexical_threshold = self.lexical_margin_threshold if self.routing_mode == 'cascade' else None
+        return f"{model_fingerprint}|{self.backend}|{self.routing_mode}|{lexical_threshold}"
+
 
     def _initialize(self, properties=None):
         super()._initialize(properties=properties)
@@ -61,15 +142,90 @@ class DatabaseRoutingAgent(BaseAgent):
     def format_output(self, output_dict:dict):
         pass
 
-    def run(self, question:str, flag_return_schema_text:bool=False):
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        db_id = predict_db(
+    def get_device(self):
+        import torch ## torch is loaded with the model, not on import of the agent module
+        if self.backend == 'torch_dynamic_quant':
+            ## quantized kernels are CPU only
+            return torch.device('cpu')
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    def predict_with_lexical_router(self, question:str):
+        """db_id predicted by BM25 if its margin is high enough (always in the lexical mode), otherwise None.
+        """
+        if self.lexical_router is None:
+            return None
+        db_id, margin = self.lexical_router.predict(question)
+        if self.routing_mode == 'lexical' or (db_id is not None and margin >= self.lexical_margin_threshold):
+            routing_decision_counter.inc(method='lexical')
+            return db_id
+        return None
+
+    def predict_with_model(self, question:str):
+        routing_decision_counter.inc(method='model')
+        if self.backend == 'onnxruntime':
+            return predict_db_batch_onnx(self.session, self.tokenizer, [question], self.label_map)[0]
+        return predict_db(
             model=self.model,
             tokenizer=self.tokenizer,
             text=question,
-            device=device,
+            device=self.get_device(),
             label_map=self.label_map
         )
+
+    def predict_with_model_batch(self, questions:list):
+        """db_id of each question, with one forward pass for all questions.
+        """
+        routing_decision_counter.inc(len(questions), method='model')
+        if self.backend == 'onnxruntime':
+            return predict_db_batch_onnx(self.session, self.tokenizer, questions, self.label_map)
+        return predict_db_batch(
+            model=self.model,
+            tokenizer=self.tokenizer,
+            texts=questions,
+            device=self.get_device(),
+            label_map=self.label_map
+        )
+
+    def run(self, question:str, flag_return_schema_text:bool=False):
+        cache_key = normalize_question(question)
+        db_id = self.routing_cache.get(cache_key)
+        if db_id is None:
+            db_id = self.predict_with_lexical_router(question)
+            if db_id is None and self.routing_mode != 'lexical':
+                db_id = self.predict_with_model(question)
+            if db_id is not None:
+                self.routing_cache.set(cache_key, db_id)
+        if flag_return_schema_text:
+            return self.get_schema_text(db_id)
+        return db_id
+
+    def run_batch(self, questions:list):
+        """db_id of each question, the questions neither cached nor routed by BM25 are classified with one forward pass.
+        """
+        cache_keys = [normalize_question(x) for x in questions]
+        cached_db_ids = [self.routing_cache.get(x) for x in cache_keys]
+        db_ids = [x if x is not None else self.predict_with_lexical_router(question) for x, question in zip(cached_db_ids, questions)]
+        if self.routing_mode != 'lexical':
+            model_indices = [i for i, x in enumerate(db_ids) if x is None]
+            if model_indices:
+                for i, db_id in zip(model_indices, self.predict_with_model_batch([questions[i] for i in model_indices])):
+                    db_ids[i] = db_id
+        for cache_key, db_id, cached_db_id in zip(cache_keys, db_ids, cached_db_ids):
+            if db_id is not None and cached_db_id is None:
+                self.routing_cache.set(cache_key, db_id)
+        return db_ids
+
+    async def run_async(self, question:str, flag_return_schema_text:bool=False):
+        """Same as run, the model forward pass is batched with the concurrent calls and runs in a worker thread.
+        """
+        cache_key = normalize_question(question)
+        db_id = self.routing_cache.get(cache_key)
+        if db_id is None:
+            db_id = self.predict_with_lexical_router(question)
+            if db_id is None and self.routing_mode != 'lexical':
+                db_id = await self.micro_batcher.submit(question)
+            if db_id is not None:
+                self.routing_cache.set(cache_key, db_id)
         if flag_return_schema_text:
             return self.get_schema_text(db_id)
         return db_id
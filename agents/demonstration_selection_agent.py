@@ -9,13 +9,8 @@ import sqlite3
 import logging
 
 # sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-import torch
-from nltk.tokenize import word_tokenize
 
 from .base_agent import BaseAgent
-from dataset_classes.spider_dataset import SpiderDataset
-from dataset_classes.wikisql_dataset import WikiSQLDataset
-from utils.database_routing_utils import load_model, predict_db
 from utils.construct_prompt_utils import fill_demonstrations
 
 from demonstration_selector.first_k_demonstration_selector import FirstKDemonstrationSelector
@@ -70,6 +65,7 @@ class DemonstrationSelectionAgent(BaseAgent):
         return demonstration_selector
 
     def get_data_dict(self, question_text:str):
+        from nltk.tokenize import word_tokenize
         data_dict = {
             'question': question_text,
             'question_toks': word_tokenize(question_text)
@@ -89,6 +85,9 @@ class DemonstrationSelectionAgent(BaseAgent):
             num_demonstrations=num_demonstrations,
             flag_return_ids = False
         )
+        return self.get_demonstration_section_text(demonstrations)
+
+    def get_demonstration_section_text(self, demonstrations:list):
         template = "### Answer the following question: {question}\n{sql_query}"
 
         ## convert demonstrations in dataset format to demonstrations in list of (question, query) format
@@ -96,6 +95,20 @@ class DemonstrationSelectionAgent(BaseAgent):
         demonstration_section_text = fill_demonstrations(demonstrations, template)
         return demonstration_section_text
 
+    def run_batch(self, questions:list, demonstration_selector_option:str='jaccard', num_demonstrations:int=5):
+        """Demonstration section text of each question, the jaccard selector scores all questions with one shared inverted index.
+        """
+        if demonstration_selector_option != 'jaccard':
+            return [self.run(x, demonstration_selector_option=demonstration_selector_option, num_demonstrations=num_demonstrations) for x in questions]
+        if self.demonstration_selector is None or self.demonstration_selector.name != 'jaccard_demonstration_selector':
+            self.demonstration_selector = self.initialize_demonstration_selector(demonstration_selector_option)
+        demonstrations_list = self.demonstration_selector.select_demonstrations_batch(
+            [self.get_data_dict(x) for x in questions],
+            num_demonstrations=num_demonstrations,
+            flag_return_ids=False
+        )
+        return [self.get_demonstration_section_text(x) for x in demonstrations_list]
+
 
 def test_agent():
     from agents.data_loader_agent import DataLoaderAgent
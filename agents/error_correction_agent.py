@@ -12,10 +12,8 @@ from openai import OpenAI
 # sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from .base_agent import BaseAgent
-from dataset_classes.spider_dataset import SpiderDataset
-from dataset_classes.wikisql_dataset import WikiSQLDataset
 from utils.construct_prompt_utils import fill_prompt_construction_prompt
-from utils.openai_utils import init_openai_client, get_prompt_from_openai
+from utils.openai_utils import init_openai_client, init_async_openai_client, get_prompt_from_openai, get_prompt_from_openai_async
 from utils.correction_utils import fill_error_correction_prompt
 from utils.sql_str_utils import query_postprocessing
 
@@ -38,6 +36,7 @@ class ErrorCorrectionAgent(BaseAgent):
         openai_api_key = kwargs.get('openai_api_key', None)
         openai_organization = kwargs.get('openai_organization', '')
         self._initialize_openai_client(openai_api_key, openai_organization)
+        self.response_cache = kwargs.get('response_cache', None) ## LLMResponseCache shared by agents, fall back to the global cache if None
 
 
     def _initialize(self, properties=None):
@@ -51,6 +50,7 @@ class ErrorCorrectionAgent(BaseAgent):
 
     def _initialize_openai_client(self, openai_api_key:str, openai_organization:str=''):
         self.client = init_openai_client(openai_api_key, openai_organization)
+        self.async_client = init_async_openai_client(openai_api_key, openai_organization)
 
     def prompt_openai(self, prompt_text:str, model:str='gpt-4', temperature:float=0.0, n:int=1, seed:int=None):
         res = get_prompt_from_openai(
@@ -62,19 +62,36 @@ class ErrorCorrectionAgent(BaseAgent):
             seed=seed,
             max_num_retry=5,
             flag_use_original=True,
-            flag_return_text_only=True
+            flag_return_text_only=True,
+            response_cache=self.response_cache
+        )
+        return res
+
+    async def prompt_openai_async(self, prompt_text:str, model:str='gpt-4', temperature:float=0.0, n:int=1, seed:int=None):
+        res = await get_prompt_from_openai_async(
+            self.async_client,
+            model=model,
+            data=prompt_text,
+            temperature=temperature,
+            n=n,
+            seed=seed,
+            max_num_retry=5,
+            flag_use_original=True,
+            flag_return_text_only=True,
+            response_cache=self.response_cache
         )
         return res
 
     def format_output(self, output_dict:dict):
         pass
 
-    def run(self, question:str, sql_query:str, schema_text:str=None, rules_groups:List[int]=[1,3,4], model:str='gpt-4'):
+    def run(self, question:str, sql_query:str, schema_text:str=None, rules_groups:List[int]=[1,3,4], model:str='gpt-4', error_message:str=None):
         prompt_text = fill_error_correction_prompt(
             question, 
             sql_query, 
             schema_text,
-            rules_groups=rules_groups
+            rules_groups=rules_groups,
+            error_message=error_message
         )
         if prompt_text is None:
             print("Prompt text is None, cannot construct prompt.")
@@ -83,11 +100,31 @@ class ErrorCorrectionAgent(BaseAgent):
         prompt_res = query_postprocessing(prompt_res)
         return prompt_text, prompt_res
     
+    async def run_async(self, question:str, sql_query:str, schema_text:str=None, rules_groups:List[int]=[1,3,4], model:str='gpt-4', error_message:str=None):
+        prompt_text = fill_error_correction_prompt(
+            question, 
+            sql_query, 
+            schema_text,
+            rules_groups=rules_groups,
+            error_message=error_message
+        )
+        if prompt_text is None:
+            print("Prompt text is None, cannot construct prompt.")
+            return None
+        prompt_res = await self.prompt_openai_async(prompt_text, model=model)
+        prompt_res = query_postprocessing(prompt_res)
+        return prompt_text, prompt_res
+    
     def run_with_generated_prompt(self, prompt_text:str, model:str='gpt-4'):
         prompt_res = self.prompt_openai(prompt_text, model=model)
         prompt_res = query_postprocessing(prompt_res)
         return prompt_text, prompt_res
 
+    async def run_with_generated_prompt_async(self, prompt_text:str, model:str='gpt-4'):
+        prompt_res = await self.prompt_openai_async(prompt_text, model=model)
+        prompt_res = query_postprocessing(prompt_res)
+        return prompt_text, prompt_res
+
 
 def test_agent():
     from agents.data_loader_agent import DataLoaderAgent
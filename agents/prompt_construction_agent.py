@@ -5,17 +5,18 @@ Prompt Construction Agent (currently only for Spider Dataset)
 import sys
 import os
 import sqlite3
+import time
 import logging
+import asyncio
 from openai import OpenAI
 
 # sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from .base_agent import BaseAgent
-from dataset_classes.spider_dataset import SpiderDataset
-from dataset_classes.wikisql_dataset import WikiSQLDataset
-from utils.construct_prompt_utils import fill_prompt_construction_prompt
-from utils.openai_utils import init_openai_client, get_prompt_from_openai
+from utils.construct_prompt_utils import build_prompt_construction_prompt, STABLE_PREFIX_SECTION_ORDER
+from utils.openai_utils import init_openai_client, init_async_openai_client, get_prompt_from_openai, get_prompt_from_openai_async, get_prompt_from_openai_stream_async
 from utils.sql_str_utils import query_postprocessing
+from utils.sql_utils import select_sql_by_execution
 
 prompt_construction_properties = {
     'name': 'PromptConstructionAgent',
@@ -36,6 +37,9 @@ class PromptConstructionAgent(BaseAgent):
         openai_api_key = kwargs.get('openai_api_key', None)
         openai_organization = kwargs.get('openai_organization', '')
         self._initialize_openai_client(openai_api_key, openai_organization)
+        self.response_cache = kwargs.get('response_cache', None) ## LLMResponseCache shared by agents, fall back to the global cache if None
+        ## stable prefix mode: instruction -> schema -> demonstrations -> question for every template option, so requests on the same database share the prompt prefix
+        self.flag_stable_prefix = kwargs.get('flag_stable_prefix', False)
         
 
     def _initialize(self, properties=None):
@@ -49,8 +53,9 @@ class PromptConstructionAgent(BaseAgent):
 
     def _initialize_openai_client(self, openai_api_key:str, openai_organization:str=''):
         self.client = init_openai_client(openai_api_key, openai_organization)
+        self.async_client = init_async_openai_client(openai_api_key, openai_organization)
 
-    def prompt_openai(self, prompt_text:str, model:str='gpt-4', temperature:float=0.0, n:int=1, seed:int=None):
+    def prompt_openai(self, prompt_text:str, model:str='gpt-4', temperature:float=0.0, n:int=1, seed:int=None, flag_return_usage:bool=False):
         res = get_prompt_from_openai(
             self.client,
             model=model,
@@ -60,21 +65,135 @@ class PromptConstructionAgent(BaseAgent):
             seed=seed,
             max_num_retry=5,
             flag_use_original=True,
-            flag_return_text_only=True
+            flag_return_text_only=True,
+            response_cache=self.response_cache,
+            flag_return_usage=flag_return_usage
         )
         return res
 
+    async def prompt_openai_async(self, prompt_text:str, model:str='gpt-4', temperature:float=0.0, n:int=1, seed:int=None, flag_return_usage:bool=False):
+        res = await get_prompt_from_openai_async(
+            self.async_client,
+            model=model,
+            data=prompt_text,
+            temperature=temperature,
+            n=n,
+            seed=seed,
+            max_num_retry=5,
+            flag_use_original=True,
+            flag_return_text_only=True,
+            response_cache=self.response_cache,
+            flag_return_usage=flag_return_usage
+        )
+        return res
+
+    async def prompt_openai_stream_async(self, prompt_text:str, on_token, model:str='gpt-4', temperature:float=0.0, seed:int=None):
+        """Stream the response with the OpenAI streaming API, on_token is called with each text delta, return the full text and the usage.
+        """
+        output = {}
+        async for delta in get_prompt_from_openai_stream_async(
+            self.async_client,
+            model=model,
+            data=prompt_text,
+            temperature=temperature,
+            seed=seed,
+            max_num_retry=5,
+            response_cache=self.response_cache,
+            output=output
+        ):
+            on_token(delta)
+        return output["response"], output["usage"]
+
     def format_output(self, output_dict:dict):
         pass
 
-    def run(self, question, schema_text:str=None, demonstration_text:str=None, template_option:str='option_1', model:str='gpt-4'):
-        prompt_text = fill_prompt_construction_prompt(question, schema_text, demonstration_text, template_option)
+    def build_prompt(self, question, schema_text:str=None, demonstration_text:str=None, template_option:str='option_1', max_tokens:int=4096):
+        """Return the prompt text and its token counts, including the expected number of prefix tokens shared with other requests on the same database.
+        """
+        section_order = STABLE_PREFIX_SECTION_ORDER if self.flag_stable_prefix else None
+        return build_prompt_construction_prompt(question, schema_text, demonstration_text, template_option, max_tokens=max_tokens, section_order=section_order)
+
+    def get_prompt_stats(self, token_counts:dict, usage:dict, prompt_build_latency:float=None, llm_latency:float=None):
+        """Expected shared prefix length of the prompt and the prompt tokens actually served from the provider-side prompt cache (None if no API call was made),
+        and the latency (seconds) of building the prompt and of the LLM call.
+        """
+        return {
+            "num_prompt_tokens": token_counts["num_tokens"],
+            "num_shared_prefix_tokens": token_counts["num_shared_prefix_tokens"],
+            "usage": usage,
+            "prompt_build_latency": prompt_build_latency,
+            "llm_latency": llm_latency,
+        }
+
+    def run(self, question, schema_text:str=None, demonstration_text:str=None, template_option:str='option_1', model:str='gpt-4', max_tokens:int=4096, flag_return_prompt_stats:bool=False):
+        """Return the prompt text and the generated SQL, and the prompt stats (see get_prompt_stats) if flag_return_prompt_stats.
+        """
+        start_time = time.perf_counter()
+        prompt_text, token_counts = self.build_prompt(question, schema_text, demonstration_text, template_option, max_tokens=max_tokens)
+        prompt_build_latency = time.perf_counter() - start_time
         if prompt_text is None:
             print("Prompt text is None, cannot construct prompt.")
             return None
-        prompt_res = self.prompt_openai(prompt_text, model=model)
+        start_time = time.perf_counter()
+        prompt_res, usage = self.prompt_openai(prompt_text, model=model, flag_return_usage=True)
+        llm_latency = time.perf_counter() - start_time
         prompt_res = query_postprocessing(prompt_res)
+        if flag_return_prompt_stats:
+            return prompt_text, prompt_res, self.get_prompt_stats(token_counts, usage, prompt_build_latency, llm_latency)
         return prompt_text, prompt_res
+
+    async def run_async(self, question, schema_text:str=None, demonstration_text:str=None, template_option:str='option_1', model:str='gpt-4', max_tokens:int=4096, flag_return_prompt_stats:bool=False, on_token=None):
+        """Same as run with the async client. If on_token is given, the response is streamed and on_token is called with each raw text delta,
+        the returned SQL is still postprocessed from the full text.
+        """
+        start_time = time.perf_counter()
+        prompt_text, token_counts = self.build_prompt(question, schema_text, demonstration_text, template_option, max_tokens=max_tokens)
+        prompt_build_latency = time.perf_counter() - start_time
+        if prompt_text is None:
+            print("Prompt text is None, cannot construct prompt.")
+            return None
+        start_time = time.perf_counter()
+        if on_token is not None:
+            prompt_res, usage = await self.prompt_openai_stream_async(prompt_text, on_token, model=model)
+        else:
+            prompt_res, usage = await self.prompt_openai_async(prompt_text, model=model, flag_return_usage=True)
+        llm_latency = time.perf_counter() - start_time
+        prompt_res = query_postprocessing(prompt_res)
+        if flag_return_prompt_stats:
+            return prompt_text, prompt_res, self.get_prompt_stats(token_counts, usage, prompt_build_latency, llm_latency)
+        return prompt_text, prompt_res
+
+    def postprocess_candidates(self, candidates):
+        if candidates is None:
+            return []
+        if isinstance(candidates, str):
+            candidates = [candidates]
+        return [query_postprocessing(x) for x in candidates if x]
+
+    def run_with_candidates(self, question, db_path:str, schema_text:str=None, demonstration_text:str=None, template_option:str='option_1', model:str='gpt-4', max_tokens:int=4096, num_candidates:int=5, temperature:float=0.7, timeout:float=10.0):
+        """Request num_candidates SQL queries in one API call, execute them on the database and pick by majority vote of the execution results.
+        Return the prompt text, the selected SQL (None if no candidate executes successfully), and the candidates with the selection details.
+        """
+        start_time = time.perf_counter()
+        prompt_text, token_counts = self.build_prompt(question, schema_text, demonstration_text, template_option, max_tokens=max_tokens)
+        prompt_build_latency = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        candidates, usage = self.prompt_openai(prompt_text, model=model, temperature=temperature, n=num_candidates, flag_return_usage=True)
+        llm_latency = time.perf_counter() - start_time
+        candidates = self.postprocess_candidates(candidates)
+        selection = select_sql_by_execution(candidates, db_path, timeout=timeout)
+        return prompt_text, selection["sql"] if selection else None, {"candidates": candidates, "selection": selection, "prompt_stats": self.get_prompt_stats(token_counts, usage, prompt_build_latency, llm_latency)}
+
+    async def run_with_candidates_async(self, question, db_path:str, schema_text:str=None, demonstration_text:str=None, template_option:str='option_1', model:str='gpt-4', max_tokens:int=4096, num_candidates:int=5, temperature:float=0.7, timeout:float=10.0):
+        start_time = time.perf_counter()
+        prompt_text, token_counts = self.build_prompt(question, schema_text, demonstration_text, template_option, max_tokens=max_tokens)
+        prompt_build_latency = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        candidates, usage = await self.prompt_openai_async(prompt_text, model=model, temperature=temperature, n=num_candidates, flag_return_usage=True)
+        llm_latency = time.perf_counter() - start_time
+        candidates = self.postprocess_candidates(candidates)
+        selection = await asyncio.to_thread(select_sql_by_execution, candidates, db_path, timeout)
+        return prompt_text, selection["sql"] if selection else None, {"candidates": candidates, "selection": selection, "prompt_stats": self.get_prompt_stats(token_counts, usage, prompt_build_latency, llm_latency)}
     
 
 def test_agent():
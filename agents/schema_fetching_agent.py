@@ -12,7 +12,6 @@ from pathlib import Path
 
 from .base_agent import BaseAgent
 from dataset_classes.spider_dataset import SpiderDataset
-from dataset_classes.wikisql_dataset import WikiSQLDataset
 from utils.sql_utils import get_sql_for_database
 
 schema_fetching_properties = {
@@ -33,7 +32,9 @@ class SchemaFetchingAgent(BaseAgent):
         self.output = schema_fetching_properties['output']
 
         self.schema = None ## db_id to schema text mapping
-        if 'cache_schema_path' in kwargs and kwargs['cache_schema_path']:
+        if 'cache_schema_path' in kwargs and kwargs['cache_schema_path'] and kwargs.get('resource_registry') is not None:
+            self.schema = kwargs['resource_registry'].get_schema_store(kwargs['cache_schema_path'])
+        elif 'cache_schema_path' in kwargs and kwargs['cache_schema_path']:
             print(f"Loading schema cache from {kwargs['cache_schema_path']}")
             self.schema = self._load_schema(kwargs['cache_schema_path'])
         else:
@@ -6,11 +6,12 @@ import sys
 import os
 import sqlite3
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from .base_agent import BaseAgent
-from utils.sql_utils import get_exec_result_from_query, get_exec_result_from_query_return_columns
+from utils.sql_utils import get_exec_result_from_query, get_exec_result_from_query_return_columns, validate_sql, postprocess
 from dataset_classes.spider_dataset import SpiderDataset
 
 sql_execution_properties = {
@@ -69,7 +70,14 @@ class SqlExecutionAgent(BaseAgent):
         result = {"status": "error", "error_message": error_message}
         return result
 
-    def run(self, sql_query:str, database:str, database_path:str=None, return_col_names=True) -> dict:
+    def get_db_path(self, database:str, database_path:str=None):
+        """Path of the sqlite file of the database with Name/ID database.
+        """
+        if database_path is None:
+            database_path = self.database_path
+        return os.path.join(database_path, database, f"{database}.sqlite") # Spider dataset
+
+    def run(self, sql_query:str, database:str, database_path:str=None, return_col_names=True, timeout:float=None) -> dict:
         """
         Executes an SQL query on the specified database and returns the result.
         
@@ -78,22 +86,28 @@ class SqlExecutionAgent(BaseAgent):
         database (str): The Name/ID of the database to run the query on.
         database_path (str): The path to the directory containing the database files.
         return_col_names (bool): Whether to return the column names along with the query results.
+        timeout (float): Seconds before the query is interrupted, no limit if None.
         
         Returns:
         dict: A dictionary containing query results or errors.
         """
-        if database_path is None:
-            database_path = self.database_path
-        db_path = os.path.join(database_path, database, f"{database}.sqlite") # Spider dataset
+        db_path = self.get_db_path(database, database_path)
         
         print(f"Executing query on database {database} at {db_path}")
         print(f"SQL Query: {sql_query}")
+
+        ## compile the query first (EXPLAIN, cached per query), queries that do not compile are not executed
+        ## the query is checked as it will be executed, i.e. after postprocess (e.g. "> =" -> ">=")
+        if os.path.isfile(db_path):
+            diagnostics = validate_sql(postprocess(sql_query), db_path)
+            if not diagnostics["valid"]:
+                return {"status": "error", "error_message": diagnostics["error_message"], "diagnostics": diagnostics}
         
         try:
             if return_col_names:
-                flag, result, columns = get_exec_result_from_query_return_columns(sql_query, db_path)
+                flag, result, columns = get_exec_result_from_query_return_columns(sql_query, db_path, timeout=timeout)
             else:
-                flag, result = get_exec_result_from_query(sql_query, db_path)
+                flag, result = get_exec_result_from_query(sql_query, db_path, timeout=timeout)
             
             flag = "error" if flag == "exception" else flag ## rename the flag
         except Exception as e:
@@ -108,4 +122,24 @@ class SqlExecutionAgent(BaseAgent):
         if output_dict["query_exec_flag"] == "error":
             return self.error_handling(output_dict)
         return output_dict
+
+    def run_safe(self, sql_query:str, database:str, database_path:str=None, return_col_names=True, timeout:float=None) -> dict:
+        """run that returns an error dict instead of raising, so one failing query does not fail a batch.
+        """
+        try:
+            return self.run(sql_query, database, database_path=database_path, return_col_names=return_col_names, timeout=timeout)
+        except Exception as e:
+            return {"status": "error", "error_message": str(e)}
+
+    def run_batch(self, sql_queries:list, databases:list, database_path:str=None, return_col_names=True, max_workers:int=8, timeout:float=None) -> list:
+        """Execute the queries concurrently on a thread pool (compilation checks share the pooled read-only connections), results in the order of the queries.
+        A query running longer than timeout seconds is interrupted and reported as an error.
+        """
+        if not sql_queries:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(sql_queries))) as executor:
+            return list(executor.map(
+                lambda x: self.run_safe(x[0], x[1], database_path=database_path, return_col_names=return_col_names, timeout=timeout),
+                zip(sql_queries, databases)
+            ))
     
@@ -1,65 +1,234 @@
 import os
 import sys
+import copy
+import json
+import time
+import asyncio
+import threading
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'agents'))
 
 import logging
 logger = logging.getLogger(__name__)
 
-from agents.data_loader_agent import DataLoaderAgent
-from agents.database_routing_agent import DatabaseRoutingAgent
-from agents.schema_fetching_agent import SchemaFetchingAgent
-from agents.demonstration_selection_agent import DemonstrationSelectionAgent
-from agents.prompt_construction_agent import PromptConstructionAgent
-from agents.error_correction_agent import ErrorCorrectionAgent
-from agents.sql_execution_agent import SqlExecutionAgent
+## the agents are imported when they are constructed (see the create_* methods), so that torch, transformers and nltk are only loaded when needed
+from utils.openai_utils import get_global_response_cache
+from utils.pipeline_utils import PipelineDAG
+from utils.resource_registry import get_resource_registry
+from utils.sql_utils import validate_sql, postprocess
+from utils.metrics_utils import stage_latency_histogram, stage_error_counter, sql_execution_error_counter, get_cache_hit_rates
+from utils.metrics_utils import pipeline_request_counter, coalesced_pipeline_request_counter, in_flight_pipeline_gauge
+
+
+CORRECTION_POLICIES = ['always', 'on_error', 'on_error_or_empty']
+## modules that take seconds to import, reported by get_health to check that they are only loaded when needed
+HEAVY_MODULES = ['torch', 'transformers', 'nltk', 'pandas']
 
 
 class AgentCenter():
-    def __init__(self):
-        ## initialize all agents
-        print("Initializing data loader agent...")
-        self.data_loader_agent = DataLoaderAgent()
+    def __init__(self, flag_eager_init:bool=None):
+        """
+        Agents (and the dataset) are constructed on first use, so the API starts serving within seconds and a worker that never routes does not load the routing model.
+        flag_eager_init constructs all agents now as before, default from the env var MAGESQL_EAGER_AGENTS=1. See also warm_up.
+        """
         ## set the base path as ../.. of current file path
         self.base_path = os.path.join(os.path.dirname(__file__), '..', '..')
         self.dataset_name = "spider"
         self.dataset_dir_path = os.path.join(self.base_path, 'datasets', self.dataset_name)
-        self.dataset = self.data_loader_agent.run(self.dataset_name, self.dataset_dir_path)
-        
-        print("Initializing database routing agent...")
         self.database_routing_model_path = os.path.join(self.base_path, 'database_routing/saved_models/database_routing_spider_v1')
-        self.database_routing_agent = DatabaseRoutingAgent(model_path=self.database_routing_model_path)
-        
-        print("Initializing schema fetching agent...")
         self.schema_file_path = os.path.join(self.base_path, 'datasets/spider/db_id2schema_text.json')
-        self.schema_fetching_agent = SchemaFetchingAgent(cache_schema_path=self.schema_file_path)
+        # self.database_path = os.path.join(self.base_path, 'datasets/spider/database')
+        self.database_path = os.path.join(self.base_path, 'datasets/spider/database_all_splits')
 
-        print("Initializing demonstration selection agent...")
-        self.demonstration_selection_agent = DemonstrationSelectionAgent(dataset=self.dataset)
-        
-        print("Initializing prompt construction agent...")
-        self.prompt_construction_agent = PromptConstructionAgent()
+        ## datasets, tokenizers, models and schema stores shared by the agents (and the gold SQL retrieval) of the process
+        self.resource_registry = get_resource_registry()
 
-        print("Initializing error correction agent...")
-        self.error_correction_agent = ErrorCorrectionAgent()
+        ## micro-batching of the DistilBERT forward passes of concurrent requests (routing and gold SQL retrieval), a batch size of 1 disables it
+        self.micro_batch_size = int(os.getenv('MAGESQL_MICRO_BATCH_SIZE', '16'))
+        self.micro_batch_wait_ms = float(os.getenv('MAGESQL_MICRO_BATCH_WAIT_MS', '5'))
 
-        print("Initializing sql execution agent...")
-        # self.database_path = os.path.join(self.base_path, 'datasets/spider/database')
-        self.database_path = os.path.join(self.base_path, 'datasets/spider/database_all_splits')
-        self.sql_execution_agent = SqlExecutionAgent(database_path=self.database_path)
+        ## inference backend of the routing classifier: torch, onnxruntime or torch_dynamic_quant, see routing_backend_benchmark.py
+        self.database_routing_backend = os.getenv('MAGESQL_ROUTING_BACKEND', 'torch')
+        ## routing mode: model, lexical (BM25) or cascade (BM25, the model when the BM25 margin is below MAGESQL_LEXICAL_MARGIN)
+        self.database_routing_mode = os.getenv('MAGESQL_ROUTING_MODE', 'model')
+        self.lexical_margin_threshold = float(os.getenv('MAGESQL_LEXICAL_MARGIN', '0.3'))
 
-        print("Agent center initialized successfully.")
+        ## LRU caches of the routing predictions and question embeddings keyed by the normalized question, a size of 0 disables them,
+        ## with MAGESQL_MODEL_CACHE_DIR the entries are also stored in SQLite files of this directory and survive restarts
+        self.routing_cache_size = int(os.getenv('MAGESQL_ROUTING_CACHE_SIZE', '4096'))
+        self.embedding_cache_size = int(os.getenv('MAGESQL_EMBEDDING_CACHE_SIZE', '4096'))
+        self.model_cache_dir = os.getenv('MAGESQL_MODEL_CACHE_DIR')
+
+        ## seconds before the query executed to decide on the error correction is interrupted
+        self.correction_check_timeout = float(os.getenv('MAGESQL_CORRECTION_CHECK_TIMEOUT', '10'))
+
+        ## cache of deterministic LLM responses shared by the prompt construction and error correction agents,
+        ## opt-in with MAGESQL_LLM_CACHE_PATH (a SQLite file, keep it outside the repository), None if not configured
+        self.llm_response_cache = get_global_response_cache()
+
+        ## constructors of the agents and shared resources, called on first use
+        self.resource_name2factory = {
+            'Dataset': self.create_dataset,
+            'Data Loader Agent': self.create_data_loader_agent,
+            'Database Routing Agent': self.create_database_routing_agent,
+            'Schema Fetching Agent': self.create_schema_fetching_agent,
+            'Demonstration Selection Agent': self.create_demonstration_selection_agent,
+            'Prompt Construction Agent': self.create_prompt_construction_agent,
+            'Error Correction Agent': self.create_error_correction_agent,
+            'SQL Execution Agent': self.create_sql_execution_agent,
+        }
+        self.resource_name2instance = {}
+        self.resource_name2load_time = {}
+        self.resource_name2lock = {name: threading.Lock() for name in self.resource_name2factory}
+        self.warm_up_status = 'not_started'
 
         # Set initial agent states
-        self.agent_name2agent = {
-            'Data Loader Agent': self.data_loader_agent,
-            'Database Routing Agent': self.database_routing_agent,
-            'Schema Fetching Agent': self.schema_fetching_agent,
-            'Demonstration Selection Agent': self.demonstration_selection_agent,
-            'Prompt Construction Agent': self.prompt_construction_agent,
-            'Error Correction Agent': self.error_correction_agent,
-            'SQL Execution Agent': self.sql_execution_agent,
+        self.agent_names = [name for name in self.resource_name2factory if name.endswith('Agent')]
+        self.agent_name2status = {agent_name: 'active' for agent_name in self.agent_names}
+
+        ## single-flight coalescing of identical concurrent pipeline requests: request key -> in-flight task
+        ## the numbers of requests are recorded in the metrics registry, see get_pipeline_coalescing_stats
+        self.pipeline_key2task = {}
+
+        if flag_eager_init is None:
+            flag_eager_init = os.getenv('MAGESQL_EAGER_AGENTS') == '1'
+        if flag_eager_init:
+            self.warm_up()
+        print("Agent center initialized successfully.")
+
+    def get_resource(self, name:str):
+        """Construct the agent or resource on first use (thread-safe, each one is constructed once) and return it.
+        """
+        instance = self.resource_name2instance.get(name)
+        if instance is not None:
+            return instance
+        with self.resource_name2lock[name]:
+            if name not in self.resource_name2instance:
+                print(f"Initializing {name}...")
+                start_time = time.perf_counter()
+                self.resource_name2instance[name] = self.resource_name2factory[name]()
+                self.resource_name2load_time[name] = time.perf_counter() - start_time
+                print(f"Initialized {name} in {self.resource_name2load_time[name]:.2f} seconds.")
+            return self.resource_name2instance[name]
+
+    def get_agent(self, agent_name:str):
+        if agent_name not in self.agent_name2status:
+            raise ValueError(f"Agent {agent_name} not found.")
+        return self.get_resource(agent_name)
+
+    async def get_agent_async(self, agent_name:str):
+        """Same as get_agent, the construction on first use runs in a worker thread so it does not block the event loop.
+        """
+        agent = self.resource_name2instance.get(agent_name)
+        if agent is not None:
+            return agent
+        return await asyncio.to_thread(self.get_agent, agent_name)
+
+    @property
+    def agent_name2agent(self):
+        """Agents constructed so far.
+        """
+        return {name: self.resource_name2instance[name] for name in self.agent_names if name in self.resource_name2instance}
+
+    def warm_up(self, resource_names:list=None):
+        """Construct the given agents/resources (all by default) now instead of on the first request.
+        """
+        self.warm_up_status = 'running'
+        try:
+            for name in resource_names or list(self.resource_name2factory):
+                self.get_resource(name)
+        except Exception:
+            self.warm_up_status = 'failed'
+            raise
+        self.warm_up_status = 'done'
+
+    def get_health(self):
+        return {
+            "status": "ok",
+            "warm_up_status": self.warm_up_status,
+            "loaded": {name: round(self.resource_name2load_time[name], 3) for name in self.resource_name2instance},
+            "not_loaded": [name for name in self.resource_name2factory if name not in self.resource_name2instance],
+            "heavy_modules_loaded": [x for x in HEAVY_MODULES if x in sys.modules],
+            "shared_resources": self.resource_registry.get_stats(),
+            "routing_cache": self.resource_name2instance['Database Routing Agent'].routing_cache.get_stats() if 'Database Routing Agent' in self.resource_name2instance else None,
         }
-        self.agent_name2status = {agent_name: 'active' for agent_name in self.agent_name2agent.keys()}
+
+    def get_model_cache_path(self, file_name:str):
+        return os.path.join(self.model_cache_dir, file_name) if self.model_cache_dir else None
+
+    def create_dataset(self):
+        return self.data_loader_agent.run(self.dataset_name, self.dataset_dir_path)
+
+    def create_data_loader_agent(self):
+        from agents.data_loader_agent import DataLoaderAgent
+        return DataLoaderAgent(resource_registry=self.resource_registry)
+
+    def create_database_routing_agent(self):
+        from agents.database_routing_agent import DatabaseRoutingAgent
+        return DatabaseRoutingAgent(
+            model_path=self.database_routing_model_path,
+            resource_registry=self.resource_registry,
+            backend=self.database_routing_backend,
+            routing_mode=self.database_routing_mode,
+            lexical_margin_threshold=self.lexical_margin_threshold,
+            dataset_dir_path=self.dataset_dir_path,
+            routing_cache_size=self.routing_cache_size,
+            routing_cache_path=self.get_model_cache_path('routing_cache.sqlite'),
+            max_batch_size=self.micro_batch_size,
+            max_wait_ms=self.micro_batch_wait_ms
+        )
+
+    def create_schema_fetching_agent(self):
+        from agents.schema_fetching_agent import SchemaFetchingAgent
+        return SchemaFetchingAgent(cache_schema_path=self.schema_file_path, resource_registry=self.resource_registry)
+
+    def create_demonstration_selection_agent(self):
+        from agents.demonstration_selection_agent import DemonstrationSelectionAgent
+        return DemonstrationSelectionAgent(dataset=self.dataset)
+
+    def create_prompt_construction_agent(self):
+        from agents.prompt_construction_agent import PromptConstructionAgent
+        ## MAGESQL_STABLE_PREFIX=1 puts the schema before the demonstrations in every template, so requests on the same database share the prompt prefix
+        return PromptConstructionAgent(response_cache=self.llm_response_cache, flag_stable_prefix=os.getenv('MAGESQL_STABLE_PREFIX') == '1')
+
+    def create_error_correction_agent(self):
+        from agents.error_correction_agent import ErrorCorrectionAgent
+        return ErrorCorrectionAgent(response_cache=self.llm_response_cache)
+
+    def create_sql_execution_agent(self):
+        from agents.sql_execution_agent import SqlExecutionAgent
+        return SqlExecutionAgent(database_path=self.database_path)
+
+    @property
+    def dataset(self):
+        return self.get_resource('Dataset')
+
+    @property
+    def data_loader_agent(self):
+        return self.get_resource('Data Loader Agent')
+
+    @property
+    def database_routing_agent(self):
+        return self.get_resource('Database Routing Agent')
+
+    @property
+    def schema_fetching_agent(self):
+        return self.get_resource('Schema Fetching Agent')
+
+    @property
+    def demonstration_selection_agent(self):
+        return self.get_resource('Demonstration Selection Agent')
+
+    @property
+    def prompt_construction_agent(self):
+        return self.get_resource('Prompt Construction Agent')
+
+    @property
+    def error_correction_agent(self):
+        return self.get_resource('Error Correction Agent')
+
+    @property
+    def sql_execution_agent(self):
+        return self.get_resource('SQL Execution Agent')
 
     def toggle_agent_status(self, agent_name: str, agent_status: str):
         """
@@ -85,10 +254,8 @@ class AgentCenter():
         """
         return self.agent_name2status.get(agent_name, 'inactive')
 
-    def execute_agent(self, agent_name: str, *args):
-        """
-        Execute a specific agent if it's active, considering dependencies.
-        For agents that depend on other agents, behavior may vary.
+    def check_agent_executable(self, agent_name: str):
+        """Raise if the agent or an agent it depends on is inactive.
         """
         if self.agent_name2status[agent_name] != 'active':
             raise ValueError(f"Agent {agent_name} is inactive.")
@@ -99,11 +266,225 @@ class AgentCenter():
         if agent_name == 'Error Correction Agent' and self.get_agent_status('Prompt Construction Agent') == 'inactive':
             raise ValueError("Prompt Construction Agent must be active for Error Correction Agent to work.")
 
+    def execute_agent(self, agent_name: str, *args):
+        """
+        Execute a specific agent if it's active, considering dependencies.
+        For agents that depend on other agents, behavior may vary.
+        """
+        self.check_agent_executable(agent_name)
         # Execute the agent's run method
-        agent = self.agent_name2agent[agent_name]
+        agent = self.get_agent(agent_name)
         return agent.run(*args)
 
-    def run_pipeline(
+    async def execute_agent_async(self, agent_name: str, *args):
+        """Same as execute_agent, the agent is constructed and run in worker threads so the event loop is not blocked.
+        """
+        self.check_agent_executable(agent_name)
+        agent = await self.get_agent_async(agent_name)
+        return await asyncio.to_thread(agent.run, *args)
+
+    async def get_correction_reason(self, sql_query: str, db_id: str, correction_policy: str = 'on_error', flag_execute: bool = True):
+        """
+        Decide whether the generated SQL needs the Error Correction Agent.
+        always: always correct. on_error: correct only if the query fails on the database. on_error_or_empty: also correct if the query returns no rows.
+        Return the reason of correction (None if no correction is needed), the SQLite error message to feed into the correction prompt,
+        and the execution result so that it could be reused instead of executing the same query again.
+        The query is executed with a timeout (correction_check_timeout). If not flag_execute (the caller disabled the execution), it is only compiled (EXPLAIN, see validate_sql)
+        and no execution result is returned, so on_error_or_empty then only corrects queries that do not compile.
+        A query interrupted by the timeout is not corrected: it compiled (run validates it before executing it) and a slow query is not an error,
+        no execution result is returned so the execution stage runs it again without the timeout.
+        """
+        if correction_policy == 'always':
+            return 'always', None, None
+        if not db_id or self.get_agent_status('SQL Execution Agent') != 'active':
+            ## cannot check the query without the database, correct it as before
+            return 'unchecked', None, None
+        sql_execution_agent = await self.get_agent_async('SQL Execution Agent')
+        if not flag_execute:
+            db_path = sql_execution_agent.get_db_path(db_id)
+            if not os.path.isfile(db_path):
+                return 'unchecked', None, None
+            diagnostics = await asyncio.to_thread(validate_sql, postprocess(sql_query), db_path)
+            if not diagnostics["valid"]:
+                return 'execution_error', diagnostics["error_message"], None
+            return None, None, None
+        sql_result = await asyncio.to_thread(sql_execution_agent.run, sql_query, db_id, timeout=self.correction_check_timeout)
+        ## sqlite3.OperationalError raised by the progress handler of the timeout, see set_query_timeout
+        if sql_result.get("status") == "error" and sql_result["error_message"] == "OperationalError: interrupted":
+            logger.info(f"Correction check of the query on {db_id} timed out after {self.correction_check_timeout}s, the query is not corrected")
+            return None, None, None
+        if sql_result.get("status") == "error":
+            return 'execution_error', sql_result["error_message"], sql_result
+        if correction_policy == 'on_error_or_empty' and not sql_result["query_exec_result"]:
+            return 'empty_result', "The SQL query returns an empty result.", sql_result
+        return None, None, sql_result
+
+    def record_pipeline_metrics(self, stage_latencies:dict, outputs:dict):
+        """Record the stage latencies and SQL errors of one pipeline run in the metrics registry.
+        The generation stage is further split into prompt build and LLM call, return the stage latencies with the split.
+        """
+        stage_latencies = dict(stage_latencies)
+        prompt_stats = outputs["generation"].get("prompt_stats") or {}
+        for stage_name, latency_key in [("prompt_build", "prompt_build_latency"), ("llm", "llm_latency")]:
+            if prompt_stats.get(latency_key) is not None:
+                stage_latencies[stage_name] = prompt_stats[latency_key]
+        for stage_name, latency in stage_latencies.items():
+            if latency is not None:
+                stage_latency_histogram.observe(latency, stage=stage_name)
+        sql_result = outputs["execution"]
+        if sql_result and sql_result.get("status") == "error":
+            error_type = (sql_result.get("diagnostics") or {}).get("error_type") or "execution_error"
+            sql_execution_error_counter.inc(error_type=error_type)
+        return stage_latencies
+
+    def get_pipeline_key(self, **kwargs):
+        """Requests with the same parameters under the same agent statuses produce the same pipeline run.
+        """
+        ## dict parameters (e.g. stage2precomputed_output) are not hashable, they are keyed by their json
+        items = [(k, json.dumps(v, sort_keys=True) if isinstance(v, dict) else v) for k, v in kwargs.items()]
+        return (tuple(sorted(items)), tuple(sorted(self.agent_name2status.items())))
+
+    def get_pipeline_coalescing_stats(self):
+        """Numbers of pipeline requests from the metrics registry (also exposed on /metrics).
+        """
+        num_pipeline_requests = pipeline_request_counter.get_values().get((), 0)
+        num_coalesced_pipeline_requests = coalesced_pipeline_request_counter.get_values().get((), 0)
+        return {
+            "num_pipeline_requests": int(num_pipeline_requests),
+            "num_coalesced_pipeline_requests": int(num_coalesced_pipeline_requests),
+            "num_in_flight_pipelines": int(in_flight_pipeline_gauge.get_values().get((), 0)),
+            "coalesced_rate": num_coalesced_pipeline_requests / num_pipeline_requests if num_pipeline_requests else None,
+        }
+
+    def remove_pipeline_task(self, key):
+        self.pipeline_key2task.pop(key, None)
+        in_flight_pipeline_gauge.set(len(self.pipeline_key2task))
+
+    async def run_pipeline(self, **kwargs):
+        """
+        Run the full pipeline (see execute_pipeline for the parameters) with single-flight coalescing:
+        concurrent requests with identical parameters share one in-flight run and all receive (a copy of) its result or its exception.
+        The shared run is shielded, so a cancelled request (e.g. client disconnect) does not cancel it for the others.
+        """
+        key = self.get_pipeline_key(**kwargs)
+        pipeline_request_counter.inc()
+        task = self.pipeline_key2task.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.execute_pipeline(**kwargs))
+            self.pipeline_key2task[key] = task
+            in_flight_pipeline_gauge.set(len(self.pipeline_key2task))
+            task.add_done_callback(lambda _: self.remove_pipeline_task(key))
+        else:
+            coalesced_pipeline_request_counter.inc()
+            logger.debug(f"Coalesced pipeline request with an in-flight run for question: {kwargs.get('question')}")
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result)
+
+    async def run_pipeline_batch(self, request_kwargs_list:list, max_concurrency:int=8):
+        """
+        Run the pipeline for a list of requests (each a dict of the parameters of execute_pipeline), results in the order of the requests.
+        The routing of all questions is one batched forward pass and the demonstrations are selected with one shared index,
+        then the pipelines (LLM calls, SQL execution) run concurrently, at most max_concurrency at a time.
+        Each result has a status, a failing request gets {"status": "error", "error_message": ...} without failing the others.
+        """
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+        stage2precomputed_output_list = [{} for _ in request_kwargs_list]
+        ## execute_pipeline defaults: routing and demonstration selection enabled, 5 demonstrations
+        routing_indices = [i for i, x in enumerate(request_kwargs_list) if x.get('flag_use_database_routing_agent', True)]
+        if routing_indices and self.get_agent_status('Database Routing Agent') == 'active':
+            try:
+                database_routing_agent = await self.get_agent_async('Database Routing Agent')
+                db_ids = await asyncio.to_thread(database_routing_agent.run_batch, [request_kwargs_list[i]['question'] for i in routing_indices])
+                for i, db_id in zip(routing_indices, db_ids):
+                    stage2precomputed_output_list[i]["routing"] = db_id
+            except Exception as e:
+                ## each pipeline routes its own question and reports its own error
+                logger.error(f"Batched routing failed, routing the questions one by one: {e}")
+        num_demonstrations2indices = {}
+        for i, request_kwargs in enumerate(request_kwargs_list):
+            if request_kwargs.get('flag_use_demonstration_selection_agent', True):
+                num_demonstrations2indices.setdefault(request_kwargs.get('num_demonstrations', 5), []).append(i)
+        if num_demonstrations2indices and self.get_agent_status('Demonstration Selection Agent') == 'active':
+            try:
+                demonstration_selection_agent = await self.get_agent_async('Demonstration Selection Agent')
+                for num_demonstrations, indices in num_demonstrations2indices.items():
+                    demonstrations_texts = await asyncio.to_thread(
+                        demonstration_selection_agent.run_batch, [request_kwargs_list[i]['question'] for i in indices], num_demonstrations=num_demonstrations
+                    )
+                    for i, demonstrations_text in zip(indices, demonstrations_texts):
+                        stage2precomputed_output_list[i]["demonstrations"] = demonstrations_text
+            except Exception as e:
+                logger.error(f"Batched demonstration selection failed, selecting the demonstrations one by one: {e}")
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_item(request_kwargs:dict, stage2precomputed_output:dict):
+            async with semaphore:
+                try:
+                    result = await self.run_pipeline(**request_kwargs, stage2precomputed_output=stage2precomputed_output)
+                except Exception as e:
+                    logger.error(f"Error running pipeline for question {request_kwargs.get('question')}: {e}")
+                    return {"status": "error", "error_message": str(e)}
+                result["status"] = "success"
+                return result
+
+        return await asyncio.gather(*[run_item(x, y) for x, y in zip(request_kwargs_list, stage2precomputed_output_list)])
+
+    def get_stage_event(self, stage_name:str, output, latency:float):
+        """Event data of a finished pipeline stage, with the keys of the corresponding fields of the result of execute_pipeline.
+        """
+        if stage_name == "routing":
+            data = {"db_id": output}
+        elif stage_name == "schema":
+            data = {"schema_text": output}
+        elif stage_name == "demonstrations":
+            data = {"demonstration_text": output}
+        elif stage_name == "generation":
+            data = {
+                "prompt_construction_agent_query": output["prompt_result"],
+                "candidate_sqls": output["candidate_sqls"],
+                "num_valid_candidates": output["num_valid_candidates"],
+            }
+        elif stage_name == "correction":
+            data = {"error_correction_agent_query": output["corrected_result"], "correction_reason": output["correction_reason"]}
+        else:
+            data = {"generated_sql_exec_res": output}
+        data["latency"] = latency
+        return data
+
+    async def stream_pipeline(self, **kwargs):
+        """
+        Run the full pipeline (see execute_pipeline for the parameters) and yield (event name, data) pairs as it progresses:
+        one event per finished stage (routing, schema, demonstrations, generation, correction, execution, see get_stage_event),
+        sql_token events with each text delta of the generated SQL while the LLM streams it, then the full result (result) or the error (error).
+        A streamed run is not coalesced with other requests since each stream needs its own events, and it is cancelled when the consumer stops (e.g. client disconnect).
+        """
+        queue = asyncio.Queue()
+
+        def on_event(event_name:str, data):
+            queue.put_nowait((event_name, data))
+
+        async def run():
+            try:
+                on_event("result", await self.execute_pipeline(**kwargs, on_event=on_event))
+            except Exception as e:
+                logger.error(f"Error streaming pipeline for question {kwargs.get('question')}: {e}")
+                on_event("error", {"error_message": str(e)})
+            finally:
+                queue.put_nowait(None)
+
+        task = asyncio.ensure_future(run())
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            task.cancel()
+
+    async def execute_pipeline(
         self, 
         question: str, 
         flag_use_database_routing_agent: bool = True, 
@@ -113,11 +494,26 @@ class AgentCenter():
         prompt_template: str = 'option_1', 
         model: str = 'gpt-4', 
         flag_use_error_correction_agent: bool = True,
-        flag_use_sql_execution_agent: bool = True
+        flag_use_sql_execution_agent: bool = True,
+        num_candidates: int = 1,
+        correction_policy: str = 'on_error',
+        flag_return_metrics: bool = False,
+        stage2precomputed_output: dict = None,
+        on_event = None
     ):
         """
         Run the full pipeline, considering agent states and using parameters from the frontend.
+        LLM calls are awaited on the async OpenAI client, and the blocking model/database stages run in worker threads, so the event loop keeps serving other requests.
+        If num_candidates > 1, the candidates are requested in one call and selected by execution-result majority vote, and error correction is skipped when a valid candidate exists.
+        correction_policy decides when the Error Correction Agent is called, see get_correction_reason.
+        The stages run as a DAG (see PipelineDAG): demonstration selection runs concurrently with routing and schema fetching, and the latency of each stage is returned in stage_latencies.
+        Stage latencies, token usage and errors are recorded in the metrics registry (served at /metrics), and attached to the result as metrics if flag_return_metrics.
+        stage2precomputed_output holds outputs of the routing and demonstrations stages already computed for a batch of requests (see run_pipeline_batch), these stages return them instead of running.
+        on_event(event name, data) is called with the output of each stage as soon as it finishes and with each token of the generated SQL, see stream_pipeline.
         """
+        stage2precomputed_output = stage2precomputed_output or {}
+        if correction_policy not in CORRECTION_POLICIES:
+            raise ValueError(f"Invalid correction policy {correction_policy}, expected one of {CORRECTION_POLICIES}.")
         print("Running pipeline with the following parameters:")
         print(f"Question: {question}")
         print(f"Use Database Routing Agent: {flag_use_database_routing_agent}")
@@ -127,43 +523,114 @@ class AgentCenter():
         print(f"Prompt Template: {prompt_template}")
         print(f"Model: {model}")
         print(f"Use Error Correction Agent: {flag_use_error_correction_agent}")
+        print(f"Number of Candidates: {num_candidates}")
+        print(f"Correction Policy: {correction_policy}")
 
-        schema_text = None
-        demonstrations_text = None
-        generated_sql_for_exec = None
+        if self.get_agent_status('Prompt Construction Agent') != 'active':
+            raise ValueError("Prompt Construction Agent must be active for SQL generation.")
+        flag_use_routing = flag_use_database_routing_agent and self.get_agent_status('Database Routing Agent') == 'active'
+
+        def get_db_id(outputs):
+            return outputs["routing"] if flag_use_routing else db_id
 
         # Step 1: If the Database Routing Agent is active, use it to get the db_id
-        if flag_use_database_routing_agent and self.get_agent_status('Database Routing Agent') == 'active':
-            db_id = self.database_routing_agent.run(question)
+        async def run_routing(outputs):
+            if "routing" in stage2precomputed_output:
+                return stage2precomputed_output["routing"]
+            return await (await self.get_agent_async('Database Routing Agent')).run_async(question)
 
-        # Step 2: Fetch the schema if the Schema Fetching Agent is active
-        if self.get_agent_status('Schema Fetching Agent') == 'active':
-            schema_text = self.schema_fetching_agent.run(db_id)
+        # Step 2: Fetch the schema of the (routed) database if the Schema Fetching Agent is active
+        async def run_schema_fetching(outputs):
+            return (await self.get_agent_async('Schema Fetching Agent')).run(get_db_id(outputs))
 
-        # Step 3: Get demonstrations if the Demonstration Selection Agent is active
-        if flag_use_demonstration_selection_agent and self.get_agent_status('Demonstration Selection Agent') == 'active':
-            demonstrations_text = self.demonstration_selection_agent.run(question, demonstration_selector_option='jaccard', num_demonstrations=num_demonstrations)
+        # Step 3: Get demonstrations if the Demonstration Selection Agent is active, only depends on the question so it runs concurrently with the routing
+        async def run_demonstration_selection(outputs):
+            if "demonstrations" in stage2precomputed_output:
+                return stage2precomputed_output["demonstrations"]
+            return await asyncio.to_thread((await self.get_agent_async('Demonstration Selection Agent')).run, question, demonstration_selector_option='jaccard', num_demonstrations=num_demonstrations)
 
         # Step 4: Use the Prompt Construction Agent to create the SQL query
-        if self.get_agent_status('Prompt Construction Agent') == 'active':
-            prompt_text, prompt_result = self.prompt_construction_agent.run(question, schema_text, demonstrations_text, prompt_template, model)
-            generated_sql_for_exec = prompt_result
-        else:
-            raise ValueError("Prompt Construction Agent must be active for SQL generation.")
+        async def run_generation(outputs):
+            stage_db_id = get_db_id(outputs)
+            output = {"candidate_sqls": None, "num_valid_candidates": None}
+            if num_candidates > 1 and stage_db_id:
+                db_path = (await self.get_agent_async('SQL Execution Agent')).get_db_path(stage_db_id)
+                prompt_text, prompt_result, candidate_info = await (await self.get_agent_async('Prompt Construction Agent')).run_with_candidates_async(
+                    question, db_path, outputs["schema"], outputs["demonstrations"], prompt_template, model, num_candidates=num_candidates
+                )
+                output["candidate_sqls"] = candidate_info["candidates"]
+                output["num_valid_candidates"] = candidate_info["selection"]["num_valid_candidates"] if candidate_info["selection"] else 0
+                output["prompt_stats"] = candidate_info["prompt_stats"]
+                if prompt_result is None and output["candidate_sqls"]:
+                    ## no candidate executes successfully, leave the first one to error correction
+                    prompt_result = output["candidate_sqls"][0]
+            else:
+                ## the candidates are sampled in one request with n > 1, only a single response is streamed
+                on_token = (lambda delta: on_event("sql_token", {"text": delta})) if on_event is not None else None
+                prompt_text, prompt_result, output["prompt_stats"] = await (await self.get_agent_async('Prompt Construction Agent')).run_async(
+                    question, outputs["schema"], outputs["demonstrations"], prompt_template, model, flag_return_prompt_stats=True, on_token=on_token
+                )
+            output["prompt_text"] = prompt_text
+            output["prompt_result"] = prompt_result
+            return output
 
         # Step 5: If error correction is enabled and the Error Correction Agent is active, use it
-        if flag_use_error_correction_agent and self.get_agent_status('Error Correction Agent') == 'active':
-            correction_prompt_text, corrected_result = self.error_correction_agent.run(question, schema_text, demonstrations_text)
-            generated_sql_for_exec = corrected_result
-        else:
-            correction_prompt_text = None
-            corrected_result = None
+        async def run_correction(outputs):
+            generation = outputs["generation"]
+            output = {"correction_prompt_text": None, "corrected_result": None, "correction_reason": None, "sql_result": None}
+            ## a candidate already validated by execution does not need another LLM round trip
+            if generation["num_valid_candidates"]:
+                return output
+            correction_reason, error_message, sql_result = await self.get_correction_reason(
+                generation["prompt_result"], get_db_id(outputs), correction_policy, flag_execute=flag_use_sql_execution_agent
+            )
+            output["correction_reason"] = correction_reason
+            output["sql_result"] = sql_result
+            if correction_reason is not None:
+                output["correction_prompt_text"], output["corrected_result"] = await (await self.get_agent_async('Error Correction Agent')).run_async(
+                    question, generation["prompt_result"], outputs["schema"], model=model, error_message=error_message
+                )
+                output["sql_result"] = None
+            return output
 
-        # Step 6: Execute the generated SQL using the SQL Execution Agent
-        if flag_use_sql_execution_agent and self.get_agent_status('SQL Execution Agent') == 'active':
-            sql_result = self.sql_execution_agent.run(generated_sql_for_exec, db_id)
-        else:
-            sql_result = None
+        def get_generated_sql_for_exec(outputs):
+            if outputs.get("correction") and outputs["correction"]["correction_reason"] is not None:
+                return outputs["correction"]["corrected_result"]
+            return outputs["generation"]["prompt_result"]
+
+        # Step 6: Execute the generated SQL using the SQL Execution Agent, the result of checking the query before correction is reused
+        async def run_execution(outputs):
+            correction = outputs["correction"]
+            if correction and correction["sql_result"] is not None:
+                return correction["sql_result"]
+            return await asyncio.to_thread((await self.get_agent_async('SQL Execution Agent')).run, get_generated_sql_for_exec(outputs), get_db_id(outputs))
+
+        dag = PipelineDAG()
+        dag.add_stage("routing", run_routing, flag_enabled=flag_use_routing)
+        dag.add_stage("schema", run_schema_fetching, dependencies=["routing"], flag_enabled=self.get_agent_status('Schema Fetching Agent') == 'active')
+        dag.add_stage("demonstrations", run_demonstration_selection, flag_enabled=flag_use_demonstration_selection_agent and self.get_agent_status('Demonstration Selection Agent') == 'active')
+        dag.add_stage("generation", run_generation, dependencies=["routing", "schema", "demonstrations"])
+        dag.add_stage("correction", run_correction, dependencies=["generation"], flag_enabled=flag_use_error_correction_agent and self.get_agent_status('Error Correction Agent') == 'active')
+        dag.add_stage("execution", run_execution, dependencies=["correction"], flag_enabled=flag_use_sql_execution_agent and self.get_agent_status('SQL Execution Agent') == 'active')
+        try:
+            on_stage_done = (lambda name, output, latency: on_event(name, self.get_stage_event(name, output, latency))) if on_event is not None else None
+            outputs, stage_latencies = await dag.run(on_stage_done=on_stage_done)
+        except Exception:
+            for stage_name, error in dag.name2error.items():
+                stage_error_counter.inc(stage=stage_name, error_type=type(error).__name__)
+            raise
+        stage_latencies = self.record_pipeline_metrics(stage_latencies, outputs)
+
+        db_id = get_db_id(outputs)
+        schema_text = outputs["schema"]
+        demonstrations_text = outputs["demonstrations"]
+        generation = outputs["generation"]
+        correction = outputs["correction"] or {}
+        prompt_text = generation["prompt_text"]
+        prompt_result = generation["prompt_result"]
+        correction_prompt_text = correction.get("correction_prompt_text")
+        corrected_result = correction.get("corrected_result")
+        sql_result = outputs["execution"]
         res = {
             "question": question,
             "db_id": db_id,
@@ -171,11 +638,23 @@ class AgentCenter():
             "demonstration_text": demonstrations_text,
             "prompt_construction_agent_prompt": prompt_text,
             "prompt_construction_agent_query": prompt_result,
+            "prompt_stats": generation["prompt_stats"],
             "error_correction_agent_prompt": correction_prompt_text,
             "error_correction_agent_query": corrected_result,
-            "generated_sql_for_exec": generated_sql_for_exec,
-            "generated_sql_exec_res": sql_result
+            "correction_reason": correction.get("correction_reason"),
+            "candidate_sqls": generation["candidate_sqls"],
+            "num_valid_candidates": generation["num_valid_candidates"],
+            "generated_sql_for_exec": get_generated_sql_for_exec(outputs),
+            "generated_sql_exec_res": sql_result,
+            "stage_latencies": stage_latencies,
         }
+        if flag_return_metrics:
+            res["metrics"] = {
+                "stage_latencies": stage_latencies,
+                "usage": (generation["prompt_stats"] or {}).get("usage"),
+                "num_shared_prefix_tokens": (generation["prompt_stats"] or {}).get("num_shared_prefix_tokens"),
+                "cache_hit_rates": get_cache_hit_rates(),
+            }
         logger.debug(f"Pipeline run successfully. Results:")
         logger.debug(f"Question: {question}")
         logger.debug(f"DB ID: {db_id}")
@@ -0,0 +1,120 @@
+"""
+Throughput of the batch endpoints (/run-pipeline-batch, /execute-sql-batch, /execute-database-routing-agent-batch, /retrieve-gold-sql-batch)
+against the same requests sent one by one to the per-item endpoints with bounded concurrency, meant to be run against the OpenAI stub server.
+
+Example:
+    python -m demo_paper.backend.openai_stub_server --port 8001
+    INDEED_OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=stub uvicorn demo_paper.backend.main:app --port 8000
+    python -m demo_paper.backend.benchmarks.batch_endpoint_benchmark --num_requests 128 --batch_size 32 --concurrency 8
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import httpx
+
+from .load_test import load_questions, get_pipeline_payload, run_load_test, summarize_latencies, get_client
+
+## per-item endpoint -> (batch endpoint, field of the batch request holding the items)
+ENDPOINT2BATCH_ENDPOINT = {
+    "/run-pipeline": ("/run-pipeline-batch", "requests"),
+    "/execute-sql": ("/execute-sql-batch", "requests"),
+    "/execute-database-routing-agent": ("/execute-database-routing-agent-batch", "questions"),
+    "/retrieve-gold-sql": ("/retrieve-gold-sql-batch", "questions"),
+}
+
+
+def get_payloads(endpoint:str, questions:list, args):
+    """Per-item payloads of the endpoint, the batch endpoints receive the same items in chunks of args.batch_size.
+    """
+    if endpoint == "/run-pipeline":
+        return [get_pipeline_payload(question, db_id, args) for question, db_id in questions]
+    if endpoint == "/execute-sql":
+        return [{"sql_query": "SELECT count(*) FROM singer", "db_id": "concert_singer"} for _ in questions]
+    return [{"question": question} for question, _ in questions]
+
+
+async def run_batch_test(client:httpx.AsyncClient, endpoint:str, payloads:list, batch_size:int, concurrency:int):
+    """Send the payloads in batches, the latency of each batch is counted once per item so the throughput is comparable with run_load_test.
+    """
+    batch_endpoint, field_name = ENDPOINT2BATCH_ENDPOINT[endpoint]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    num_errors = 0
+
+    async def send(batch_payloads:list):
+        nonlocal num_errors
+        items = [x["question"] for x in batch_payloads] if field_name == "questions" else batch_payloads
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                response = await client.post(batch_endpoint, json={field_name: items})
+                if response.status_code != 200:
+                    num_errors += len(batch_payloads)
+                    return
+                num_item_errors = response.json()["num_errors"]
+                num_errors += num_item_errors
+                latencies.extend([time.perf_counter() - start_time] * (len(batch_payloads) - num_item_errors))
+            except httpx.HTTPError as e:
+                print(f"Request failed: {e}")
+                num_errors += len(batch_payloads)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[send(payloads[i:i + batch_size]) for i in range(0, len(payloads), batch_size)])
+    return summarize_latencies(latencies, time.perf_counter() - start_time, num_errors)
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    all_questions = load_questions(args.dev_file_path)
+    questions = [rng.choice(all_questions) for _ in range(args.num_requests)]
+    results = []
+    async with get_client(args) as client:
+        for endpoint in args.endpoints:
+            payloads = get_payloads(endpoint, questions, args)
+            ## warm-up, loads the agents used by the endpoint
+            await run_load_test(client, payloads[:2], 1, endpoint=endpoint)
+            per_item_summary = await run_load_test(client, payloads, args.concurrency, endpoint=endpoint)
+            batch_summary = await run_batch_test(client, endpoint, payloads, args.batch_size, max(1, args.concurrency // args.batch_size))
+            result = {
+                "endpoint": endpoint,
+                "batch_size": args.batch_size,
+                "per_item": per_item_summary,
+                "batch": batch_summary,
+                "speedup": batch_summary["throughput"] / per_item_summary["throughput"] if per_item_summary["throughput"] else None,
+            }
+            results.append(result)
+            print(json.dumps(result, indent=4))
+    if args.output_file_path:
+        with open(args.output_file_path, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the batch endpoints against the per-item endpoints")
+    parser.add_argument("--base_url", type=str, default="http://localhost:8000")
+    parser.add_argument("--in_process", action="store_true", help="drive the FastAPI app in this process instead of a running server")
+    parser.add_argument("--endpoints", type=str, nargs="+", default=list(ENDPOINT2BATCH_ENDPOINT), choices=list(ENDPOINT2BATCH_ENDPOINT))
+    parser.add_argument("--dev_file_path", type=str, default="./datasets/spider/dev.json")
+    parser.add_argument("--num_requests", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent per-item requests, the batch requests get concurrency // batch_size (at least 1)")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--model", type=str, default="gpt-4")
+    parser.add_argument("--num_demonstrations", type=int, default=5)
+    parser.add_argument("--flag_use_database_routing_agent", action="store_true")
+    parser.add_argument("--flag_use_demonstration_selection_agent", action="store_true")
+    parser.add_argument("--flag_use_error_correction_agent", action="store_true")
+    parser.add_argument("--flag_use_sql_execution_agent", action="store_true")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output_file_path", type=str, default=None)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
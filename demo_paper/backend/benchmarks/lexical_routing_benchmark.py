@@ -0,0 +1,83 @@
+"""
+Accuracy and latency of the database routing on the Spider dev split in the lexical (BM25 only), model (DistilBERT only)
+and cascade (BM25, DistilBERT when the BM25 margin is below the threshold) modes, for several margin thresholds.
+The BM25 index is built from tables.json and the training questions, so the dev questions are not indexed.
+
+Example:
+    python -m demo_paper.backend.benchmarks.lexical_routing_benchmark --margin_thresholds 0.1 0.2 0.3 0.5
+"""
+
+import os
+import json
+import time
+import argparse
+
+from agents.database_routing_agent import DatabaseRoutingAgent
+from utils.database_routing_utils import ROUTING_BACKENDS
+from utils.lexical_routing_utils import LexicalRouter
+from utils.resource_registry import get_resource_registry
+from .load_test import load_questions, get_percentile
+
+
+def evaluate_mode(agent:DatabaseRoutingAgent, routing_mode:str, margin_threshold:float, questions:list, gold_db_ids:list):
+    agent.routing_mode = routing_mode
+    agent.lexical_margin_threshold = margin_threshold
+    latencies = []
+    num_correct = 0
+    num_lexical = 0
+    for question, gold_db_id in zip(questions, gold_db_ids):
+        start_time = time.perf_counter()
+        db_id = agent.predict_with_lexical_router(question) if routing_mode != 'model' else None
+        if db_id is not None or routing_mode == 'lexical':
+            num_lexical += 1
+        else:
+            db_id = agent.predict_with_model(question)
+        latencies.append(time.perf_counter() - start_time)
+        num_correct += db_id == gold_db_id
+    latencies.sort()
+    return {
+        "routing_mode": routing_mode,
+        "margin_threshold": margin_threshold if routing_mode == 'cascade' else None,
+        "accuracy": num_correct / len(questions),
+        "lexical_ratio": num_lexical / len(questions),
+        "avg_latency": sum(latencies) / len(latencies),
+        "p50_latency": get_percentile(latencies, 50),
+        "p95_latency": get_percentile(latencies, 95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy and latency of the lexical, model and cascaded database routing")
+    parser.add_argument("--model_path", type=str, default="./database_routing/saved_models/database_routing_spider_v1")
+    parser.add_argument("--dataset_dir_path", type=str, default="./datasets/spider")
+    parser.add_argument("--backend", type=str, default="torch", choices=ROUTING_BACKENDS)
+    parser.add_argument("--margin_thresholds", type=float, nargs="+", default=[0.1, 0.2, 0.3, 0.5])
+    parser.add_argument("--k1", type=float, default=1.2)
+    parser.add_argument("--b", type=float, default=0.75)
+    parser.add_argument("--output_file_path", type=str, default=None)
+    args = parser.parse_args()
+
+    dev_file_path = os.path.join(args.dataset_dir_path, "dev.json")
+    if not os.path.exists(dev_file_path):
+        raise FileNotFoundError(f"Spider dev split not found at {dev_file_path}")
+    questions, gold_db_ids = zip(*load_questions(dev_file_path))
+
+    start_time = time.perf_counter()
+    dataset = get_resource_registry().get_dataset('spider', args.dataset_dir_path)
+    lexical_router = LexicalRouter.from_dataset(dataset, k1=args.k1, b=args.b)
+    print(f"Built the BM25 index of {len(lexical_router.db_ids)} databases in {time.perf_counter() - start_time:.2f} seconds")
+    agent = DatabaseRoutingAgent(model_path=args.model_path, backend=args.backend, routing_mode='cascade', lexical_router=lexical_router)
+    agent.predict_with_model(questions[0]) ## warm-up
+
+    results = [evaluate_mode(agent, 'lexical', 0.0, questions, gold_db_ids), evaluate_mode(agent, 'model', 0.0, questions, gold_db_ids)]
+    for margin_threshold in args.margin_thresholds:
+        results.append(evaluate_mode(agent, 'cascade', margin_threshold, questions, gold_db_ids))
+    for result in results:
+        print(json.dumps(result))
+    if args.output_file_path:
+        with open(args.output_file_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Load test harness for the FastAPI backend, meant to be run against the OpenAI stub server (see openai_stub_server.py).
+Sends /run-pipeline requests with bounded concurrency and reports p50/p95/p99 latency and throughput.
+
+Example:
+    python -m demo_paper.backend.openai_stub_server --port 8001 --latency_distribution lognormal --latency_mean_ms 800
+    INDEED_OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=stub uvicorn demo_paper.backend.main:app --port 8000
+    python -m demo_paper.backend.benchmarks.load_test --base_url http://localhost:8000 --num_requests 200 --concurrency 16
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import httpx
+
+DEFAULT_QUESTIONS = [
+    ("How many singers do we have?", "concert_singer"),
+    ("What is the average, minimum, and maximum age of all singers from France?", "concert_singer"),
+    ("How many pets are owned by students that have an age greater than 20?", "pets_1"),
+    ("What are the names of the countries that became independent after 1950?", "world_1"),
+]
+
+
+def get_percentile(sorted_values:list, percentile:float):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(percentile / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def summarize_latencies(latencies:list, elapsed_time:float, num_errors:int):
+    sorted_latencies = sorted(latencies)
+    num_requests = len(latencies) + num_errors
+    return {
+        "num_requests": num_requests,
+        "num_success": len(latencies),
+        "num_errors": num_errors,
+        "elapsed_time": elapsed_time,
+        "throughput": num_requests / elapsed_time if elapsed_time > 0 else None,
+        "p50_latency": get_percentile(sorted_latencies, 50),
+        "p95_latency": get_percentile(sorted_latencies, 95),
+        "p99_latency": get_percentile(sorted_latencies, 99),
+        "max_latency": sorted_latencies[-1] if sorted_latencies else None,
+    }
+
+
+def load_questions(dev_file_path:str=None):
+    """Load (question, db_id) pairs from the Spider dev split if available, otherwise use a few built-in questions.
+    """
+    if dev_file_path and os.path.exists(dev_file_path):
+        with open(dev_file_path, 'r') as f:
+            records = json.load(f)
+        return [(x['question'], x['db_id']) for x in records]
+    return DEFAULT_QUESTIONS
+
+
+def get_pipeline_payload(question:str, db_id:str, args):
+    return {
+        "question": question,
+        "flag_use_database_routing_agent": args.flag_use_database_routing_agent,
+        "db_id": db_id,
+        "flag_use_demonstration_selection_agent": args.flag_use_demonstration_selection_agent,
+        "num_demonstrations": args.num_demonstrations,
+        "prompt_template": "option_1",
+        "model": args.model,
+        "flag_use_error_correction_agent": args.flag_use_error_correction_agent,
+        "flag_use_sql_execution_agent": args.flag_use_sql_execution_agent,
+    }
+
+
+async def run_load_test(client:httpx.AsyncClient, payloads:list, concurrency:int, endpoint:str="/run-pipeline"):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    num_errors = 0
+
+    async def send(payload:dict):
+        nonlocal num_errors
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                response = await client.post(endpoint, json=payload)
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - start_time)
+                else:
+                    num_errors += 1
+            except httpx.HTTPError as e:
+                print(f"Request failed: {e}")
+                num_errors += 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[send(x) for x in payloads])
+    return summarize_latencies(latencies, time.perf_counter() - start_time, num_errors)
+
+
+def get_client(args):
+    timeout = httpx.Timeout(args.timeout)
+    if args.in_process:
+        ## drive the app in this process, the agents are initialized on import
+        from demo_paper.backend.main import app
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver", timeout=timeout)
+    return httpx.AsyncClient(base_url=args.base_url, timeout=timeout)
+
+
+async def main_async(args):
+    questions = load_questions(args.dev_file_path)
+    rng = random.Random(args.seed)
+    payloads = [get_pipeline_payload(*rng.choice(questions), args) for _ in range(args.num_requests)]
+    async with get_client(args) as client:
+        if args.num_warmup_requests:
+            await run_load_test(client, payloads[:args.num_warmup_requests], args.concurrency)
+        summary = await run_load_test(client, payloads, args.concurrency)
+    print(json.dumps(summary, indent=4))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the /run-pipeline endpoint")
+    parser.add_argument("--base_url", type=str, default="http://localhost:8000")
+    parser.add_argument("--in_process", action="store_true", help="drive the FastAPI app in this process instead of a running server")
+    parser.add_argument("--dev_file_path", type=str, default="./datasets/spider/dev.json")
+    parser.add_argument("--num_requests", type=int, default=100)
+    parser.add_argument("--num_warmup_requests", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--model", type=str, default="gpt-4")
+    parser.add_argument("--num_demonstrations", type=int, default=5)
+    parser.add_argument("--flag_use_database_routing_agent", action="store_true")
+    parser.add_argument("--flag_use_demonstration_selection_agent", action="store_true")
+    parser.add_argument("--flag_use_error_correction_agent", action="store_true")
+    parser.add_argument("--flag_use_sql_execution_agent", action="store_true")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+In-process benchmark of the micro-batching of the DistilBERT forward passes (database routing and gold SQL retrieval):
+throughput and p50/p95 latency of concurrent calls with a batch size of 1 (one forward pass per request, the previous behavior)
+and with larger batch sizes and wait times.
+
+Example:
+    python -m demo_paper.backend.benchmarks.micro_batching_benchmark --targets routing retrieval --batch_sizes 1 8 16 --concurrency 32
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from utils.micro_batcher import MicroBatcher
+from .load_test import load_questions, summarize_latencies
+
+
+def get_targets(target_names:list):
+    """Blocking batch function of each target, the models are loaded once and shared by all configurations.
+    The routing and embedding caches are disabled, the same questions are sent to every configuration.
+    """
+    from demo_paper.backend.main import agent_center, get_gold_sql_retrieval
+    target2batch_func = {}
+    if 'routing' in target_names:
+        target2batch_func['routing'] = agent_center.get_agent('Database Routing Agent').predict_with_model_batch
+    if 'retrieval' in target_names:
+        retrieval = get_gold_sql_retrieval()
+        retrieval.embedding_cache.max_size = 0
+        target2batch_func['retrieval'] = retrieval.get_most_similar_sqls
+    return target2batch_func
+
+
+async def run_config(batch_func, questions:list, concurrency:int, max_batch_size:int, max_wait_ms:float):
+    batcher = MicroBatcher(batch_func, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, name='benchmark')
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def send(question:str):
+        async with semaphore:
+            start_time = time.perf_counter()
+            await batcher.submit(question)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[send(x) for x in questions])
+    summary = summarize_latencies(latencies, time.perf_counter() - start_time, 0)
+    summary.update(batcher.get_stats())
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of the routing and retrieval models with micro-batching")
+    parser.add_argument("--targets", type=str, nargs="+", default=["routing", "retrieval"], choices=["routing", "retrieval"])
+    parser.add_argument("--dev_file_path", type=str, default="./datasets/spider/dev.json")
+    parser.add_argument("--num_requests", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 16, 32])
+    parser.add_argument("--max_wait_ms", type=float, nargs="+", default=[2.0, 5.0])
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output_file_path", type=str, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    questions = [rng.choice(load_questions(args.dev_file_path))[0] for _ in range(args.num_requests)]
+    results = []
+    for target, batch_func in get_targets(args.targets).items():
+        ## warm-up, the first forward passes are slower
+        batch_func(questions[:8])
+        for max_batch_size in args.batch_sizes:
+            for max_wait_ms in (args.max_wait_ms if max_batch_size > 1 else [0.0]):
+                summary = asyncio.run(run_config(batch_func, questions, args.concurrency, max_batch_size, max_wait_ms))
+                summary["target"] = target
+                results.append(summary)
+                print(json.dumps(summary))
+    if args.output_file_path:
+        with open(args.output_file_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Memory benchmark of the backend under gunicorn with several uvicorn workers: RSS and PSS of the master and of each worker,
+with the models loaded in every worker (default) and loaded once in the master before fork (MAGESQL_PREFORK=1, see gunicorn_conf.py).
+PSS splits the shared pages between the processes, so the PSS sum is the actual memory of the server, while the RSS of a worker counts the shared pages in full.
+The memory is read from /proc/<pid>/smaps_rollup (Linux only) after warm-up requests have loaded the models in the workers.
+
+Example:
+    python -m demo_paper.backend.benchmarks.prefork_memory_benchmark --modes per_worker prefork --num_workers 4 --port 8011
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import httpx
+
+from .startup_benchmark import wait_for_health
+
+MODE2ENV = {
+    "per_worker": {"MAGESQL_PREFORK": "0", "MAGESQL_WARMUP": "all"},
+    "prefork": {"MAGESQL_PREFORK": "1"},
+}
+
+## requests that touch the routing model, the demonstrations and the gold SQL retrieval
+WARMUP_REQUESTS = [
+    ("/execute-database-routing-agent", {"question": "How many singers do we have?"}),
+    ("/execute-demonstration-selection-agent", {"question": "How many singers do we have?", "num_demonstrations": 5}),
+    ("/retrieve-gold-sql", {"question": "How many singers do we have?"}),
+]
+
+
+def get_memory_usage(pid:int):
+    """RSS, PSS and private memory of a process in MB.
+    """
+    key2kb = {}
+    with open(f"/proc/{pid}/smaps_rollup", 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                key2kb[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        "rss_mb": key2kb.get("Rss", 0) / 1024,
+        "pss_mb": key2kb.get("Pss", 0) / 1024,
+        "private_mb": (key2kb.get("Private_Clean", 0) + key2kb.get("Private_Dirty", 0)) / 1024,
+    }
+
+
+def get_child_pids(pid:int):
+    with open(f"/proc/{pid}/task/{pid}/children", 'r') as f:
+        return [int(x) for x in f.read().split()]
+
+
+def wait_for_workers(pid:int, num_workers:int, timeout:float):
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < timeout:
+        child_pids = get_child_pids(pid)
+        if len(child_pids) >= num_workers:
+            return child_pids
+        time.sleep(0.1)
+    raise TimeoutError(f"{num_workers} workers not started after {timeout} seconds")
+
+
+def run_mode(mode:str, args):
+    env = dict(os.environ)
+    env.update(MODE2ENV[mode])
+    env.update({"MAGESQL_WORKERS": str(args.num_workers), "MAGESQL_BIND": f"127.0.0.1:{args.port}"})
+    if args.torch_threads:
+        env["MAGESQL_TORCH_THREADS"] = str(args.torch_threads)
+    command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(os.path.dirname(__file__), "..", "gunicorn_conf.py")]
+    base_url = f"http://127.0.0.1:{args.port}"
+    process = subprocess.Popen(command, env=env)
+    result = {"mode": mode, "num_workers": args.num_workers}
+    try:
+        result["time_to_healthy"] = wait_for_health(base_url, args.timeout, process)
+        worker_pids = wait_for_workers(process.pid, args.num_workers, args.timeout)
+        with httpx.Client(base_url=base_url, timeout=args.timeout) as client:
+            ## requests are spread over the workers by the kernel, send enough of them to reach every worker
+            for _ in range(args.num_warmup_rounds * args.num_workers):
+                for endpoint, payload in WARMUP_REQUESTS:
+                    client.post(endpoint, json=payload)
+            result["health"] = client.get("/health").json()
+        result["master"] = get_memory_usage(process.pid)
+        result["workers"] = [get_memory_usage(pid) for pid in worker_pids]
+        result["avg_worker_rss_mb"] = sum(x["rss_mb"] for x in result["workers"]) / len(worker_pids)
+        result["avg_worker_private_mb"] = sum(x["private_mb"] for x in result["workers"]) / len(worker_pids)
+        result["total_pss_mb"] = result["master"]["pss_mb"] + sum(x["pss_mb"] for x in result["workers"])
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RSS/PSS per worker of the backend with and without loading the models before fork")
+    parser.add_argument("--modes", type=str, nargs="+", default=["per_worker", "prefork"], choices=list(MODE2ENV))
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--num_warmup_rounds", type=int, default=3)
+    parser.add_argument("--torch_threads", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--output_file_path", type=str, default=None)
+    args = parser.parse_args()
+
+    results = [run_mode(mode, args) for mode in args.modes]
+    print(json.dumps(results, indent=4))
+    if args.output_file_path:
+        with open(args.output_file_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Accuracy vs latency of the inference backends of the database routing classifier (torch, onnxruntime with int8 dynamic quantization,
+torch int8 dynamic quantization) on the Spider dev split: routing accuracy, agreement with the full precision torch predictions,
+p50/p95 latency of single questions and throughput of batched questions.
+The ONNX model is exported (and quantized) to <model_path>/onnx on the first run, --flag_export_only only runs this step.
+
+Example:
+    python -m demo_paper.backend.benchmarks.routing_backend_benchmark --backends torch onnxruntime torch_dynamic_quant --num_threads 4
+"""
+
+import os
+import json
+import time
+import argparse
+
+from agents.database_routing_agent import DatabaseRoutingAgent
+from utils.database_routing_utils import ROUTING_BACKENDS, prepare_onnx_model
+from .load_test import load_questions, get_percentile
+
+
+def evaluate_backend(backend:str, questions:list, gold_db_ids:list, args):
+    agent = DatabaseRoutingAgent(model_path=args.model_path, backend=backend, num_threads=args.num_threads, flag_quantized=not args.flag_onnx_fp32, routing_cache_size=0)
+    agent.run_batch(questions[:args.batch_size]) ## warm-up
+
+    start_time = time.perf_counter()
+    predicted_db_ids = []
+    for i in range(0, len(questions), args.batch_size):
+        predicted_db_ids.extend(agent.run_batch(questions[i:i + args.batch_size]))
+    batch_elapsed_time = time.perf_counter() - start_time
+
+    latencies = []
+    for question in questions[:args.num_latency_questions]:
+        start_time = time.perf_counter()
+        agent.run(question)
+        latencies.append(time.perf_counter() - start_time)
+    latencies.sort()
+
+    return predicted_db_ids, {
+        "backend": backend,
+        "accuracy": sum(x == y for x, y in zip(predicted_db_ids, gold_db_ids)) / len(gold_db_ids),
+        "p50_latency": get_percentile(latencies, 50),
+        "p95_latency": get_percentile(latencies, 95),
+        "batch_size": args.batch_size,
+        "throughput": len(questions) / batch_elapsed_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy and latency of the database routing backends on the Spider dev split")
+    parser.add_argument("--model_path", type=str, default="./database_routing/saved_models/database_routing_spider_v1")
+    parser.add_argument("--dev_file_path", type=str, default="./datasets/spider/dev.json")
+    parser.add_argument("--backends", type=str, nargs="+", default=ROUTING_BACKENDS, choices=ROUTING_BACKENDS)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_latency_questions", type=int, default=200)
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads of onnxruntime (torch uses torch.set_num_threads)")
+    parser.add_argument("--flag_onnx_fp32", action="store_true", help="run the exported ONNX model without quantization")
+    parser.add_argument("--flag_export_only", action="store_true")
+    parser.add_argument("--output_file_path", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.flag_export_only:
+        prepare_onnx_model(args.model_path, flag_quantized=not args.flag_onnx_fp32, flag_overwrite=True)
+        return
+    if args.num_threads:
+        import torch
+        torch.set_num_threads(args.num_threads)
+    if not os.path.exists(args.dev_file_path):
+        raise FileNotFoundError(f"Spider dev split not found at {args.dev_file_path}")
+
+    questions, gold_db_ids = zip(*load_questions(args.dev_file_path))
+    questions, gold_db_ids = list(questions), list(gold_db_ids)
+    results = []
+    reference_db_ids = None
+    for backend in args.backends:
+        predicted_db_ids, result = evaluate_backend(backend, questions, gold_db_ids, args)
+        if backend == 'torch':
+            reference_db_ids = predicted_db_ids
+        if reference_db_ids is not None:
+            result["agreement_with_torch"] = sum(x == y for x, y in zip(predicted_db_ids, reference_db_ids)) / len(questions)
+        results.append(result)
+        print(json.dumps(result))
+    if args.output_file_path:
+        with open(args.output_file_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Startup benchmark of the FastAPI backend: time until the server answers /health, and the latency of the first (cold) request
+of each endpoint, with lazy agent construction (default) and with eager construction (MAGESQL_EAGER_AGENTS=1, the previous behavior).
+Each mode starts a fresh uvicorn process, the heavy modules (torch, transformers, nltk, pandas) loaded by the process are reported from /health.
+
+Example:
+    python -m demo_paper.backend.benchmarks.startup_benchmark --modes lazy eager --port 8010
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import httpx
+
+MODE2ENV = {
+    "lazy": {"MAGESQL_EAGER_AGENTS": "0"},
+    "eager": {"MAGESQL_EAGER_AGENTS": "1"},
+    "lazy_warmup": {"MAGESQL_EAGER_AGENTS": "0", "MAGESQL_WARMUP": "all"},
+}
+
+## cold requests sent after the server is healthy, in order
+COLD_REQUESTS = [
+    ("fetch_schema", "/fetch-schema", {"db_id": "concert_singer"}),
+    ("sql_execution", "/execute-sql", {"sql_query": "SELECT count(*) FROM singer", "db_id": "concert_singer"}),
+    ("database_routing", "/execute-database-routing-agent", {"question": "How many singers do we have?"}),
+    ("demonstration_selection", "/execute-demonstration-selection-agent", {"question": "How many singers do we have?", "num_demonstrations": 5}),
+]
+
+
+def wait_for_health(base_url:str, timeout:float, process:subprocess.Popen):
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before becoming healthy")
+        try:
+            response = httpx.get(f"{base_url}/health", timeout=1.0)
+            if response.status_code == 200:
+                return time.perf_counter() - start_time
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f"Server not healthy after {timeout} seconds")
+
+
+def run_mode(mode:str, args):
+    env = dict(os.environ)
+    env.update(MODE2ENV[mode])
+    command = [sys.executable, "-m", "uvicorn", "demo_paper.backend.main:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"]
+    base_url = f"http://127.0.0.1:{args.port}"
+    process = subprocess.Popen(command, env=env)
+    result = {"mode": mode}
+    try:
+        result["time_to_healthy"] = wait_for_health(base_url, args.timeout, process)
+        with httpx.Client(base_url=base_url, timeout=args.timeout) as client:
+            result["cold_request_latency"] = {}
+            for name, endpoint, payload in COLD_REQUESTS:
+                start_time = time.perf_counter()
+                response = client.post(endpoint, json=payload)
+                result["cold_request_latency"][name] = {"latency": time.perf_counter() - start_time, "status_code": response.status_code}
+            result["health"] = client.get("/health").json()
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark of the backend with lazy and eager agent construction")
+    parser.add_argument("--modes", type=str, nargs="+", default=["lazy", "eager"], choices=list(MODE2ENV))
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--output_file_path", type=str, default=None)
+    args = parser.parse_args()
+
+    results = [run_mode(mode, args) for mode in args.modes]
+    print(json.dumps(results, indent=4))
+    if args.output_file_path:
+        with open(args.output_file_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Perceived latency of /run-pipeline-stream against /run-pipeline, meant to be run against the OpenAI stub server:
+time to the first event, to the first SQL token and to the final result of the streamed requests, and the latency of /run-pipeline requests.
+The two endpoints get disjoint questions, since the responses of the LLM could be cached by the backend (MAGESQL_LLM_CACHE_PATH).
+Use the Spider dev split so there are enough distinct questions, and leave the LLM response cache disabled or use a fresh file for every run.
+
+Example:
+    python -m demo_paper.backend.openai_stub_server --port 8001 --latency_mean_ms 800 --token_interval_ms 20
+    INDEED_OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=stub uvicorn demo_paper.backend.main:app --port 8000
+    python -m demo_paper.backend.benchmarks.streaming_benchmark --num_requests 50 --concurrency 4
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import httpx
+
+from .load_test import load_questions, get_pipeline_payload, run_load_test, get_percentile, get_client
+
+
+async def run_stream_test(client:httpx.AsyncClient, payloads:list, concurrency:int):
+    semaphore = asyncio.Semaphore(concurrency)
+    name2latencies = {"first_event_latency": [], "first_token_latency": [], "result_latency": []}
+    num_errors = 0
+
+    async def send(payload:dict):
+        nonlocal num_errors
+        async with semaphore:
+            start_time = time.perf_counter()
+            name2latency = {}
+            try:
+                async with client.stream("POST", "/run-pipeline-stream", json=payload) as response:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("event: "):
+                            continue
+                        event_name = line[len("event: "):]
+                        latency = time.perf_counter() - start_time
+                        name2latency.setdefault("first_event_latency", latency)
+                        if event_name == "sql_token":
+                            name2latency.setdefault("first_token_latency", latency)
+                        elif event_name == "result":
+                            name2latency["result_latency"] = latency
+                        elif event_name == "error":
+                            num_errors += 1
+            except httpx.HTTPError as e:
+                print(f"Request failed: {e}")
+                num_errors += 1
+            for name, latency in name2latency.items():
+                name2latencies[name].append(latency)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[send(x) for x in payloads])
+    summary = {"num_requests": len(payloads), "num_errors": num_errors, "elapsed_time": time.perf_counter() - start_time}
+    for name, latencies in name2latencies.items():
+        latencies.sort()
+        summary[f"p50_{name}"] = get_percentile(latencies, 50)
+        summary[f"p95_{name}"] = get_percentile(latencies, 95)
+    return summary
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    questions = load_questions(args.dev_file_path)
+    questions = rng.sample(questions, min(len(questions), 2 * args.num_requests + 1))
+    payloads = [get_pipeline_payload(question, db_id, args) for question, db_id in questions]
+    num_requests = (len(payloads) - 1) // 2
+    async with get_client(args) as client:
+        ## warm-up, loads the agents
+        await run_load_test(client, payloads[-1:], 1)
+        results = {
+            "run_pipeline": await run_load_test(client, payloads[:num_requests], args.concurrency),
+            "run_pipeline_stream": await run_stream_test(client, payloads[num_requests:2 * num_requests], args.concurrency),
+        }
+    print(json.dumps(results, indent=4))
+    if args.output_file_path:
+        with open(args.output_file_path, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first event and to the result of /run-pipeline-stream against /run-pipeline")
+    parser.add_argument("--base_url", type=str, default="http://localhost:8000")
+    parser.add_argument("--in_process", action="store_true", help="drive the FastAPI app in this process instead of a running server")
+    parser.add_argument("--dev_file_path", type=str, default="./datasets/spider/dev.json")
+    parser.add_argument("--num_requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--model", type=str, default="gpt-4")
+    parser.add_argument("--num_demonstrations", type=int, default=5)
+    parser.add_argument("--flag_use_database_routing_agent", action="store_true")
+    parser.add_argument("--flag_use_demonstration_selection_agent", action="store_true")
+    parser.add_argument("--flag_use_error_correction_agent", action="store_true")
+    parser.add_argument("--flag_use_sql_execution_agent", action="store_true")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output_file_path", type=str, default=None)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
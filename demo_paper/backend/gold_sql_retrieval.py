@@ -3,25 +3,35 @@ import os
 from pathlib import Path
 
 from tqdm import tqdm
-import torch
-import torch.nn.functional as F
-from transformers import DistilBertTokenizer, DistilBertModel
 from dataset_classes.spider_dataset import SpiderDataset
+from utils.micro_batcher import MicroBatcher
+from utils.cache_utils import LRUCache, EmbeddingStore, normalize_question
+
+## torch and transformers are imported when the retrieval is constructed, so that importing this module (e.g. by main.py) stays cheap
 
 class GoldSQLRetrieval():
     def __init__(self, dataset_dir_path: str = None, **kwargs):
         if not dataset_dir_path:
             dataset_dir_path = "./datasets/spider"
+        import torch
+        from transformers import DistilBertTokenizer, DistilBertModel
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        ## the dataset, tokenizer and model are shared with the agents of the process if a resource registry is given
+        self.resource_registry = kwargs.get('resource_registry', None)
         
         # Load DistilBERT tokenizer and model
-        self.tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
-        self.model = DistilBertModel.from_pretrained('distilbert-base-uncased').to(self.device)
-        self.model.eval()
+        self.encoder_model_id = 'distilbert-base-uncased'
+        if self.resource_registry is not None:
+            self.tokenizer = self.resource_registry.get_tokenizer(self.encoder_model_id)
+            self.model = self.resource_registry.get_encoder_model(self.encoder_model_id, device=self.device)
+        else:
+            self.tokenizer = DistilBertTokenizer.from_pretrained(self.encoder_model_id)
+            self.model = DistilBertModel.from_pretrained(self.encoder_model_id).to(self.device)
+            self.model.eval()
 
         print("Loading question-SQL pairs...")
         # Load cached question-SQL pairs if available
-        if 'pairs_cache_path' in kwargs and kwargs['pairs_cache_path']:
+        if 'pairs_cache_path' in kwargs and kwargs['pairs_cache_path'] and os.path.exists(kwargs['pairs_cache_path']):
             self.question2sql = self.load_pairs_cache(kwargs['pairs_cache_path'])
         else:
             self.question2sql = self.load_gold_sql_from_dataset(dataset_dir_path)
@@ -34,18 +44,83 @@ class GoldSQLRetrieval():
         print(f"Loaded {len(self.question2sql)} question to gold SQL query pairs")
         
         print("Encoding questions...")
-        # Load cached question embeddings if available
+        self.questions = list(self.question2sql.keys())
+        flag_mmap = kwargs.get('flag_mmap_embeddings', False)
         if 'embeddings_cache_path' in kwargs and kwargs['embeddings_cache_path']:
-            self.question_embeddings = torch.load(kwargs['embeddings_cache_path'])
+            ## explicit embeddings file, trusted as is
+            self.question_embeddings = self.load_embeddings(kwargs['embeddings_cache_path'], flag_mmap=flag_mmap)
         else:
-            self.question_embeddings = self.encode_questions(list(self.question2sql.keys()), batch_size=32)
-            # save the embeddings cache
-            embeddings_cache_path = os.path.join(dataset_dir_path, 'question_embeddings.pt')
-            torch.save(self.question_embeddings, embeddings_cache_path)
-            print(f"Saved question embeddings cache to {embeddings_cache_path}")
+            ## content-addressed store: reused only for the same encoder and question list, only new questions are encoded
+            embedding_store = EmbeddingStore(kwargs.get('embedding_store_dir') or os.path.join(dataset_dir_path, 'question_embeddings'), self.encoder_model_id)
+            embeddings = embedding_store.get_or_encode(
+                self.questions,
+                lambda questions: self.encode_questions(questions, batch_size=32).cpu().numpy(),
+                flag_mmap=flag_mmap
+            )
+            self.question_embeddings = self.numpy_to_tensor(embeddings)
         print(f"Encoded {len(self.question_embeddings)} questions")
+        ## norms of the question embeddings for the batched cosine similarity, computed on first use
+        self.question_embedding_norms = None
+
+        ## concurrent get_most_similar_sql_async calls are encoded together, see MicroBatcher
+        self.micro_batcher = MicroBatcher(
+            self.get_most_similar_sqls,
+            max_batch_size=kwargs.get('max_batch_size', 16),
+            max_wait_ms=kwargs.get('max_wait_ms', 5.0),
+            name='gold_sql_retrieval'
+        )
+
+        ## embeddings of the input questions keyed by the normalized question, in the namespace of the encoder model, a size of 0 disables it
+        self.embedding_cache = LRUCache(
+            'question_embedding',
+            max_size=kwargs.get('embedding_cache_size', 4096),
+            namespace=self.encoder_model_id,
+            persistent_path=kwargs.get('embedding_cache_path', None),
+            serialize=self.serialize_embedding,
+            deserialize=self.deserialize_embedding
+        )
         
 
+    def load_embeddings(self, embeddings_cache_path: str, flag_mmap: bool = False):
+        """
+        Load the question embeddings from a .pt (torch.save) or .npy file.
+        With flag_mmap, the file is memory-mapped read-only instead of read into private memory, so the pages are shared by all worker processes through the page cache.
+        """
+        import torch
+        if embeddings_cache_path.endswith('.npy'):
+            import numpy as np
+            return self.numpy_to_tensor(np.load(embeddings_cache_path, mmap_mode='r' if flag_mmap else None))
+        if flag_mmap:
+            try:
+                return torch.load(embeddings_cache_path, mmap=True)
+            except (TypeError, RuntimeError) as e:
+                ## torch < 2.1 or a file saved in the legacy format
+                print(f"Cannot memory-map {embeddings_cache_path} ({e}), loading it into memory")
+        return torch.load(embeddings_cache_path)
+
+    def numpy_to_tensor(self, embeddings):
+        """
+        Tensor sharing the memory of the array (no copy on CPU), a memory-mapped array stays mapped.
+        """
+        import torch
+        import warnings
+        with warnings.catch_warnings():
+            ## the tensor of a read-only memory-mapped array is not writable, torch warns about it, the embeddings are never modified
+            warnings.simplefilter("ignore", UserWarning)
+            return torch.from_numpy(embeddings).to(self.device)
+
+    def save_embeddings(self, embeddings_cache_path: str):
+        """
+        Save the question embeddings as .npy (memory-mappable, see load_embeddings) or with torch.save.
+        """
+        import torch
+        if embeddings_cache_path.endswith('.npy'):
+            import numpy as np
+            np.save(embeddings_cache_path, self.question_embeddings.detach().cpu().numpy())
+        else:
+            torch.save(self.question_embeddings, embeddings_cache_path)
+        print(f"Saved question embeddings cache to {embeddings_cache_path}")
+
     def load_pairs_cache(self, cache_path: str):
         with open(cache_path, 'r') as f:
             question2sql = json.load(f)
@@ -56,19 +131,23 @@ class GoldSQLRetrieval():
         Load the Spider dataset and map questions to their gold SQL queries.
         """
         question2sql = {}
-        dataset = SpiderDataset(dataset_dir_path)
+        if self.resource_registry is not None:
+            dataset = self.resource_registry.get_dataset('spider', dataset_dir_path)
+        else:
+            dataset = SpiderDataset(dataset_dir_path)
         for split_name in ['train', 'dev', 'test']:
             for record in dataset.data[split_name]:
                 question2sql[record['question']] = record['query']
         return question2sql
 
-    def encode_questions(self, questions: list, batch_size: int = 32):
+    def encode_questions(self, questions: list, batch_size: int = 32, flag_show_progress: bool = True):
         """
         Encode all the questions in the dataset using DistilBERT in batches.
         """
+        import torch
         encodings = []
         with torch.no_grad():
-            for i in tqdm(range(0, len(questions), batch_size)):
+            for i in tqdm(range(0, len(questions), batch_size), disable=not flag_show_progress):
                 batch = questions[i:i + batch_size]
                 inputs = self.tokenizer(batch, return_tensors='pt', padding=True, truncation=True, max_length=128).to(self.device)
                 outputs = self.model(**inputs)
@@ -84,6 +163,7 @@ class GoldSQLRetrieval():
         """
         Encode a single input question using DistilBERT.
         """
+        import torch
         with torch.no_grad():
             inputs = self.tokenizer(question, return_tensors='pt', padding=True, truncation=True, max_length=128).to(self.device)
             outputs = self.model(**inputs)
@@ -91,13 +171,39 @@ class GoldSQLRetrieval():
             cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding.squeeze(0)
 
+    def serialize_embedding(self, embedding):
+        return embedding.detach().cpu().numpy().astype('float32').tobytes()
+
+    def deserialize_embedding(self, value: bytes):
+        import torch
+        import numpy as np
+        return torch.from_numpy(np.frombuffer(value, dtype='float32').copy()).to(self.device)
+
+    def encode_questions_cached(self, questions: list):
+        """
+        Embeddings of the input questions, the ones not in the embedding cache are encoded in one padded forward pass.
+        """
+        import torch
+        cache_keys = [normalize_question(x) for x in questions]
+        embeddings = [self.embedding_cache.get(x) for x in cache_keys]
+        missing_indices = [i for i, x in enumerate(embeddings) if x is None]
+        if missing_indices:
+            encoded_questions = self.encode_questions([questions[i] for i in missing_indices], batch_size=len(missing_indices), flag_show_progress=False)
+            for i, embedding in zip(missing_indices, encoded_questions):
+                ## clone so that the cached row does not keep the whole batch tensor alive
+                embeddings[i] = embedding.clone()
+                self.embedding_cache.set(cache_keys[i], embeddings[i])
+        return torch.stack(embeddings)
+
     def get_most_similar_sql(self, question: str):
         """
         Given a question, find the most similar question in the dataset based on cosine similarity of the embeddings,
         and return the corresponding SQL query.
         """
+        import torch
+        import torch.nn.functional as F
         # Encode the input question
-        encoded_question = self.encode_single_question(question)
+        encoded_question = self.encode_questions_cached([question])[0]
 
         # Compute cosine similarity between the input question and all precomputed question embeddings
         similarities = F.cosine_similarity(encoded_question.unsqueeze(0), self.question_embeddings)
@@ -109,14 +215,34 @@ class GoldSQLRetrieval():
         # Return the corresponding SQL query
         return self.question2sql[most_similar_question], most_similar_question
 
+    def get_most_similar_sqls(self, questions: list):
+        """
+        Batched get_most_similar_sql, the questions are encoded in one padded forward pass.
+        """
+        import torch
+        encoded_questions = self.encode_questions_cached(questions)
+        if self.question_embedding_norms is None:
+            self.question_embedding_norms = self.question_embeddings.norm(dim=1)
+        # cosine similarity of each input question to all precomputed question embeddings, (num_questions, num_dataset_questions)
+        similarities = (encoded_questions @ self.question_embeddings.T) / (
+            encoded_questions.norm(dim=1).unsqueeze(1) * self.question_embedding_norms.unsqueeze(0)
+        ).clamp(min=1e-8)
+        most_similar_questions = [self.questions[x] for x in torch.argmax(similarities, dim=1).tolist()]
+        return [(self.question2sql[x], x) for x in most_similar_questions]
+
+    async def get_most_similar_sql_async(self, question: str):
+        """
+        Same as get_most_similar_sql, batched with the concurrent calls, the forward pass runs in a worker thread.
+        """
+        return await self.micro_batcher.submit(question)
+
 def main():
     dataset_dir_path = "./datasets/spider"
     pairs_cache_path = os.path.join(dataset_dir_path, 'question2sql.json')
-    embeddings_cache_path = os.path.join(dataset_dir_path, 'question_embeddings.pt')
     gold_sql_retrieval = GoldSQLRetrieval(
         dataset_dir_path,
         pairs_cache_path=pairs_cache_path,
-        embeddings_cache_path=embeddings_cache_path
+        flag_mmap_embeddings=True
     )
     
     # Example usage
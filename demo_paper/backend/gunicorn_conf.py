@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration of the backend with multiple uvicorn workers.
+With MAGESQL_PREFORK=1 the app is imported in the master process (preload_app), which loads the routing model,
+the retrieval model, the question embeddings and the dataset before the workers are forked, so the workers share them copy-on-write.
+
+Example:
+    MAGESQL_PREFORK=1 MAGESQL_WORKERS=4 gunicorn -c demo_paper/backend/gunicorn_conf.py
+"""
+
+import os
+import sys
+
+wsgi_app = "demo_paper.backend.main:app"
+bind = os.getenv("MAGESQL_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("MAGESQL_WORKERS", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+## loading the models on the first request of a worker may take a while without prefork
+timeout = int(os.getenv("MAGESQL_WORKER_TIMEOUT", "300"))
+preload_app = os.getenv("MAGESQL_PREFORK", "0") == "1"
+
+
+def post_fork(server, worker):
+    ## each worker gets its own intra-op thread pool, limit it so N workers do not oversubscribe the cores
+    num_threads = os.getenv("MAGESQL_TORCH_THREADS")
+    if num_threads and "torch" in sys.modules:
+        import torch
+        torch.set_num_threads(int(num_threads))
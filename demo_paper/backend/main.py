@@ -1,9 +1,15 @@
 import sys
 import os
+import gc
+import json
+import time
+import asyncio
+import threading
 
 from fastapi import FastAPI,  HTTPException 
 from fastapi.middleware.cors import CORSMiddleware  # Import CORS middleware
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
 
 # current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -13,6 +19,8 @@ from typing import List, Dict, Optional
 
 from .agent_center import AgentCenter  # Import the updated AgentCenter class
 from .gold_sql_retrieval import GoldSQLRetrieval
+from utils.openai_utils import get_openai_request_stats
+from utils.metrics_utils import get_metrics_registry
 
 import logging
 logging.basicConfig(
@@ -32,16 +40,64 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+## agents are constructed on first use, see AgentCenter
 agent_center = AgentCenter()
 
 dataset_dir_path = "./datasets/spider"
 pairs_cache_path = os.path.join(dataset_dir_path, 'question2sql.json')
-embeddings_cache_path = os.path.join(dataset_dir_path, 'question_embeddings.pt')
-gold_sql_retrieval = GoldSQLRetrieval(
-    dataset_dir_path,
-    pairs_cache_path=pairs_cache_path,
-    embeddings_cache_path=embeddings_cache_path
-)
+## content-addressed store of the question embeddings, see EmbeddingStore
+embedding_store_dir = os.path.join(dataset_dir_path, 'question_embeddings')
+## MAGESQL_PREFORK=1: load the models and embeddings on import, i.e. in the gunicorn master with preload_app (see gunicorn_conf.py),
+## so the forked workers share the pages copy-on-write instead of each loading its own copy
+flag_prefork = os.getenv('MAGESQL_PREFORK', '0') == '1'
+## memory-map the question embeddings instead of reading them into memory, set MAGESQL_MMAP_EMBEDDINGS=0 to disable
+flag_mmap_embeddings = flag_prefork or os.getenv('MAGESQL_MMAP_EMBEDDINGS', '1') == '1'
+gold_sql_retrieval = None
+gold_sql_retrieval_lock = threading.Lock()
+
+def get_gold_sql_retrieval():
+    """Construct the gold SQL retrieval (DistilBERT and question embeddings) on first use.
+    """
+    global gold_sql_retrieval
+    with gold_sql_retrieval_lock:
+        if gold_sql_retrieval is None:
+            gold_sql_retrieval = GoldSQLRetrieval(
+                dataset_dir_path,
+                pairs_cache_path=pairs_cache_path,
+                embedding_store_dir=embedding_store_dir,
+                flag_mmap_embeddings=flag_mmap_embeddings,
+                max_batch_size=agent_center.micro_batch_size,
+                max_wait_ms=agent_center.micro_batch_wait_ms,
+                embedding_cache_size=agent_center.embedding_cache_size,
+                embedding_cache_path=agent_center.get_model_cache_path('embedding_cache.sqlite'),
+                resource_registry=agent_center.resource_registry
+            )
+    return gold_sql_retrieval
+
+def warm_up():
+    """Construct the agents listed in MAGESQL_WARMUP (comma separated names, or 1/all for all agents and the gold SQL retrieval).
+    """
+    warm_up_option = os.getenv('MAGESQL_WARMUP', '')
+    if warm_up_option.lower() in ['1', 'all']:
+        agent_center.warm_up()
+        get_gold_sql_retrieval()
+    elif warm_up_option:
+        agent_center.warm_up([x.strip() for x in warm_up_option.split(',') if x.strip()])
+
+if flag_prefork:
+    agent_center.warm_up()
+    get_gold_sql_retrieval()
+    ## move the loaded objects to the permanent generation, so the garbage collector of the workers
+    ## does not touch (and copy) their pages
+    gc.collect()
+    gc.freeze()
+
+@app.on_event("startup")
+async def start_warm_up():
+    """Optional background warm-up, the API accepts requests (e.g. /health) while the agents are loading.
+    """
+    if os.getenv('MAGESQL_WARMUP') and not flag_prefork:
+        app.state.warm_up_task = asyncio.create_task(asyncio.to_thread(warm_up))
 
 # Define request models
 class AgentToggleRequest(BaseModel):
@@ -58,6 +114,9 @@ class RunPipelineRequest(BaseModel):
     model:str = "gpt-4"
     flag_use_error_correction_agent: bool = False
     flag_use_sql_execution_agent: bool = False
+    num_candidates: int = 1
+    correction_policy: str = "on_error"
+    flag_return_metrics: bool = False ## debug: attach stage latencies, token usage and cache hit rates to the result
 
 class SQLExecutionRequest(BaseModel):
     sql_query: str
@@ -109,6 +168,87 @@ class ExecuteDemonstrationSelectionAgentRequest(BaseModel):
 class ExecuteDatabaseRoutingAgentRequest(BaseModel):
     question: str
 
+## server caps of the batch requests, larger batches or concurrencies are rejected with a 422
+max_batch_size = int(os.getenv('MAGESQL_MAX_BATCH_SIZE', '256'))
+max_batch_concurrency = int(os.getenv('MAGESQL_MAX_BATCH_CONCURRENCY', '32'))
+## timeout (seconds) of each query of /execute-sql-batch, so one slow query does not hold a worker of the batch
+sql_batch_timeout = float(os.getenv('MAGESQL_SQL_BATCH_TIMEOUT', '10'))
+
+## batch variants of the per-question requests, results are returned in the order of the requests with a status per item
+class RunPipelineBatchRequest(BaseModel):
+    requests: List[RunPipelineRequest] = Field(..., max_length=max_batch_size)
+    max_concurrency: int = Field(8, ge=1, le=max_batch_concurrency)
+
+class SQLExecutionBatchRequest(BaseModel):
+    requests: List[SQLExecutionRequest] = Field(..., max_length=max_batch_size)
+    max_concurrency: int = Field(8, ge=1, le=max_batch_concurrency)
+
+class ExecuteDatabaseRoutingAgentBatchRequest(BaseModel):
+    questions: List[str] = Field(..., max_length=max_batch_size)
+
+class GoldSQLRetrievalBatchRequest(BaseModel):
+    questions: List[str] = Field(..., max_length=max_batch_size)
+
+
+def get_pipeline_kwargs(request: RunPipelineRequest):
+    return dict(
+        question=request.question,
+        flag_use_database_routing_agent=request.flag_use_database_routing_agent,
+        db_id=None if request.flag_use_database_routing_agent else request.db_id,
+        flag_use_demonstration_selection_agent=request.flag_use_demonstration_selection_agent,
+        num_demonstrations=request.num_demonstrations,
+        prompt_template=request.prompt_template,
+        model=request.model,
+        flag_use_error_correction_agent=request.flag_use_error_correction_agent,
+        flag_use_sql_execution_agent=request.flag_use_sql_execution_agent,
+        num_candidates=request.num_candidates,
+        correction_policy=request.correction_policy,
+        flag_return_metrics=request.flag_return_metrics
+    )
+
+def replace_none_values(result: dict):
+    for key in result:
+        if result[key] is None:
+            ## replace with empty string
+            result[key] = ''
+    return result
+
+def get_batch_response(results: list, start_time: float):
+    """Response of a batch endpoint: the per-item results, the number of failed items and the throughput of the batch.
+    """
+    elapsed_time = time.perf_counter() - start_time
+    return {
+        "status": "success",
+        "results": results,
+        "num_errors": sum(1 for x in results if x.get("status") == "error"),
+        "elapsed_time": elapsed_time,
+        "throughput": len(results) / elapsed_time if elapsed_time > 0 else None,
+    }
+
+async def run_batch_with_fallback(batch_func, items: list, item_func):
+    """Run batch_func(items) in a worker thread; if the batch fails, run item_func on each item so that only the failing items report an error.
+    """
+    try:
+        return [{"status": "success", "result": x} for x in await asyncio.to_thread(batch_func, items)]
+    except Exception as e:
+        logging.error(f"Batch failed, running the items one by one: {e}")
+    results = []
+    for item in items:
+        try:
+            results.append({"status": "success", "result": await asyncio.to_thread(item_func, item)})
+        except Exception as e:
+            results.append({"status": "error", "error_message": str(e)})
+    return results
+
+
+@app.get("/health")
+async def health():
+    """
+    Liveness check that does not load any agent, also reports which agents are loaded and the warm-up status.
+    """
+    health_info = agent_center.get_health()
+    health_info["gold_sql_retrieval_loaded"] = gold_sql_retrieval is not None
+    return health_info
 
 # 1. Get Agent Statuses
 @app.get("/agents")
@@ -118,6 +258,36 @@ async def get_agent_statuses():
     """
     return agent_center.agent_name2status
 
+@app.get("/openai-request-stats")
+async def openai_request_stats():
+    """
+    Return the request, retry and latency counters of OpenAI calls shared by all agents.
+    """
+    return get_openai_request_stats()
+
+@app.get("/llm-response-cache-stats")
+async def llm_response_cache_stats():
+    """
+    Return the hit/miss counters of the LLM response cache, enabled by MAGESQL_LLM_CACHE_PATH.
+    """
+    if agent_center.llm_response_cache is None:
+        return {"enabled": False}
+    return agent_center.llm_response_cache.get_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Return the stage latency, token usage, cache and error metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(get_metrics_registry().render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/pipeline-coalescing-stats")
+async def pipeline_coalescing_stats():
+    """
+    Return the number of pipeline requests and how many of them were coalesced with an identical in-flight request, derived from the counters on /metrics.
+    """
+    return agent_center.get_pipeline_coalescing_stats()
+
 # 2. Toggle Agent Activation Status
 @app.post("/agents/toggle")
 async def toggle_agent_status(request: AgentToggleRequest):
@@ -144,28 +314,46 @@ async def run_pipeline(request: RunPipelineRequest):
     """
     try:
         logging.debug("Received request:", request)
-        if request.flag_use_database_routing_agent:
-            request.db_id = None
-        result = agent_center.run_pipeline(
-            question=request.question,
-            flag_use_database_routing_agent=request.flag_use_database_routing_agent,
-            db_id=request.db_id,
-            flag_use_demonstration_selection_agent=request.flag_use_demonstration_selection_agent,
-            num_demonstrations=request.num_demonstrations,
-            prompt_template=request.prompt_template,
-            model=request.model,
-            flag_use_error_correction_agent=request.flag_use_error_correction_agent,
-            flag_use_sql_execution_agent=request.flag_use_sql_execution_agent
-        )
+        result = await agent_center.run_pipeline(**get_pipeline_kwargs(request))
         result["status"] = "success"
-        for key in result:
-            if result[key] is None:
-                ## replace with empty string
-                result[key] = ''
-        return result
+        return replace_none_values(result)
     except Exception as e:
         logging.error(f"Error running pipeline:\n{e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/run-pipeline-batch")
+async def run_pipeline_batch(request: RunPipelineBatchRequest):
+    """
+    Run the full pipeline for a list of requests: batched routing and demonstration selection, then concurrent LLM calls and SQL execution.
+    """
+    start_time = time.perf_counter()
+    try:
+        results = await agent_center.run_pipeline_batch([get_pipeline_kwargs(x) for x in request.requests], max_concurrency=request.max_concurrency)
+        return get_batch_response([replace_none_values(x) for x in results], start_time)
+    except Exception as e:
+        logging.error(f"Error running pipeline batch:\n{e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def format_server_sent_event(event_name:str, data):
+    ## default=str for the values of the SQL results that are not json serializable (e.g. bytes, decimals)
+    return f"event: {event_name}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.post("/run-pipeline-stream")
+async def run_pipeline_stream(request: RunPipelineRequest):
+    """
+    Run the full pipeline and stream its progress as server-sent events: the output of each stage as soon as it finishes
+    (routing, schema, demonstrations, generation, correction, execution), the generated SQL token by token (sql_token),
+    then the same result as /run-pipeline (result) or the error (error).
+    """
+    async def generate_events():
+        async for event_name, data in agent_center.stream_pipeline(**get_pipeline_kwargs(request)):
+            if event_name == "result":
+                data["status"] = "success"
+                data = replace_none_values(data)
+            yield format_server_sent_event(event_name, data)
+
+    ## no buffering by proxies (e.g. nginx), so each event reaches the client when it is emitted
+    return StreamingResponse(generate_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
     
 
 # 4. SQL Execution (Manual)
@@ -177,12 +365,32 @@ async def execute_sql(request: SQLExecutionRequest):
     try:
         logging.debug(f"Received request: {request}")
         logging.debug(f"SQL Execution result for query {request.sql_query} on database {request.db_id}")
-        result = agent_center.execute_agent('SQL Execution Agent', request.sql_query, request.db_id)
+        result = await agent_center.execute_agent_async('SQL Execution Agent', request.sql_query, request.db_id)
         logging.debug(f"SQL Execution result:\n{result}")
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/execute-sql-batch")
+async def execute_sql_batch(request: SQLExecutionBatchRequest):
+    """
+    Execute a list of SQL queries concurrently on a thread pool, with an error per failing query.
+    """
+    start_time = time.perf_counter()
+    try:
+        agent_center.check_agent_executable('SQL Execution Agent')
+        sql_execution_agent = await agent_center.get_agent_async('SQL Execution Agent')
+        results = await asyncio.to_thread(
+            sql_execution_agent.run_batch,
+            [x.sql_query for x in request.requests],
+            [x.db_id for x in request.requests],
+            max_workers=request.max_concurrency,
+            timeout=sql_batch_timeout
+        )
+        return get_batch_response(results, start_time)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # 5. Fetch Schema for a Database
 @app.post("/fetch-schema")
 async def fetch_schema(request: FetchSchemaRequest):
@@ -193,7 +401,8 @@ async def fetch_schema(request: FetchSchemaRequest):
         if not request.db_id:
             raise HTTPException(status_code=400, detail="Database ID (db_id) is required for schema fetching.")
         
-        schema_text = agent_center.schema_fetching_agent.run(request.db_id)
+        schema_fetching_agent = await agent_center.get_agent_async('Schema Fetching Agent')
+        schema_text = await asyncio.to_thread(schema_fetching_agent.run, request.db_id)
         return {"status": "success", "schema": schema_text}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch schema: {str(e)}")
@@ -205,8 +414,9 @@ async def select_demonstrations(request: SelectDemonstrationsRequest):
     Select demonstrations based on the user's question using the DemonstrationSelectionAgent.
     """
     try:
-        demonstrations_text = agent_center.demonstration_selection_agent.run(
-            request.question, demonstration_selector_option='jaccard', num_demonstrations=request.num_demonstrations
+        demonstration_selection_agent = await agent_center.get_agent_async('Demonstration Selection Agent')
+        demonstrations_text = await asyncio.to_thread(
+            demonstration_selection_agent.run, request.question, demonstration_selector_option='jaccard', num_demonstrations=request.num_demonstrations
         )
         return {"status": "success", "demonstrations": demonstrations_text}
     except Exception as e:
@@ -219,11 +429,14 @@ async def construct_prompt(request: ConstructPromptRequest):
     Construct a SQL prompt using the PromptConstructionAgent.
     """
     try:
-        schema_text = agent_center.schema_fetching_agent.run(request.db_id)
-        demonstrations_text = agent_center.demonstration_selection_agent.run(
-            request.question, demonstration_selector_option='jaccard', num_demonstrations=request.num_demonstrations
+        schema_fetching_agent = await agent_center.get_agent_async('Schema Fetching Agent')
+        demonstration_selection_agent = await agent_center.get_agent_async('Demonstration Selection Agent')
+        schema_text, demonstrations_text = await asyncio.gather(
+            asyncio.to_thread(schema_fetching_agent.run, request.db_id),
+            asyncio.to_thread(demonstration_selection_agent.run, request.question, demonstration_selector_option='jaccard', num_demonstrations=request.num_demonstrations)
         )
-        prompt_text, prompt_result = agent_center.prompt_construction_agent.run(request.question, schema_text, demonstrations_text)
+        prompt_construction_agent = await agent_center.get_agent_async('Prompt Construction Agent')
+        prompt_text, prompt_result = await prompt_construction_agent.run_async(request.question, schema_text, demonstrations_text)
         return {"status": "success", "prompt_text": prompt_text, "result": prompt_result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to construct prompt: {str(e)}")
@@ -235,11 +448,10 @@ async def apply_error_correction(request: ApplyErrorCorrectionRequest):
     Apply error correction to an SQL query using the ErrorCorrectionAgent.
     """
     try:
-        schema_text = agent_center.schema_fetching_agent.run(request.db_id)
-        demonstrations_text = agent_center.demonstration_selection_agent.run(
-            request.question, demonstration_selector_option='jaccard', num_demonstrations=request.num_demonstrations
-        )
-        prompt_text, corrected_result = agent_center.error_correction_agent.run(request.question, schema_text, demonstrations_text)
+        schema_fetching_agent = await agent_center.get_agent_async('Schema Fetching Agent')
+        schema_text = await asyncio.to_thread(schema_fetching_agent.run, request.db_id)
+        error_correction_agent = await agent_center.get_agent_async('Error Correction Agent')
+        prompt_text, corrected_result = await error_correction_agent.run_async(request.question, request.sql_query, schema_text)
         return {"status": "success", "corrected_result": corrected_result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to apply error correction: {str(e)}")
@@ -249,16 +461,35 @@ async def apply_error_correction(request: ApplyErrorCorrectionRequest):
 async def retrieve_gold_sql(request: GoldSQLRetrievalRequest):
     question = request.question
     try:
-        most_similar_sql, most_similar_question = gold_sql_retrieval.get_most_similar_sql(question)
+        retrieval = await asyncio.to_thread(get_gold_sql_retrieval)
+        most_similar_sql, most_similar_question = await retrieval.get_most_similar_sql_async(question)
         return most_similar_sql
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to retrieve gold SQL: {str(e)}")
+
+@app.post("/retrieve-gold-sql-batch")
+async def retrieve_gold_sql_batch(request: GoldSQLRetrievalBatchRequest):
+    """
+    Retrieve the gold SQL of the most similar question for a list of questions, encoded in one forward pass.
+    """
+    start_time = time.perf_counter()
+    try:
+        retrieval = await asyncio.to_thread(get_gold_sql_retrieval)
+        results = await run_batch_with_fallback(retrieval.get_most_similar_sqls, request.questions, retrieval.get_most_similar_sql)
+        for result in results:
+            if result["status"] == "success":
+                most_similar_sql, most_similar_question = result.pop("result")
+                result.update({"gold_sql": most_similar_sql, "most_similar_question": most_similar_question})
+        return get_batch_response(results, start_time)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to retrieve gold SQL: {str(e)}")
     
 
 @app.post("/execute-prompt-construction-agent")
 async def execute_prompt_construction_agent(request: ExecutePromptConstructionAgentRequest):
     try:
-        prompt_text, prompt_res = agent_center.prompt_construction_agent.run(
+        prompt_construction_agent = await agent_center.get_agent_async('Prompt Construction Agent')
+        prompt_text, prompt_res = await prompt_construction_agent.run_async(
             request.question,
             request.schema_text if request.schema_text else None,
             request.demonstration_text if request.demonstration_text else None, 
@@ -272,7 +503,8 @@ async def execute_prompt_construction_agent(request: ExecutePromptConstructionAg
 @app.post("/execute-error-correction-agent")
 async def execute_error_correction_agent(request: ExecuteErrorCorrectionAgentRequest):
     try:
-        prompt_text, prompt_result = agent_center.error_correction_agent.run(
+        error_correction_agent = await agent_center.get_agent_async('Error Correction Agent')
+        prompt_text, prompt_result = await error_correction_agent.run_async(
             request.question,
             request.sql_query,
             schema_text=request.schema_text if request.schema_text else None,
@@ -287,8 +519,10 @@ async def execute_error_correction_agent(request: ExecuteErrorCorrectionAgentReq
 @app.post("/execute-error-correction-agent-with-generated-prompt")
 async def execute_error_correction_agent_with_generated_prompt(request: ExecuteErrorCorrectionAgentWithGeneratedPromptRequest):
     try:
-        prompt_text, prompt_result = agent_center.error_correction_agent.run_with_generated_prompt(
+        error_correction_agent = await agent_center.get_agent_async('Error Correction Agent')
+        prompt_text, prompt_result = await error_correction_agent.run_with_generated_prompt_async(
             request.prompt_text, 
+            model=request.model
         )
         return {"prompt_text": prompt_text, "prompt_result": prompt_result}
     except Exception as e:
@@ -297,7 +531,9 @@ async def execute_error_correction_agent_with_generated_prompt(request: ExecuteE
 @app.post("/execute-demonstration-selection-agent")
 async def execute_demonstration_selection_agent(request: ExecuteDemonstrationSelectionAgentRequest):
     try:
-        demonstrations_text = agent_center.demonstration_selection_agent.run(
+        demonstration_selection_agent = await agent_center.get_agent_async('Demonstration Selection Agent')
+        demonstrations_text = await asyncio.to_thread(
+            demonstration_selection_agent.run,
             request.question, 
             demonstration_selector_option='jaccard',
             num_demonstrations=request.num_demonstrations
@@ -309,7 +545,24 @@ async def execute_demonstration_selection_agent(request: ExecuteDemonstrationSel
 @app.post("/execute-database-routing-agent")
 async def execute_database_routing_agent(request: ExecuteDatabaseRoutingAgentRequest):
     try:
-        db_id = agent_center.database_routing_agent.run(request.question)
+        database_routing_agent = await agent_center.get_agent_async('Database Routing Agent')
+        db_id = await database_routing_agent.run_async(request.question)
         return {"db_id": db_id}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to execute Database Routing Agent: {str(e)}")
+
+@app.post("/execute-database-routing-agent-batch")
+async def execute_database_routing_agent_batch(request: ExecuteDatabaseRoutingAgentBatchRequest):
+    """
+    Route a list of questions, with one forward pass for the questions not cached or routed by BM25.
+    """
+    start_time = time.perf_counter()
+    try:
+        database_routing_agent = await agent_center.get_agent_async('Database Routing Agent')
+        results = await run_batch_with_fallback(database_routing_agent.run_batch, request.questions, database_routing_agent.run)
+        for result in results:
+            if result["status"] == "success":
+                result["db_id"] = result.pop("result")
+        return get_batch_response(results, start_time)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to execute Database Routing Agent: {str(e)}")
\ No newline at end of file
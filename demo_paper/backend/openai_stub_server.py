@@ -0,0 +1,202 @@
+"""
+OpenAI-compatible stub server for offline load testing.
+Implements /v1/chat/completions and answers with the gold SQL of the question in the prompt (looked up from question2sql.json),
+or a canned SQL, after a configurable latency, and injects 429s, 5xx and timeouts at configurable rates.
+Streamed requests (stream=True) receive the SQL word by word as server-sent events, token_interval_ms apart, after the same latency.
+
+Start the stub server and point the backend to it with the base url env var read by init_openai_client:
+    python -m demo_paper.backend.openai_stub_server --port 8001 --latency_distribution lognormal --latency_mean_ms 800 --rate_429 0.05
+    INDEED_OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=stub uvicorn demo_paper.backend.main:app
+The configuration could also be given by environment variables STUB_<ARG_NAME_IN_UPPER_CASE>, e.g. STUB_RATE_429=0.05, when started with
+    uvicorn --factory demo_paper.backend.openai_stub_server:create_app --port 8001
+"""
+
+import os
+import re
+import math
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+QUESTION_PATTERNS = [
+    re.compile(r"#### Question:\n(.+?)\n"),
+    re.compile(r"### Answer the following question: (.+?)$", re.MULTILINE),
+    re.compile(r"/\* Answer the following: (.+?) ?\*/"),
+]
+
+DEFAULT_CONFIG = {
+    "pairs_path": "./datasets/spider/question2sql.json",
+    "canned_response": "SELECT 1",
+    "latency_distribution": "fixed", ## fixed, uniform or lognormal
+    "latency_mean_ms": 500.0,
+    "latency_std_ms": 200.0,
+    "rate_429": 0.0,
+    "rate_5xx": 0.0,
+    "rate_timeout": 0.0,
+    "timeout_seconds": 600.0, ## how long a "timed out" request hangs, should exceed the client timeout
+    "retry_after_seconds": 1.0,
+    "token_interval_ms": 10.0, ## delay between the chunks of a streamed response
+    "seed": None,
+}
+
+
+def get_config_from_env():
+    config = dict(DEFAULT_CONFIG)
+    for key, default_value in DEFAULT_CONFIG.items():
+        env_value = os.getenv(f"STUB_{key.upper()}")
+        if env_value is None:
+            continue
+        config[key] = env_value if isinstance(default_value, str) or default_value is None else type(default_value)(env_value)
+    return config
+
+
+class StubBackend():
+    def __init__(self, config:dict):
+        self.config = config
+        self.rng = random.Random(int(config["seed"]) if config["seed"] is not None else None)
+        self.question2sql = {}
+        if config["pairs_path"] and os.path.exists(config["pairs_path"]):
+            with open(config["pairs_path"], 'r') as f:
+                self.question2sql = json.load(f)
+            print(f"Loaded {len(self.question2sql)} question to gold SQL pairs from {config['pairs_path']}")
+        else:
+            print(f"Question to gold SQL pairs not found at {config['pairs_path']}, always answer with the canned response")
+        self.num_requests = 0
+        self.status2count = {}
+
+    def sample_latency(self):
+        mean = self.config["latency_mean_ms"] / 1000
+        std = self.config["latency_std_ms"] / 1000
+        distribution = self.config["latency_distribution"]
+        if distribution == "fixed":
+            return mean
+        if distribution == "uniform":
+            return self.rng.uniform(max(mean - std, 0), mean + std)
+        if distribution == "lognormal":
+            ## parameters of the underlying normal distribution that give the requested mean and std
+            if mean <= 0:
+                return 0
+            sigma2 = math.log(1 + (std / mean) ** 2)
+            mu = math.log(mean) - sigma2 / 2
+            return self.rng.lognormvariate(mu, math.sqrt(sigma2))
+        raise ValueError(f"Invalid latency distribution {distribution}")
+
+    def get_sql(self, messages:list):
+        prompt_text = "\n".join(x.get("content") or "" for x in messages if x.get("role") == "user")
+        for pattern in QUESTION_PATTERNS:
+            match = pattern.search(prompt_text)
+            if match and match.group(1).strip() in self.question2sql:
+                return self.question2sql[match.group(1).strip()]
+        return self.config["canned_response"]
+
+    def count(self, status_code:int):
+        self.status2count[status_code] = self.status2count.get(status_code, 0) + 1
+
+
+async def stream_chunks(sql:str, completion_id:str, model:str, usage:dict, token_interval:float):
+    """Server-sent events of a streamed chat completion: the SQL word by word, then the usage chunk (requested with stream_options.include_usage, None otherwise).
+    """
+    def get_chunk(choices:list, chunk_usage:dict=None):
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": choices, "usage": chunk_usage}
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    yield get_chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+    for token in re.findall(r"\S+\s*", sql):
+        await asyncio.sleep(token_interval)
+        yield get_chunk([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+    yield get_chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+    if usage is not None:
+        yield get_chunk([], usage)
+    yield "data: [DONE]\n\n"
+
+
+def create_app(config:dict=None):
+    if config is None:
+        config = get_config_from_env()
+    app = FastAPI()
+    stub_backend = StubBackend(config)
+    app.state.stub_backend = stub_backend
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stub_backend.num_requests += 1
+        await asyncio.sleep(stub_backend.sample_latency())
+        dice = stub_backend.rng.random()
+        if dice < config["rate_429"]:
+            stub_backend.count(429)
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after": str(config["retry_after_seconds"])},
+                content={"error": {"message": "Rate limit reached (stub)", "type": "requests", "code": "rate_limit_exceeded"}}
+            )
+        dice -= config["rate_429"]
+        if dice < config["rate_5xx"]:
+            stub_backend.count(500)
+            return JSONResponse(status_code=500, content={"error": {"message": "Internal server error (stub)", "type": "server_error"}})
+        dice -= config["rate_5xx"]
+        if dice < config["rate_timeout"]:
+            stub_backend.count(504)
+            await asyncio.sleep(config["timeout_seconds"])
+            return JSONResponse(status_code=504, content={"error": {"message": "Timeout (stub)", "type": "timeout"}})
+        stub_backend.count(200)
+        sql = stub_backend.get_sql(body.get("messages", []))
+        n = body.get("n") or 1
+        prompt_tokens = sum(len((x.get("content") or "").split()) for x in body.get("messages", []))
+        completion_tokens = len(sql.split())
+        if body.get("stream"):
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+            flag_include_usage = (body.get("stream_options") or {}).get("include_usage")
+            return StreamingResponse(
+                stream_chunks(sql, f"chatcmpl-stub-{uuid.uuid4().hex}", body.get("model", "stub"), usage if flag_include_usage else None, config["token_interval_ms"] / 1000),
+                media_type="text/event-stream"
+            )
+        return {
+            "id": f"chatcmpl-stub-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [
+                {"index": i, "message": {"role": "assistant", "content": sql}, "finish_reason": "stop"}
+                for i in range(n)
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens * n,
+                "total_tokens": prompt_tokens + completion_tokens * n,
+            },
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return {"num_requests": stub_backend.num_requests, "status2count": stub_backend.status2count}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for offline load testing")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    for key, default_value in DEFAULT_CONFIG.items():
+        arg_type = str if default_value is None or isinstance(default_value, str) else type(default_value)
+        parser.add_argument(f"--{key}", type=arg_type, default=None)
+    args = parser.parse_args()
+
+    config = get_config_from_env()
+    for key in DEFAULT_CONFIG:
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    import uvicorn
+    uvicorn.run(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,19 +20,56 @@ class JacDemonstrationSelector(BaseDemonstrationSelector):
         union = (len(set(list1)) + len(set(list2))) - intersection
         return float(intersection) / union
 
+    def build_index(self):
+        """Token sets of the demonstrations and an inverted index token -> demonstration indices, built once on first use
+        """
+        if getattr(self, 'token2demonstration_indices', None) is not None:
+            return
+        self.demonstration_token_sets = [set(data['question_toks']) for data in self.demonstrations]
+        token2demonstration_indices = {}
+        for i, token_set in enumerate(self.demonstration_token_sets):
+            for token in token_set:
+                token2demonstration_indices.setdefault(token, []).append(i)
+        self.token2demonstration_indices = token2demonstration_indices
+
+    def get_top_demonstration_indices(self, question_toks:list, num_demonstrations:int):
+        """Indices of the demonstrations with the highest Jaccard similarity, ties in the order of the demonstrations.
+        Only the demonstrations sharing a token with the question are scored, the others have similarity 0.
+        """
+        question_token_set = set(question_toks)
+        idx2intersection = {}
+        for token in question_token_set:
+            for i in self.token2demonstration_indices.get(token, ()):
+                idx2intersection[i] = idx2intersection.get(i, 0) + 1
+        scored = []
+        for i, intersection in idx2intersection.items():
+            union = len(question_token_set) + len(self.demonstration_token_sets[i]) - intersection
+            scored.append((-float(intersection) / union, i))
+        top_indices = [i for _, i in sorted(scored)[:num_demonstrations]]
+        if len(top_indices) < num_demonstrations:
+            ## fill with the first demonstrations without any shared token
+            for i in range(self.num_all_demonstrations):
+                if len(top_indices) >= num_demonstrations:
+                    break
+                if i not in idx2intersection:
+                    top_indices.append(i)
+        return top_indices
+
     def select_demonstrations(self, record_data: dict, num_demonstrations:int=5, flag_return_ids:bool=False):
-        tmp = []
-        for data in self.demonstrations:
-            jac = self._jaccard_similarity(record_data['question_toks'], data['question_toks'])
-            tmp.append((jac, data))
-        tmp.sort(reverse=True,key = lambda x: (x[0]))
-        tmp = tmp[:num_demonstrations]
-        res = []
-        if flag_return_ids:
-            res = [x[1]['idx'] for x in tmp]
-        else:
-            res = [x[1] for x in tmp]
-        return res
+        return self.select_demonstrations_batch([record_data], num_demonstrations=num_demonstrations, flag_return_ids=flag_return_ids)[0]
+
+    def select_demonstrations_batch(self, record_data_list: list, num_demonstrations:int=5, flag_return_ids:bool=False):
+        """select_demonstrations for several questions, sharing the inverted index of the demonstrations
+        """
+        self.build_index()
+        res_list = []
+        for record_data in record_data_list:
+            top_indices = self.get_top_demonstration_indices(record_data['question_toks'], num_demonstrations)
+            if flag_return_ids:
+                res_list.append([self.demonstrations[i]['idx'] for i in top_indices])
+            else:
+                res_list.append([self.demonstrations[i] for i in top_indices])
+        return res_list
 
     def get_default_output_file_path(self, config:dict):
         """Get default output file path to store the prompts
@@ -0,0 +1,47 @@
+import os
+import sqlite3
+
+from agents.sql_execution_agent import SqlExecutionAgent
+from utils.sql_utils import validate_sql
+
+
+def create_database(database_path, database:str):
+    os.makedirs(os.path.join(database_path, database))
+    connection = sqlite3.connect(os.path.join(database_path, database, f"{database}.sqlite"))
+    connection.execute("CREATE TABLE t (a INTEGER)")
+    connection.executemany("INSERT INTO t VALUES (?)", [(1,), (2,)])
+    connection.commit()
+    connection.close()
+
+
+def test_run_validates_postprocessed_sql(tmp_path):
+    ## "> =" is rewritten to ">=" before execution, so the query must not be rejected by the compilation check
+    create_database(tmp_path, "db")
+    agent = SqlExecutionAgent(database_path=str(tmp_path))
+    result = agent.run("SELECT a FROM t WHERE a > = 2", "db")
+    assert result["query_exec_flag"] == "result"
+    assert result["query_exec_result"] == [{"a": 2}]
+
+
+def test_run_reports_invalid_sql(tmp_path):
+    create_database(tmp_path, "db")
+    agent = SqlExecutionAgent(database_path=str(tmp_path))
+    result = agent.run("SELECT b FROM t", "db")
+    assert result["status"] == "error"
+
+
+def test_run_batch_interrupts_slow_queries(tmp_path):
+    create_database(tmp_path, "db")
+    agent = SqlExecutionAgent(database_path=str(tmp_path))
+    slow_sql = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c"
+    results = agent.run_batch([slow_sql, "SELECT a FROM t WHERE a = 1"], ["db", "db"], timeout=0.2)
+    assert results[0]["status"] == "error"
+    assert results[1]["query_exec_result"] == [{"a": 1}]
+
+
+def test_validation_cache_keeps_line_comments(tmp_path):
+    ## joining the lines would comment out the WHERE clause and share the cache entry of the valid query
+    create_database(tmp_path, "db")
+    db_path = os.path.join(tmp_path, "db", "db.sqlite")
+    assert validate_sql("SELECT a FROM t -- all rows WHERE b = 1", db_path)["valid"]
+    assert not validate_sql("SELECT a FROM t -- all rows\nWHERE b = 1", db_path)["valid"]
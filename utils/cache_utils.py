@@ -0,0 +1,238 @@
+"""
+In-memory LRU cache with an optional persistent SQLite tier, for results of the DistilBERT models keyed by the normalized question
+(database routing predictions, question embeddings). Entries belong to a namespace (e.g. the model path),
+so the entries of another model are never returned, and changing the namespace clears the memory tier.
+Also a content-addressed on-disk store of the embeddings of a whole question list (EmbeddingStore).
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from utils.metrics_utils import cache_request_counter
+
+NON_ALPHANUMERIC_PATTERN = re.compile(r"[^\w]+")
+
+
+def normalize_question(question:str):
+    """Fold case, punctuation and whitespace: 'How many singers?' and 'how many  singers' share the key.
+    """
+    return NON_ALPHANUMERIC_PATTERN.sub(" ", question.casefold()).strip()
+
+
+def get_model_fingerprint(model_path:str):
+    """Namespace of the results of a model: its absolute path and a digest of the name, size and modification time of its files
+    (weights, config, tokenizer, the files directly in the model directory), so overwriting the weights in place (e.g. save_pretrained) invalidates the cache.
+    The modification time of the directory itself is not used, it does not change when a file is overwritten.
+    """
+    if not model_path or not os.path.exists(model_path):
+        return str(model_path)
+    if os.path.isdir(model_path):
+        file_paths = sorted(x.path for x in os.scandir(model_path) if x.is_file())
+    else:
+        file_paths = [model_path]
+    digest = hashlib.sha256()
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        digest.update(f"{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return f"{os.path.abspath(model_path)}@{digest.hexdigest()[:16]}"
+
+
+class LRUCache():
+    def __init__(self, name:str, max_size:int=4096, namespace:str='', persistent_path:str=None, serialize=json.dumps, deserialize=json.loads):
+        """name labels the hit/miss metrics (magesql_cache_requests_total), max_size 0 disables the cache.
+        With persistent_path, entries are also written to a SQLite file (serialized with serialize, a str or bytes) and survive restarts.
+        """
+        self.name = name
+        self.max_size = max_size
+        self.namespace = namespace
+        self.persistent_path = persistent_path
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.lock = threading.Lock()
+        self.key2value = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.connection = None
+        self.connection_pid = None
+        if self.persistent_path:
+            if os.path.dirname(persistent_path):
+                os.makedirs(os.path.dirname(persistent_path), exist_ok=True)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS lru_cache (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (namespace, key))")
+            self.conn.commit()
+
+    @property
+    def conn(self):
+        """SQLite connection of the current process, reopened after a fork, see LLMResponseCache.conn.
+        """
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.persistent_path, check_same_thread=False)
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def set_namespace(self, namespace:str):
+        """Switch to another namespace (e.g. the model path changed), the entries of the previous namespace are dropped from memory.
+        """
+        with self.lock:
+            if namespace != self.namespace:
+                self.namespace = namespace
+                self.key2value.clear()
+
+    def get(self, key:str):
+        if not self.enabled:
+            return None
+        with self.lock:
+            if key in self.key2value:
+                self.key2value.move_to_end(key)
+                self.num_hits += 1
+                cache_request_counter.inc(cache=self.name, result="hit")
+                return self.key2value[key]
+            row = None
+            if self.persistent_path:
+                row = self.conn.execute("SELECT value FROM lru_cache WHERE namespace = ? AND key = ?", (self.namespace, key)).fetchone()
+            if row is None:
+                self.num_misses += 1
+                cache_request_counter.inc(cache=self.name, result="miss")
+                return None
+            value = self.deserialize(row[0])
+            self.set_memory(key, value)
+            self.num_hits += 1
+        cache_request_counter.inc(cache=self.name, result="hit")
+        return value
+
+    def set_memory(self, key:str, value):
+        self.key2value[key] = value
+        self.key2value.move_to_end(key)
+        while len(self.key2value) > self.max_size:
+            self.key2value.popitem(last=False)
+
+    def set(self, key:str, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.set_memory(key, value)
+            if self.persistent_path:
+                self.conn.execute("INSERT OR REPLACE INTO lru_cache (namespace, key, value) VALUES (?, ?, ?)", (self.namespace, key, self.serialize(value)))
+                self.conn.commit()
+
+    def clear(self):
+        """Drop the entries of the current namespace from memory and from the persistent tier.
+        """
+        with self.lock:
+            self.key2value.clear()
+            if self.persistent_path:
+                self.conn.execute("DELETE FROM lru_cache WHERE namespace = ?", (self.namespace,))
+                self.conn.commit()
+
+    def get_stats(self):
+        num_requests = self.num_hits + self.num_misses
+        return {
+            "name": self.name,
+            "namespace": self.namespace,
+            "size": len(self.key2value),
+            "max_size": self.max_size,
+            "num_hits": self.num_hits,
+            "num_misses": self.num_misses,
+            "hit_rate": self.num_hits / num_requests if num_requests else None,
+        }
+
+
+def get_embedding_key(model_id:str, questions:list):
+    """Content address of the embeddings of an ordered question list encoded by a model.
+    """
+    return hashlib.sha256(json.dumps([model_id, questions]).encode()).hexdigest()
+
+
+class EmbeddingStore():
+    """Content-addressed store of question embeddings: <store_dir>/<key>.npy (float32, memory-mappable) and <key>.json with the model id and the ordered questions,
+    where key = get_embedding_key(model_id, questions). A stored file is only used for exactly the same model and questions,
+    and when the question list changes, the embeddings of the questions already stored are reused and only the new questions are encoded.
+    """
+    def __init__(self, store_dir:str, model_id:str, max_versions:int=2):
+        self.store_dir = store_dir
+        self.model_id = model_id
+        self.max_versions = max_versions ## stored versions kept per model, the oldest ones are deleted
+        os.makedirs(store_dir, exist_ok=True)
+
+    def get_paths(self, key:str):
+        return os.path.join(self.store_dir, f"{key}.npy"), os.path.join(self.store_dir, f"{key}.json")
+
+    def get_manifests(self):
+        """Manifests of the stored embeddings of the model, most recent first.
+        """
+        manifests = []
+        for file_name in os.listdir(self.store_dir):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.store_dir, file_name), 'r') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if manifest.get('model_id') == self.model_id and os.path.exists(self.get_paths(manifest['key'])[0]):
+                manifests.append(manifest)
+        return sorted(manifests, key=lambda x: -x['created_time'])
+
+    def load(self, key:str, flag_mmap:bool=True):
+        import numpy as np
+        return np.load(self.get_paths(key)[0], mmap_mode='r' if flag_mmap else None)
+
+    def save(self, key:str, questions:list, embeddings):
+        """Write the embeddings and the manifest through temporary files, so a concurrent reader never sees a partial file.
+        """
+        import numpy as np
+        embeddings_path, manifest_path = self.get_paths(key)
+        tmp_embeddings_path = f"{embeddings_path}.{os.getpid()}.tmp"
+        with open(tmp_embeddings_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+        os.replace(tmp_embeddings_path, embeddings_path)
+        manifest = {"key": key, "model_id": self.model_id, "num_questions": len(questions), "created_time": time.time(), "questions": questions}
+        tmp_manifest_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_manifest_path, manifest_path)
+        for old_manifest in self.get_manifests()[self.max_versions:]:
+            for path in self.get_paths(old_manifest['key']):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def get_or_encode(self, questions:list, encode_func, flag_mmap:bool=True):
+        """Embeddings of the questions (a float32 array, memory-mapped read-only with flag_mmap), encode_func(questions) encodes the missing ones.
+        An empty question list is neither encoded nor stored, its array has the dimension of the stored embeddings (0 if none are stored).
+        """
+        import numpy as np
+        if not questions:
+            manifests = self.get_manifests()
+            dim = self.load(manifests[0]['key']).shape[1] if manifests else 0
+            return np.empty((0, dim), dtype=np.float32)
+        key = get_embedding_key(self.model_id, questions)
+        if os.path.exists(self.get_paths(key)[0]):
+            print(f"Loaded question embeddings {key[:12]} from {self.store_dir}")
+            return self.load(key, flag_mmap=flag_mmap)
+        ## rows of the most recent stored version, then the newly encoded questions after them
+        question2row = {}
+        embedding_parts = []
+        manifests = self.get_manifests()
+        if manifests:
+            embedding_parts.append(self.load(manifests[0]['key'], flag_mmap=True))
+            question2row = {question: i for i, question in enumerate(manifests[0]['questions'])}
+        new_questions = [x for x in dict.fromkeys(questions) if x not in question2row]
+        print(f"Encoding {len(new_questions)} new questions, reusing the stored embeddings of {len(questions) - len(new_questions)} questions")
+        if new_questions:
+            num_stored_rows = embedding_parts[0].shape[0] if embedding_parts else 0
+            embedding_parts.append(np.asarray(encode_func(new_questions), dtype=np.float32))
+            for i, question in enumerate(new_questions):
+                question2row[question] = num_stored_rows + i
+        all_embeddings = np.concatenate(embedding_parts) if len(embedding_parts) > 1 else embedding_parts[0]
+        embeddings = all_embeddings[[question2row[x] for x in questions]]
+        self.save(key, questions, embeddings)
+        return self.load(key, flag_mmap=flag_mmap)
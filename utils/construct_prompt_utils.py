@@ -1,5 +1,7 @@
 import tiktoken
 
+from utils.prompt_builder_utils import PromptBuilder
+
 PROMPT_TEMPLATE = {
     "instruction_section": "### Complete sqlite SQL query only and with no explanation.",
     "demonstration_section": {
@@ -107,22 +109,83 @@ def get_prompt_construction_template(template_option:str='option_1'):
         raise ValueError(f"Invalid template option: {template_option}")
     return template
 
-def fill_prompt_construction_prompt(question:str, schema_text:str=None, demonstration_text:str=None ,template_option:str='option_1'):
+## default order of the sections, the demonstrations are per question so the shared prefix across requests is only the instruction
+DEFAULT_SECTION_ORDER = ["instruction", "demonstrations", "schema", "question"]
+## stable prefix order, the instruction and the schema (same for all questions on a db_id) come first so that requests on the same database share a long identical prefix,
+## which is served from the provider-side prompt cache
+STABLE_PREFIX_SECTION_ORDER = ["instruction", "schema", "demonstrations", "question"]
+## sections that are identical across requests on the same database
+STABLE_SECTIONS = {"instruction", "schema"}
+
+PROMPT_CONSTRUCTION_TEMPLATES = {
+    'option_1': {
+        "instruction": "### Complete sqlite SQL query only and with no explanation.",
+        "demonstration_prefix": "### Some example pairs of question and corresponding SQL query are provided based on similar problems:",
+        "schema_prefix": "### Given the following database schema:",
+        "question": "### Answer the following question: {question}",
+    },
+    'option_2': {
+        "instruction": "/* Complete sqlite SQL query only and with no explanation.*/",
+        "demonstration_prefix": "/* Some example pairs of question and corresponding SQL query are provided based on similar problems: */:",
+        "schema_prefix": "/* Given the following database schema: */:",
+        "question": "/* Answer the following: {question} */\nSELECT ",
+    },
+    'option_3': {
+        "instruction": None,
+        "demonstration_prefix": "/* Some example pairs of question and corresponding SQL query are provided based on similar problems: */:",
+        "schema_prefix": "/* Given the following database schema: */:",
+        "question": "/* Answer the following: {question} */\nSELECT ",
+    },
+    ## option_1 with the stable prefix order
+    'option_4': {
+        "instruction": "### Complete sqlite SQL query only and with no explanation.",
+        "demonstration_prefix": "### Some example pairs of question and corresponding SQL query are provided based on similar problems:",
+        "schema_prefix": "### Given the following database schema:",
+        "question": "### Answer the following question: {question}",
+        "section_order": STABLE_PREFIX_SECTION_ORDER,
+    },
+}
+
+def build_prompt_construction_prompt(question:str, schema_text:str=None, demonstration_text:str|list=None, template_option:str='option_1', max_tokens:int=4096, tokenizer=None, section_order:list=None, budget_policy:dict=None):
+    """Build the prompt and return it with its token counts: the number of tokens of the prompt, of each section,
+    and of the prefix shared with other requests on the same database (the leading instruction and schema sections).
+    section_order overrides the order of the template, e.g. STABLE_PREFIX_SECTION_ORDER.
+    budget_policy defaults to DEFAULT_BUDGET_POLICY of prompt_builder_utils (the schema is kept whole), pass TRUNCATE_SCHEMA_BUDGET_POLICY to truncate a schema exceeding max_tokens.
+    """
+    if template_option not in PROMPT_CONSTRUCTION_TEMPLATES:
+        raise ValueError(f"Invalid template option: {template_option}")
+    template = PROMPT_CONSTRUCTION_TEMPLATES[template_option]
+    if section_order is None:
+        section_order = template.get("section_order", DEFAULT_SECTION_ORDER)
+    if isinstance(demonstration_text, str):
+        ## a free-form text is one item, kept verbatim or dropped as a whole, splitting it on blank lines could cut a demonstration in half
+        demonstration_text = [demonstration_text] if demonstration_text else []
+    builder = PromptBuilder(max_tokens=max_tokens, section_separator="\n\n", budget_policy=budget_policy, tokenizer=tokenizer)
+    for section_name in section_order:
+        if section_name == "instruction":
+            builder.add_section("instruction", template["instruction"])
+        elif section_name == "demonstrations":
+            builder.add_list_section("demonstrations", demonstration_text, prefix=template["demonstration_prefix"], separator="\n\n")
+        elif section_name == "schema":
+            builder.add_section("schema", schema_text, prefix=template["schema_prefix"], separator="\n")
+        elif section_name == "question":
+            builder.add_section("question", template["question"].format(question=question))
+        else:
+            raise ValueError(f"Invalid section name: {section_name}")
+    output, num_tokens = builder.build()
+    token_counts = {
+        "num_tokens": num_tokens,
+        "num_shared_prefix_tokens": builder.get_prefix_num_tokens(STABLE_SECTIONS),
+        "section2num_tokens": builder.get_section_num_tokens(),
+    }
+    return output, token_counts
+
+def fill_prompt_construction_prompt(question:str, schema_text:str=None, demonstration_text:str|list=None, template_option:str='option_1', max_tokens:int=4096, tokenizer=None, flag_return_num_tokens:bool=False, section_order:list=None, budget_policy:dict=None):
     """
     Currently assume the demonstration_text already contains the prefix. Need to update the template if in future demonstration_text does not contain the prefix.
+    The demonstrations could be a list of demonstration texts, of which trailing ones are dropped to fit max_tokens, or a text that is kept or dropped as a whole.
     """
-    if template_option == 'option_1':
-        demonstration_text = '' if not demonstration_text else f"### Some example pairs of question and corresponding SQL query are provided based on similar problems:\n\n{demonstration_text}\n\n"
-        schema_text = '' if not schema_text else f"### Given the following database schema:\n{schema_text}\n\n"
-        template = """### Complete sqlite SQL query only and with no explanation.\n\n{demonstration_text}{schema_text}### Answer the following question: {question}"""
-    elif template_option == 'option_2':
-        demonstration_text = '' if not demonstration_text else f"/* Some example pairs of question and corresponding SQL query are provided based on similar problems: */:\n\n{demonstration_text}\n\n"
-        schema_text = '' if not schema_text else f"/* Given the following database schema: */:\n{schema_text}\n\n"
-        template = """/* Complete sqlite SQL query only and with no explanation.*/\n\n{demonstration_text}{schema_text}/* Answer the following: {question} */\nSELECT """
-    elif template_option == 'option_3':
-        demonstration_text = '' if not demonstration_text else f"/* Some example pairs of question and corresponding SQL query are provided based on similar problems: */:\n\n{demonstration_text}\n\n"
-        schema_text = '' if not schema_text else f"/* Given the following database schema: */:\n{schema_text}\n\n"
-        template = """{demonstration_text}{schema_text}/* Answer the following: {question} */\nSELECT """
-    output = template.format(question=question, schema_text=schema_text, demonstration_text=demonstration_text)
+    output, token_counts = build_prompt_construction_prompt(question, schema_text, demonstration_text, template_option, max_tokens=max_tokens, tokenizer=tokenizer, section_order=section_order, budget_policy=budget_policy)
+    if flag_return_num_tokens:
+        return output, token_counts["num_tokens"]
     return output
-
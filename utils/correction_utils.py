@@ -1,112 +1,189 @@
-import pandas as pd
+import os
+import threading
 from typing import List, Union, Optional
 
+from utils.prompt_builder_utils import get_tokenizer
+from utils.cache_utils import LRUCache
+
+def format_foreign_keys(df):
+    """Foreign keys of one database as "[t1.c1 = t2.c2,...]", or "]" when there is none (kept from the original string slicing).
+    """
+    if df.empty:
+        return "]"
+    pairs = df['First Table Name'] + '.' + df['First Table Foreign Key'] + " = " + df['Second Table Name'] + '.' + df['Second Table Foreign Key']
+    return "[" + ",".join(pairs) + "]"
+
+def format_primary_keys(df):
+    """Primary keys of one database as "[t.c,...]\n", or "]\n" when there is none (kept from the original string slicing).
+    """
+    if df.empty:
+        return "]\n"
+    keys = df['Table Name'] + '.' + df['Primary Key']
+    return "[" + ",".join(keys) + "]\n"
+
+def format_fields(df):
+    """Fields of one database, one line per table sorted by table name.
+    """
+    table2fields = df.groupby(' Table Name', sort=True)[' Field Name'].agg(",".join)
+    return "".join("Table " + name + ', columns = [' + fields + "]\n" for name, fields in table2fields.items())
+
 def find_foreign_keys_MYSQL_like(db_name, spider_foreign):
     """Generate the foreign keys for self-correction.
     """
-    df = spider_foreign[spider_foreign['Database name'] == db_name]
-    output = "["
-    for _, row in df.iterrows():
-        output += row['First Table Name'] + '.' + row['First Table Foreign Key'] + " = " + row['Second Table Name'] + '.' + row['Second Table Foreign Key'] + ','
-    output= output[:-1] + "]"
-    return output
+    return format_foreign_keys(spider_foreign[spider_foreign['Database name'] == db_name])
 
 def find_fields_MYSQL_like(db_name, spider_schema):
     """Generate the fields for self-correction.
     """
-    df = spider_schema[spider_schema['Database name'] == db_name]
-    df = df.groupby(' Table Name')
-    output = ""
-    for name, group in df:
-        output += "Table " +name+ ', columns = ['
-        for _, row in group.iterrows():
-            output += row[" Field Name"]+','
-        output = output[:-1]
-        output += "]\n"
-    return output
+    return format_fields(spider_schema[spider_schema['Database name'] == db_name])
 
 def find_primary_keys_MYSQL_like(db_name, spider_primary):
     """Generate the primary keys for self-correction.
     """
-    df = spider_primary[spider_primary['Database name'] == db_name]
-    output = "["
-    for _, row in df.iterrows():
-        output += row['Table Name'] + '.' + row['Primary Key'] +','
-    output = output[:-1]
-    output += "]\n"
-    return output
+    return format_primary_keys(spider_primary[spider_primary['Database name'] == db_name])
+
+def get_db_id2schema_texts(spider_schema, spider_primary, spider_foreign):
+    """Precompute the fields, foreign keys and primary keys texts of every database in one pass over each table,
+    so that building a prompt is a dict lookup instead of filtering the dataframes by db_id.
+    Output is the same as find_fields_MYSQL_like, find_foreign_keys_MYSQL_like and find_primary_keys_MYSQL_like.
+    """
+    db_id2fields = {db_id: format_fields(df) for db_id, df in spider_schema.groupby('Database name', sort=False)}
+    db_id2foreign_keys = {db_id: format_foreign_keys(df) for db_id, df in spider_foreign.groupby('Database name', sort=False)}
+    db_id2primary_keys = {db_id: format_primary_keys(df) for db_id, df in spider_primary.groupby('Database name', sort=False)}
+    db_id2schema_texts = {}
+    for db_id in dict.fromkeys(list(spider_schema['Database name']) + list(spider_primary['Database name']) + list(spider_foreign['Database name'])):
+        db_id2schema_texts[db_id] = {
+            "fields": db_id2fields.get(db_id, ""),
+            "foreign_keys": db_id2foreign_keys.get(db_id, "]"),
+            "primary_keys": db_id2primary_keys.get(db_id, "]\n"),
+        }
+    return db_id2schema_texts
+
+## precomputed schema texts of the schema tables, keyed by the ids of the three dataframes, which are kept in the entry so the ids are not reused
+_schema_tables2schema_texts = {}
+## schema tables and texts loaded from a tables.json path
+_tables_path2correction_schema = {}
+_correction_schema_lock = threading.Lock()
+
+def get_cached_db_id2schema_texts(spider_schema, spider_primary, spider_foreign):
+    """get_db_id2schema_texts of the schema tables, computed once per set of tables.
+    """
+    key = (id(spider_schema), id(spider_primary), id(spider_foreign))
+    with _correction_schema_lock:
+        entry = _schema_tables2schema_texts.get(key)
+        if entry is None:
+            entry = ((spider_schema, spider_primary, spider_foreign), get_db_id2schema_texts(spider_schema, spider_primary, spider_foreign))
+            _schema_tables2schema_texts[key] = entry
+    return entry[1]
+
+def load_correction_schema(tables_json_path:str):
+    """Schema tables (see creating_schema) of a tables.json file and the schema texts of all its databases, built once per path at load time.
+    Return spider_schema, spider_primary, spider_foreign and db_id2schema_texts.
+    """
+    key = os.path.abspath(tables_json_path)
+    with _correction_schema_lock:
+        if key not in _tables_path2correction_schema:
+            spider_schema, spider_primary, spider_foreign = creating_schema(tables_json_path)
+            db_id2schema_texts = get_db_id2schema_texts(spider_schema, spider_primary, spider_foreign)
+            _schema_tables2schema_texts[(id(spider_schema), id(spider_primary), id(spider_foreign))] = ((spider_schema, spider_primary, spider_foreign), db_id2schema_texts)
+            _tables_path2correction_schema[key] = (spider_schema, spider_primary, spider_foreign, db_id2schema_texts)
+    return _tables_path2correction_schema[key]
+
+def get_schema_texts(db_name, spider_schema=None, spider_primary=None, spider_foreign=None, db_id2schema_texts=None):
+    """Fields, foreign keys and primary keys texts of a database, looked up from db_id2schema_texts,
+    which defaults to the texts precomputed once for the schema tables (see get_cached_db_id2schema_texts).
+    """
+    if db_id2schema_texts is None and spider_schema is not None and spider_primary is not None and spider_foreign is not None:
+        db_id2schema_texts = get_cached_db_id2schema_texts(spider_schema, spider_primary, spider_foreign)
+    if db_id2schema_texts is not None:
+        return db_id2schema_texts.get(db_name, {"fields": "", "foreign_keys": "]", "primary_keys": "]\n"})
+    return {
+        "fields": find_fields_MYSQL_like(db_name, spider_schema),
+        "foreign_keys": find_foreign_keys_MYSQL_like(db_name, spider_foreign),
+        "primary_keys": find_primary_keys_MYSQL_like(db_name, spider_primary),
+    }
 
 def creating_schema(DATASET_JSON):
     """Generate the schema for self-correction.
     """
+    import pandas as pd ## pandas is only needed to build the schema tables, not to fill the correction prompt
     schema_df = pd.read_json(DATASET_JSON)
-    schema_df = schema_df.drop(['column_names','table_names'], axis=1)
     schema = []
     f_keys = []
     p_keys = []
-    for index, row in schema_df.iterrows():
-        tables = row['table_names_original']
-        col_names = row['column_names_original']
-        col_types = row['column_types']
-        foreign_keys = row['foreign_keys']
-        primary_keys = row['primary_keys']
-        for col, col_type in zip(col_names, col_types):
-            index, col_name = col
+    columns = zip(schema_df['db_id'], schema_df['table_names_original'], schema_df['column_names_original'], schema_df['column_types'], schema_df['primary_keys'], schema_df['foreign_keys'])
+    for db_id, tables, col_names, col_types, primary_keys, foreign_keys in columns:
+        for (index, col_name), col_type in zip(col_names, col_types):
             if index == -1:
-                for table in tables:
-                    schema.append([row['db_id'], table, '*', 'text'])
+                schema.extend([db_id, table, '*', 'text'] for table in tables)
             else:
-                schema.append([row['db_id'], tables[index], col_name, col_type])
-        for primary_key in primary_keys:
-            index, column = col_names[primary_key]
-            p_keys.append([row['db_id'], tables[index], column])
-        for foreign_key in foreign_keys:
-            first, second = foreign_key
-            first_index, first_column = col_names[first]
-            second_index, second_column = col_names[second]
-            f_keys.append([row['db_id'], tables[first_index], tables[second_index], first_column, second_column])
+                schema.append([db_id, tables[index], col_name, col_type])
+        p_keys.extend([db_id, tables[col_names[x][0]], col_names[x][1]] for x in primary_keys)
+        f_keys.extend([db_id, tables[col_names[first][0]], tables[col_names[second][0]], col_names[first][1], col_names[second][1]] for first, second in foreign_keys)
     spider_schema = pd.DataFrame(schema, columns=['Database name', ' Table Name', ' Field Name', ' Type'])
     spider_primary = pd.DataFrame(p_keys, columns=['Database name', 'Table Name', 'Primary Key'])
     spider_foreign = pd.DataFrame(f_keys, columns=['Database name', 'First Table Name', 'Second Table Name', 'First Table Foreign Key', 'Second Table Foreign Key'])
     return spider_schema, spider_primary, spider_foreign
 
 
-def generate_instruction(rules_groups=[1,2,3], flag_add_generic_rules=False):
-    """Generate the instruction for self-correction. User could add rules in this function."""
-    # if rules_groups is not list but integer, then convert integer to list
+## rules groups of the Spider self-correction instruction, user could add rules here
+SPIDER_GROUP2RULES = {
+    ## rules group 1
+    1: [
+        "Use the db_name values that are explicitly mentioned in the question.",
+        "Pay attention to the columns that are used for the JOIN by using the Foreign_keys.",
+        "Use DESC and DISTINCT when needed.",
+        "Pay attention to the columns that are used for the GROUP BY statement.",
+        "Pay attention to the columns that are used for the SELECT statement.",
+        "Only change the GROUP BY clause when necessary (Avoid redundant columns in GROUP BY).",
+        "Use GROUP BY on one column only.",
+    ],
+    ## rules group 2
+    2: [
+        "When the question only asks for a certain field, please don't include the COUNT(*) in the SELECT statement, but instead use it in the ORDER BY clause to sort the results based on the count of that field.",
+        """Please don't use "IN", "OR", "LEFT JOIN" as it might cause extra results, use "INTERSECT" or "EXCEPT" instead, and remember to use "DISTINCT" or "LIMIT" when necessary.""",
+    ],
+    ## rules group 3
+    3: [
+        "Don't make error that write queries with multiple join operations as one with nested subqueries with IN keyword, please use join to get correct results in such cases.",
+        "Please think when to use conjunction, sometimes you may need to use conjunction to get correct results.",
+    ],
+    ## rules group 4
+    4: [
+        "When the question only asks for a certain field, please don't include the COUNT(*) in the SELECT statement, but instead use it in the ORDER BY clause to sort the results based on the count of that field.",
+        """Please don't use "IN", "LEFT JOIN" as it might cause extra results, use "INTERSECT" or "EXCEPT" instead, and remember to use "DISTINCT" or "LIMIT" when necessary.""",
+    ],
+}
+
+## rules groups of the WikiSQL self-correction instruction
+WIKISQL_GROUP2RULES = {
+    ## rules group 1
+    1: [
+        """Here are the SQL operations allowed :\naggregation operaters: 'MAX', 'MIN', 'COUNT', 'SUM', 'AVG'; comparison operators: '=', '>', '<'; symbols: 'SELECT', 'WHERE', 'AND', 'COL', 'TABLE'""",
+        """Please be careful that the generated SQL will be executed directly with python sqlite3 library, so please correct the SQL to be compatible with sqlite3, i.e. single quote inside of string that need to be matched should be escaped by another single quote, and the column name should be wrapped by double quote.""",
+    ]
+}
+
+SPIDER_INSTRUCTION_HEADER = "#### For the given question, use the provided tables, columns, foreign keys, and primary keys to fix the given SQLite SQL QUERY for any issues. If there are any problems, fix them. If there are no issues, return the SQLite SQL QUERY as is.\n"
+WIKISQL_INSTRUCTION_HEADER = "#### For the given question, use the provided table schema to fix the given SQLite SQL QUERY for any issues. If there are any problems, fix them. If there are no issues, return the SQLite SQL QUERY as is.\n"
+RULES_HEADER = "#### Use the following instructions for fixing the SQL QUERY:\n"
+
+## instruction text, keyed by (dataset, rules groups tuple, flag_add_generic_rules) or (rules text,)
+_instruction_cache = {}
+## prefix (instruction and schema) of the error correction prompt and its number of tokens, keyed by (rules key, schema_text), bounded since the schema text could come from the client
+_error_correction_prefix_cache = LRUCache("error_correction_prefix", max_size=1024)
+
+def get_rules_groups_key(rules_groups):
+    """Hashable key of rules_groups, an integer is a single group.
+    """
     if isinstance(rules_groups, int):
-        rules_groups = [rules_groups]
+        return (rules_groups,)
+    return tuple(rules_groups)
+
+def build_instruction(header:str, group2rules:dict, rules_groups:tuple, flag_add_generic_rules:bool=False):
     query = [] if not flag_add_generic_rules else generic_instruction()
-    query.append("#### For the given question, use the provided tables, columns, foreign keys, and primary keys to fix the given SQLite SQL QUERY for any issues. If there are any problems, fix them. If there are no issues, return the SQLite SQL QUERY as is.\n")
-    query.append("#### Use the following instructions for fixing the SQL QUERY:\n")
-    ## TDOD: add more rules & add options to select which rules to use
-    group2rules = {
-        ## rules group 1
-        1: [
-            "Use the db_name values that are explicitly mentioned in the question.",
-            "Pay attention to the columns that are used for the JOIN by using the Foreign_keys.",
-            "Use DESC and DISTINCT when needed.",
-            "Pay attention to the columns that are used for the GROUP BY statement.",
-            "Pay attention to the columns that are used for the SELECT statement.",
-            "Only change the GROUP BY clause when necessary (Avoid redundant columns in GROUP BY).",
-            "Use GROUP BY on one column only.",
-        ],
-        ## rules group 2
-        2: [
-            "When the question only asks for a certain field, please don't include the COUNT(*) in the SELECT statement, but instead use it in the ORDER BY clause to sort the results based on the count of that field.",
-            """Please don't use "IN", "OR", "LEFT JOIN" as it might cause extra results, use "INTERSECT" or "EXCEPT" instead, and remember to use "DISTINCT" or "LIMIT" when necessary.""",
-        ],
-        ## rules group 3
-        3: [
-            "Don't make error that write queries with multiple join operations as one with nested subqueries with IN keyword, please use join to get correct results in such cases.",
-            "Please think when to use conjunction, sometimes you may need to use conjunction to get correct results.",
-        ],
-        ## rules group 4
-        4: [
-            "When the question only asks for a certain field, please don't include the COUNT(*) in the SELECT statement, but instead use it in the ORDER BY clause to sort the results based on the count of that field.",
-            """Please don't use "IN", "LEFT JOIN" as it might cause extra results, use "INTERSECT" or "EXCEPT" instead, and remember to use "DISTINCT" or "LIMIT" when necessary.""",
-        ],
-    }
+    query.append(header)
+    query.append(RULES_HEADER)
     rules = []
     for group in rules_groups:
         if group in group2rules:
@@ -117,31 +194,22 @@ def generate_instruction(rules_groups=[1,2,3], flag_add_generic_rules=False):
     query += '\n'
     return query
 
+def generate_instruction(rules_groups=[1,2,3], flag_add_generic_rules=False):
+    """Generate the instruction for self-correction. Rules are defined in SPIDER_GROUP2RULES.
+    The text is built once per rules groups and cached, so the prefix of the prompt is identical across requests.
+    """
+    key = ("spider", get_rules_groups_key(rules_groups), flag_add_generic_rules)
+    if key not in _instruction_cache:
+        _instruction_cache[key] = build_instruction(SPIDER_INSTRUCTION_HEADER, SPIDER_GROUP2RULES, key[1], flag_add_generic_rules)
+    return _instruction_cache[key]
+
 def generate_instruction_wikisql(rules_groups=[1], flag_add_generic_rules=False):
-    # if rules_groups is not list but integer, then convert integer to list
-    if isinstance(rules_groups, int):
-        rules_groups = [rules_groups]
-    """Generate the instruction for self-correction. User could add rules in this function."""
-    query = [] if not flag_add_generic_rules else generic_instruction()
-    query.append("#### For the given question, use the provided table schema to fix the given SQLite SQL QUERY for any issues. If there are any problems, fix them. If there are no issues, return the SQLite SQL QUERY as is.\n")
-    query.append("#### Use the following instructions for fixing the SQL QUERY:\n")
-    ## TDOD: add more rules & add options to select which rules to use
-    group2rules = {
-        ## rules group 1
-        1: [
-            """Here are the SQL operations allowed :\naggregation operaters: 'MAX', 'MIN', 'COUNT', 'SUM', 'AVG'; comparison operators: '=', '>', '<'; symbols: 'SELECT', 'WHERE', 'AND', 'COL', 'TABLE'""",
-            """Please be careful that the generated SQL will be executed directly with python sqlite3 library, so please correct the SQL to be compatible with sqlite3, i.e. single quote inside of string that need to be matched should be escaped by another single quote, and the column name should be wrapped by double quote.""",
-        ]
-    }
-    rules = []
-    for group in rules_groups:
-        if group in group2rules:
-            rules.extend(group2rules[group])
-    for i, rule in enumerate(rules):
-        query.append(str(i+1) + ") " + rule + '\n')
-    query = "".join(query)
-    query += '\n'
-    return query
+    """Generate the instruction for self-correction on WikiSQL. Rules are defined in WIKISQL_GROUP2RULES, the text is cached per rules groups.
+    """
+    key = ("wikisql", get_rules_groups_key(rules_groups), flag_add_generic_rules)
+    if key not in _instruction_cache:
+        _instruction_cache[key] = build_instruction(WIKISQL_INSTRUCTION_HEADER, WIKISQL_GROUP2RULES, key[1], flag_add_generic_rules)
+    return _instruction_cache[key]
 
 def generic_instruction():
     rules = [
@@ -151,18 +219,20 @@ def generic_instruction():
     return rules
 
 def geneerate_instruction_with_given_rules_text(rules_text):
-    query = []
-    query += "#### For the given question, use the provided tables, columns, foreign keys, and primary keys to fix the given SQLite SQL QUERY for any issues. If there are any problems, fix them. If there are no issues, return the SQLite SQL QUERY as is.\n"
-    query += "#### Use the following instructions for fixing the SQL QUERY:\n"
-    query += rules_text
-    query += '\n'
-    return query
+    key = (rules_text,)
+    if key not in _instruction_cache:
+        _instruction_cache[key] = SPIDER_INSTRUCTION_HEADER + RULES_HEADER + rules_text + '\n'
+    return _instruction_cache[key]
 
-def construct_self_correction_prompt(test_sample_text, db_name, sql, spider_schema, spider_primary, spider_foreign, rules_groups=[1,2,3], flag_add_generic_rules=False):
+def construct_self_correction_prompt(test_sample_text, db_name, sql, spider_schema, spider_primary, spider_foreign, rules_groups=[1,2,3], flag_add_generic_rules=False, db_id2schema_texts=None):
+    """The schema tables could come from load_correction_schema, their schema texts are precomputed once and looked up by db_name.
+    db_id2schema_texts overrides the precomputed texts.
+    """
     instruction = generate_instruction(rules_groups=rules_groups, flag_add_generic_rules=flag_add_generic_rules)
-    fields = find_fields_MYSQL_like(db_name, spider_schema)
-    fields += "Foreign_keys = " + find_foreign_keys_MYSQL_like(db_name, spider_foreign) + '\n'
-    fields += "Primary_keys = " + find_primary_keys_MYSQL_like(db_name, spider_primary)
+    schema_texts = get_schema_texts(db_name, spider_schema, spider_primary, spider_foreign, db_id2schema_texts=db_id2schema_texts)
+    fields = schema_texts["fields"]
+    fields += "Foreign_keys = " + schema_texts["foreign_keys"] + '\n'
+    fields += "Primary_keys = " + schema_texts["primary_keys"]
     prompt = instruction + fields+ '#### Question: ' + test_sample_text + '\n#### SQLite SQL QUERY\n' + sql +'\n#### SQLite FIXED SQL QUERY\nSELECT'
     return prompt
 
@@ -174,10 +244,38 @@ def construct_self_correction_prompt_wikisql(question, table_schema, prev_query,
     return prompt
 
 
-def fill_error_correction_prompt(question:str, sql_query:str, schema_text:str=None, rules_groups=Union[List[int], str], template:str=None):
-    instruction = generate_instruction(rules_groups=rules_groups) if not isinstance(rules_groups, str) else geneerate_instruction_with_given_rules_text(rules_groups)
-    schema_text = '' if not schema_text else f"#### Table Schema:\n{schema_text}\n\n"
+def get_error_correction_prefix(schema_text:str=None, rules_groups:Union[List[int], str]=[1,3,4], flag_return_num_tokens:bool=False, tokenizer=None):
+    """Instruction and schema segments of the error correction prompt, shared by all questions on the same database.
+    Built once per (rules groups, schema_text) and cached, with its number of tokens (counted on the first request of the count) if flag_return_num_tokens.
+    """
+    key = (("text", rules_groups) if isinstance(rules_groups, str) else get_rules_groups_key(rules_groups), schema_text or '')
+    entry = _error_correction_prefix_cache.get(key)
+    if entry is None:
+        instruction = generate_instruction(rules_groups=rules_groups) if not isinstance(rules_groups, str) else geneerate_instruction_with_given_rules_text(rules_groups)
+        schema_segment = '' if not schema_text else f"#### Table Schema:\n{schema_text}\n\n"
+        entry = {"text": instruction + schema_segment, "num_tokens": None}
+        _error_correction_prefix_cache.set(key, entry)
+    if not flag_return_num_tokens:
+        return entry["text"]
+    if entry["num_tokens"] is None:
+        entry["num_tokens"] = len((tokenizer or get_tokenizer()).encode(entry["text"]))
+    return entry["text"], entry["num_tokens"]
+
+
+def fill_error_correction_prompt(question:str, sql_query:str, schema_text:str=None, rules_groups:Union[List[int], str]=[1,3,4], template:str=None, error_message:str=None, flag_return_num_prefix_tokens:bool=False):
+    """error_message is the SQLite error (or other issue) of executing sql_query, shown to the model when provided.
+    Without a template, the prompt is the cached prefix (instruction and schema) followed by the request specific segments,
+    the question and the query are inserted as is (braces in them are not interpreted as format fields).
+    If flag_return_num_prefix_tokens, also return the number of tokens of the cached prefix (None with a template).
+    """
+    error_text = '' if not error_message else f"#### Execution Error:\n{error_message}\n\n"
     if not template:
-        template = f"""{instruction}{schema_text}#### Question:\n{question}\n#### SQLite SQL QUERY:\n{sql_query}\n\n#### SQLite FIXED SQL QUERY\nSELECT"""
-    output = template.format(schema_text=schema_text, question=question, sql_query=sql_query)
-    return output
+        if flag_return_num_prefix_tokens:
+            prefix, num_prefix_tokens = get_error_correction_prefix(schema_text=schema_text, rules_groups=rules_groups, flag_return_num_tokens=True)
+        else:
+            prefix, num_prefix_tokens = get_error_correction_prefix(schema_text=schema_text, rules_groups=rules_groups), None
+        output = f"{prefix}#### Question:\n{question}\n#### SQLite SQL QUERY:\n{sql_query}\n\n{error_text}#### SQLite FIXED SQL QUERY\nSELECT"
+        return (output, num_prefix_tokens) if flag_return_num_prefix_tokens else output
+    schema_text = '' if not schema_text else f"#### Table Schema:\n{schema_text}\n\n"
+    output = template.format(schema_text=schema_text, question=question, sql_query=sql_query, error_text=error_text)
+    return (output, None) if flag_return_num_prefix_tokens else output
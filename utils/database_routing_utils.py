@@ -1,24 +1,91 @@
 import json
 import os
+from pathlib import Path
 
-import torch
-from transformers import DistilBertForSequenceClassification, DistilBertTokenizer
+## torch and transformers are imported in the functions, so that importing this module (e.g. by the agents) does not load them
+
+## inference backends of the routing classifier: full precision PyTorch, ONNX Runtime (int8 dynamic quantization by default), PyTorch int8 dynamic quantization
+ROUTING_BACKENDS = ['torch', 'onnxruntime', 'torch_dynamic_quant']
+
+def load_label_map(model_path):
+    label_map_path = os.path.join(model_path, "label_map.json")
+    with open(label_map_path, 'r') as f:
+        label_map = json.load(f)
+    return label_map
 
 # Load the saved model, tokenizer, and label map
 def load_model(model_path):
+    from transformers import DistilBertForSequenceClassification, DistilBertTokenizer
     print(f"Loading model and label map from {model_path}...")
     model = DistilBertForSequenceClassification.from_pretrained(model_path)
     tokenizer = DistilBertTokenizer.from_pretrained(model_path)
 
     # Load the label_map
-    label_map_path = os.path.join(model_path, "label_map.json")
-    with open(label_map_path, 'r') as f:
-        label_map = json.load(f)
+    label_map = load_label_map(model_path)
 
     return model, tokenizer, label_map
 
+# Int8 dynamic quantization of the linear layers (weights int8, activations quantized on the fly), CPU only
+def quantize_model_dynamic(model):
+    import torch
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def get_onnx_model_path(model_path, flag_quantized=True):
+    return os.path.join(model_path, 'onnx', 'model_quantized.onnx' if flag_quantized else 'model.onnx')
+
+# Export the classifier to ONNX with dynamic batch size and sequence length
+def export_onnx(model, tokenizer, onnx_path, opset_version=14):
+    import torch
+    model.eval()
+    inputs = tokenizer(["How many singers do we have?"], return_tensors="pt", max_length=128, truncation=True, padding=True)
+    Path(os.path.dirname(onnx_path)).mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (inputs['input_ids'], inputs['attention_mask']),
+            onnx_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['logits'],
+            dynamic_axes={
+                'input_ids': {0: 'batch_size', 1: 'sequence_length'},
+                'attention_mask': {0: 'batch_size', 1: 'sequence_length'},
+                'logits': {0: 'batch_size'},
+            },
+            opset_version=opset_version
+        )
+    print(f"Exported ONNX model to {onnx_path}")
+
+def quantize_onnx(onnx_path, quantized_onnx_path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(onnx_path, quantized_onnx_path, weight_type=QuantType.QInt8)
+    print(f"Saved int8 quantized ONNX model to {quantized_onnx_path}")
+
+# Export (and quantize) the saved model to <model_path>/onnx if not done yet, return the path of the ONNX model
+def prepare_onnx_model(model_path, flag_quantized=True, flag_overwrite=False):
+    onnx_path = get_onnx_model_path(model_path, flag_quantized=False)
+    quantized_onnx_path = get_onnx_model_path(model_path, flag_quantized=True)
+    if flag_overwrite or not os.path.exists(onnx_path):
+        model, tokenizer, _ = load_model(model_path)
+        export_onnx(model, tokenizer, onnx_path)
+    if flag_quantized and (flag_overwrite or not os.path.exists(quantized_onnx_path)):
+        quantize_onnx(onnx_path, quantized_onnx_path)
+    return quantized_onnx_path if flag_quantized else onnx_path
+
+def load_onnx_session(onnx_path, num_threads=None):
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError("The onnxruntime backend of the database routing requires onnxruntime, run `pip install onnxruntime`.") from e
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
 # Prediction function that returns db_id
 def predict_db(model, tokenizer, text, device, label_map):
+    import torch
     model.eval()
 
     # Tokenizing the input text
@@ -43,4 +110,43 @@ def predict_db(model, tokenizer, text, device, label_map):
 
     # Map the predicted index back to the db_id
     predicted_db_id = label_map[str(preds)]
-    return predicted_db_id
\ No newline at end of file
+    return predicted_db_id
+
+# Batched prediction, one padded forward pass for all texts
+def predict_db_batch(model, tokenizer, texts, device, label_map):
+    import torch
+    model.eval()
+
+    # pad to the longest text of the batch instead of max_length, the attention mask excludes the padding
+    inputs = tokenizer(
+        list(texts),
+        return_tensors="pt",
+        max_length=128,
+        truncation=True,
+        padding=True
+    )
+
+    input_ids = inputs['input_ids'].to(device)
+    attention_mask = inputs['attention_mask'].to(device)
+
+    with torch.no_grad():
+        outputs = model(input_ids, attention_mask=attention_mask)
+        logits = outputs.logits
+
+    preds = torch.argmax(logits, dim=1).tolist()
+    return [label_map[str(x)] for x in preds]
+
+# Batched prediction with an ONNX Runtime session of the exported classifier
+def predict_db_batch_onnx(session, tokenizer, texts, label_map):
+    inputs = tokenizer(
+        list(texts),
+        return_tensors="np",
+        max_length=128,
+        truncation=True,
+        padding=True
+    )
+    logits = session.run(['logits'], {
+        'input_ids': inputs['input_ids'].astype('int64'),
+        'attention_mask': inputs['attention_mask'].astype('int64'),
+    })[0]
+    return [label_map[str(x)] for x in logits.argmax(axis=1).tolist()]
@@ -21,12 +21,12 @@ def load_txt_records(file_path:str):
         records = [line.strip() for line in f.readlines()]
     return records
 
-def save_line_by_line_json(data, file_path:str):
-    """Save a data into line by line json format
+def save_line_by_line_json(data, file_path:str, flag_append:bool=False):
+    """Save a data into line by line json format, append to the end of the file if flag_append is True
     """
     # create directory if not exists
     Path.mkdir(Path(file_path).parent, parents=True, exist_ok=True)
-    with open(file_path, 'w') as f:
+    with open(file_path, 'a' if flag_append else 'w') as f:
         for record in data:
             f.write(json.dumps(record) + '\n')
 
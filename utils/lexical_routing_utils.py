@@ -0,0 +1,116 @@
+"""
+Lexical database routing with BM25: one document per db_id made of its table and column names (tables.json) and of its training questions.
+Scoring a question only sums the precomputed BM25 weights of its terms in an inverted index, so it takes microseconds,
+and the margin between the two best databases tells whether the lexical match is reliable or the question should go to the DistilBERT model.
+"""
+
+import re
+import math
+import heapq
+from collections import Counter, defaultdict
+
+## frequent question words that do not tell the databases apart
+STOPWORDS = {
+    'a', 'an', 'the', 'of', 'in', 'on', 'at', 'to', 'for', 'by', 'with', 'from', 'and', 'or', 'not', 'no', 'is', 'are', 'was', 'were', 'be',
+    'been', 'do', 'does', 'did', 'have', 'has', 'had', 'what', 'which', 'who', 'whom', 'whose', 'when', 'where', 'how', 'many', 'much',
+    'all', 'each', 'every', 'any', 'that', 'this', 'these', 'those', 'there', 'their', 'its', 'it', 'they', 'them', 'we', 'us', 'our',
+    'me', 'my', 'you', 'your', 'give', 'show', 'list', 'find', 'return', 'tell', 'name', 'names', 'number', 'count', 'total', 'than',
+    'more', 'most', 'less', 'least', 'greater', 'larger', 'smaller', 'average', 'maximum', 'minimum', 'max', 'min', 'distinct', 'different',
+    'also', 'both', 'either', 'other', 'only', 'as', 'if', 'but', 'so', 'order', 'ordered', 'sorted', 'descending', 'ascending', 'id', 'ids',
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text:str):
+    """Lowercased alphanumeric tokens without stopwords, with a light plural folding (singers -> singer).
+    Identifiers such as concert_singer are split on underscores.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower().replace('_', ' ')):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def get_schema_text(table_schema:dict):
+    """Table and column names of one database of tables.json, both the original identifiers and the natural language names.
+    """
+    names = list(table_schema['table_names']) + list(table_schema['table_names_original'])
+    for _, column_name in table_schema['column_names'] + table_schema['column_names_original']:
+        if column_name != '*':
+            names.append(column_name)
+    return ' '.join(names)
+
+
+class BM25Index():
+    def __init__(self, documents:list, k1:float=1.2, b:float=0.75):
+        """documents is a list of token lists. The BM25 weight of each (term, document) is computed here, so scoring only adds them up.
+        """
+        self.k1 = k1
+        self.b = b
+        self.num_documents = len(documents)
+        avg_document_length = sum(len(x) for x in documents) / max(1, self.num_documents)
+        term2document_frequency = Counter()
+        for tokens in documents:
+            term2document_frequency.update(set(tokens))
+        self.term2postings = defaultdict(list)
+        for document_idx, tokens in enumerate(documents):
+            length_norm = k1 * (1 - b + b * len(tokens) / avg_document_length) if avg_document_length else k1
+            for term, term_frequency in Counter(tokens).items():
+                document_frequency = term2document_frequency[term]
+                idf = math.log(1 + (self.num_documents - document_frequency + 0.5) / (document_frequency + 0.5))
+                self.term2postings[term].append((document_idx, idf * term_frequency * (k1 + 1) / (term_frequency + length_norm)))
+
+    def get_scores(self, tokens:list):
+        """BM25 score of each document matching at least one of the tokens, document index -> score.
+        """
+        document_idx2score = defaultdict(float)
+        for term in set(tokens):
+            for document_idx, weight in self.term2postings.get(term, ()):
+                document_idx2score[document_idx] += weight
+        return document_idx2score
+
+
+class LexicalRouter():
+    def __init__(self, db_id2texts:dict, k1:float=1.2, b:float=0.75):
+        """db_id2texts maps each db_id to the texts describing it (schema text and questions).
+        """
+        self.db_ids = list(db_id2texts)
+        self.index = BM25Index([tokenize(' '.join(db_id2texts[x])) for x in self.db_ids], k1=k1, b=b)
+
+    @classmethod
+    def from_dataset(cls, dataset, question_split_names:tuple=('train',), schema_weight:int=2, **kwargs):
+        """Build the router from a Spider dataset with loaded schema (see SpiderDataset.load_schema).
+        The schema text is repeated schema_weight times so that the table and column names are not drowned by the questions.
+        """
+        db_id2texts = defaultdict(list)
+        for split_name in ['train', 'dev', 'test']:
+            for db_id, table_schema in dataset.table_schema.get(split_name, {}).items():
+                if db_id not in db_id2texts:
+                    db_id2texts[db_id].extend([get_schema_text(table_schema)] * schema_weight)
+        for split_name in question_split_names:
+            for record in dataset.data.get(split_name, []):
+                db_id2texts[record['db_id']].append(record['question'])
+        return cls(db_id2texts, **kwargs)
+
+    def predict_top_k(self, question:str, k:int=5):
+        """The k best (db_id, score) pairs, by decreasing score.
+        """
+        document_idx2score = self.index.get_scores(tokenize(question))
+        top_k = heapq.nlargest(k, document_idx2score.items(), key=lambda x: x[1])
+        return [(self.db_ids[idx], score) for idx, score in top_k]
+
+    def predict(self, question:str):
+        """Best db_id and the relative margin (top1 - top2) / top1 of its score, in [0, 1].
+        The db_id is None (and the margin 0) if no term of the question matches any database.
+        """
+        top_2 = self.predict_top_k(question, k=2)
+        if not top_2:
+            return None, 0.0
+        top1_score = top_2[0][1]
+        top2_score = top_2[1][1] if len(top_2) > 1 else 0.0
+        return top_2[0][0], (top1_score - top2_score) / top1_score if top1_score > 0 else 0.0
@@ -0,0 +1,202 @@
+"""
+Minimal in-process metrics (counters, gauges, histograms with labels) rendered in the Prometheus text exposition format,
+so the backend could expose /metrics without depending on prometheus_client.
+"""
+
+import math
+import threading
+from collections import defaultdict
+
+## latency buckets in seconds, from a cache hit to a slow LLM call
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+## token count buckets of a single request
+DEFAULT_TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def format_labels(label_names:tuple, label_values:tuple, extra_labels:dict=None):
+    labels = list(zip(label_names, label_values))
+    if extra_labels:
+        labels.extend(extra_labels.items())
+    if not labels:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in labels]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def format_value(value:float):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric():
+    metric_type = None
+
+    def __init__(self, name:str, description:str, label_names:tuple=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def get_label_values(self, labels:dict):
+        labels = labels or {}
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(labels[x] for x in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self.render_samples())
+        return lines
+
+    def render_samples(self):
+        raise NotImplementedError
+
+
+class CounterMetric(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name:str, description:str, label_names:tuple=()):
+        super().__init__(name, description, label_names)
+        self.label_values2value = defaultdict(float)
+
+    def inc(self, value:float=1, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.label_values2value[label_values] += value
+
+    def get_values(self):
+        with self.lock:
+            return dict(self.label_values2value)
+
+    def render_samples(self):
+        return [f"{self.name}{format_labels(self.label_names, k)} {format_value(v)}" for k, v in sorted(self.get_values().items())]
+
+
+class GaugeMetric(CounterMetric):
+    metric_type = "gauge"
+
+    def set(self, value:float, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.label_values2value[label_values] = value
+
+
+class HistogramMetric(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name:str, description:str, label_names:tuple=(), buckets:tuple=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.label_values2bucket_counts = {}
+        self.label_values2sum = defaultdict(float)
+        self.label_values2count = defaultdict(int)
+
+    def observe(self, value:float, **labels):
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            if label_values not in self.label_values2bucket_counts:
+                self.label_values2bucket_counts[label_values] = [0] * len(self.buckets)
+            bucket_counts = self.label_values2bucket_counts[label_values]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+            self.label_values2sum[label_values] += value
+            self.label_values2count[label_values] += 1
+
+    def get_summary(self, **labels):
+        """Count, sum and average of the observations with the given labels.
+        """
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            count = self.label_values2count.get(label_values, 0)
+            total = self.label_values2sum.get(label_values, 0.0)
+        return {"count": count, "sum": total, "avg": total / count if count else None}
+
+    def render_samples(self):
+        lines = []
+        with self.lock:
+            for label_values in sorted(self.label_values2bucket_counts):
+                for upper_bound, count in zip(self.buckets, self.label_values2bucket_counts[label_values]):
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names, label_values, {'le': format_value(upper_bound)})} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, label_values)} {format_value(self.label_values2sum[label_values])}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, label_values)} {self.label_values2count[label_values]}")
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.name2metric = {}
+
+    def get_or_create(self, metric_class, name:str, description:str, label_names:tuple=(), **kwargs):
+        with self.lock:
+            if name not in self.name2metric:
+                self.name2metric[name] = metric_class(name, description, label_names, **kwargs)
+            metric = self.name2metric[name]
+        if not isinstance(metric, metric_class) or metric.label_names != tuple(label_names):
+            raise ValueError(f"Metric {name} is already registered with another type or labels.")
+        return metric
+
+    def counter(self, name:str, description:str, label_names:tuple=()):
+        return self.get_or_create(CounterMetric, name, description, label_names)
+
+    def gauge(self, name:str, description:str, label_names:tuple=()):
+        return self.get_or_create(GaugeMetric, name, description, label_names)
+
+    def histogram(self, name:str, description:str, label_names:tuple=(), buckets:tuple=DEFAULT_LATENCY_BUCKETS):
+        return self.get_or_create(HistogramMetric, name, description, label_names, buckets=buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.name2metric.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+def get_metrics_registry():
+    return metrics_registry
+
+
+## metrics shared by the agents and the backend
+stage_latency_histogram = metrics_registry.histogram("magesql_stage_latency_seconds", "Latency of each pipeline stage", ("stage",))
+stage_error_counter = metrics_registry.counter("magesql_stage_errors_total", "Exceptions raised by each pipeline stage", ("stage", "error_type"))
+llm_request_latency_histogram = metrics_registry.histogram("magesql_llm_request_latency_seconds", "Latency of OpenAI requests including retries", ("model",))
+llm_error_counter = metrics_registry.counter("magesql_llm_errors_total", "Failed OpenAI attempts by error type", ("error_type",))
+llm_token_histogram = metrics_registry.histogram("magesql_llm_tokens", "Tokens per OpenAI request", ("model", "token_type"), buckets=DEFAULT_TOKEN_BUCKETS)
+llm_token_counter = metrics_registry.counter("magesql_llm_tokens_total", "Total tokens of OpenAI requests, cached is the part of the prompt served from the provider prompt cache", ("model", "token_type"))
+cache_request_counter = metrics_registry.counter("magesql_cache_requests_total", "Cache lookups by cache and result (hit, miss)", ("cache", "result"))
+sql_execution_error_counter = metrics_registry.counter("magesql_sql_execution_errors_total", "Generated SQL queries that failed to compile or execute", ("error_type",))
+pipeline_request_counter = metrics_registry.counter("magesql_pipeline_requests_total", "Pipeline requests, including the coalesced ones")
+coalesced_pipeline_request_counter = metrics_registry.counter("magesql_coalesced_pipeline_requests_total", "Pipeline requests that shared the run of an identical in-flight request")
+in_flight_pipeline_gauge = metrics_registry.gauge("magesql_in_flight_pipelines", "Pipeline runs in flight, each shared by one or more requests")
+
+
+def record_usage_metrics(model:str, usage:dict):
+    """Record the token usage of one OpenAI response, see get_usage_from_response.
+    """
+    if not usage:
+        return
+    for token_type in ["prompt_tokens", "completion_tokens", "cached_tokens"]:
+        llm_token_histogram.observe(usage[token_type], model=model, token_type=token_type)
+        llm_token_counter.inc(usage[token_type], model=model, token_type=token_type)
+
+
+def get_cache_hit_rates():
+    """Hit rate of each cache from the lookups recorded in cache_request_counter.
+    """
+    cache2counts = defaultdict(lambda: {"hit": 0, "miss": 0})
+    for (cache, result), value in cache_request_counter.get_values().items():
+        cache2counts[cache][result] = cache2counts[cache].get(result, 0) + value
+    return {
+        cache: counts["hit"] / (counts["hit"] + counts["miss"]) if counts["hit"] + counts["miss"] else None
+        for cache, counts in cache2counts.items()
+    }
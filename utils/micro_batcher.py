@@ -0,0 +1,103 @@
+"""
+Dynamic micro-batching of model calls: concurrent requests (e.g. routing classification or question encoding of several HTTP requests)
+are queued for at most max_wait_ms or until max_batch_size items are waiting, then run as one padded forward pass in a worker thread,
+and each caller gets the result of its own item. While a batch runs, the next requests accumulate, so the batch size adapts to the load.
+"""
+
+import time
+import asyncio
+import threading
+
+from utils.metrics_utils import get_metrics_registry, DEFAULT_LATENCY_BUCKETS
+
+## observed batch sizes and time spent in the queue
+batch_size_histogram = get_metrics_registry().histogram("magesql_micro_batch_size", "Number of items per micro-batch", ("batcher",), buckets=(1, 2, 4, 8, 16, 32, 64))
+queue_wait_histogram = get_metrics_registry().histogram("magesql_micro_batch_queue_wait_seconds", "Time an item waits before its micro-batch starts", ("batcher",), buckets=DEFAULT_LATENCY_BUCKETS)
+
+
+class MicroBatcher():
+    def __init__(self, batch_func, max_batch_size:int=16, max_wait_ms:float=5.0, name:str='default'):
+        """batch_func is a blocking function of a list of items that returns the list of results in the same order.
+        max_wait_ms bounds the latency added to a request by waiting for other requests, 0 only batches the requests already queued.
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self.batch_func = batch_func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        ## the queue and the worker task belong to one event loop, they are recreated if the batcher is used from another loop (e.g. another asyncio.run)
+        self.lock = threading.Lock()
+        self.loop = None
+        self.queue = None
+        self.worker_task = None
+        self.num_items = 0
+        self.num_batches = 0
+
+    def get_queue(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.loop is not loop or self.worker_task is None or self.worker_task.done():
+                self.loop = loop
+                self.queue = asyncio.Queue()
+                self.worker_task = loop.create_task(self.run_worker(self.queue))
+            return self.queue
+
+    async def submit(self, item):
+        """Result of batch_func for the item, computed in a batch with the other items submitted concurrently.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.get_queue().put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    async def run_worker(self, queue:asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.run_batch(batch)
+
+    async def run_batch(self, batch:list):
+        ## callers that gave up (cancelled) are not computed
+        batch = [x for x in batch if not x[1].done()]
+        if not batch:
+            return
+        start_time = time.perf_counter()
+        for _, _, submit_time in batch:
+            queue_wait_histogram.observe(start_time - submit_time, batcher=self.name)
+        batch_size_histogram.observe(len(batch), batcher=self.name)
+        self.num_items += len(batch)
+        self.num_batches += 1
+        try:
+            results = await asyncio.to_thread(self.batch_func, [x[0] for x in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Batch function of {self.name} returned {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def get_stats(self):
+        return {
+            "name": self.name,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "num_items": self.num_items,
+            "num_batches": self.num_batches,
+            "avg_batch_size": self.num_items / self.num_batches if self.num_batches else None,
+        }
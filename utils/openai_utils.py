@@ -1,10 +1,20 @@
 import time
 import json
 import os
+import asyncio
+import random
+import hashlib
+import sqlite3
+import threading
+from collections import defaultdict, deque
+from email.utils import parsedate_to_datetime
 
 import tiktoken
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+
+from utils.metrics_utils import llm_request_latency_histogram, llm_error_counter, cache_request_counter, record_usage_metrics
+from utils.dataset_utils import load_json_records, save_line_by_line_json, load_line_by_line_json
 
 
 ## example code from OpenAI to calculate the number of tokens in messages
@@ -91,33 +101,40 @@ def ask_llm(model:str, data: str, temperature: float, n:int):
     return response
 
 
-def init_openai_client(openai_api_key:str = None, openai_organization:str = None, base_url:str = None):
-    """Initialize OpenAI client with credentials, timeout and max_retries"""
+def get_openai_client_kwargs(openai_api_key:str = None, openai_organization:str = None, base_url:str = None, max_retries:int = 0):
+    """Resolve credentials and base url from arguments or environment variables, shared by sync and async clients.
+    The client's own retries are disabled by default, retries are handled by RetryPolicy in get_prompt_from_openai.
+    """
     if openai_api_key is None:
         openai_api_key = os.getenv('OPENAI_API_KEY') or os.getenv('INDEED_OPENAI_KEY')
     if openai_organization is None:
         openai_organization = os.getenv('OPENAI_ORGANIZATION') or os.getenv('INDEED_OPENAI_ORGANIZATION')
     if base_url is None:
         base_url = os.getenv('INDEED_OPENAI_BASE_URL')
-    if base_url is None:
-        client = OpenAI(
-            api_key=openai_api_key,
-            organization=openai_organization,
-            timeout=180.0,
-            max_retries=5,
-        )
-    else: 
-        client = OpenAI(
-            api_key=openai_api_key,
-            organization=openai_organization,
-            base_url=base_url,
-            timeout=180.0,
-            max_retries=5,
-        )
+    client_kwargs = dict(
+        api_key=openai_api_key,
+        organization=openai_organization,
+        timeout=180.0,
+        max_retries=max_retries,
+    )
+    if base_url is not None:
+        client_kwargs['base_url'] = base_url
+    return client_kwargs
+
+
+def init_openai_client(openai_api_key:str = None, openai_organization:str = None, base_url:str = None, max_retries:int = 0):
+    """Initialize OpenAI client with credentials, timeout and max_retries"""
+    client = OpenAI(**get_openai_client_kwargs(openai_api_key, openai_organization, base_url, max_retries))
+    return client
+
+
+def init_async_openai_client(openai_api_key:str = None, openai_organization:str = None, base_url:str = None, max_retries:int = 0):
+    """Initialize async OpenAI client with credentials, timeout and max_retries"""
+    client = AsyncOpenAI(**get_openai_client_kwargs(openai_api_key, openai_organization, base_url, max_retries))
     return client
 
 
-def ask_gpt(client, model, messages: list, temperature, n):
+def ask_gpt(client, model, messages: list, temperature, n, seed=None):
     """Call API to get response from model
     """
     response = client.chat.completions.create(
@@ -125,8 +142,27 @@ def ask_gpt(client, model, messages: list, temperature, n):
         messages=messages,
         temperature=temperature,
         max_tokens=200,
-        n=n
+        n=n,
+        seed=seed
     )
+    return format_ask_gpt_response(response, n)
+
+
+async def ask_gpt_async(client, model, messages: list, temperature, n, seed=None):
+    """Call API with async client to get response from model
+    """
+    response = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=200,
+        n=n,
+        seed=seed
+    )
+    return format_ask_gpt_response(response, n)
+
+
+def format_ask_gpt_response(response, n):
     # response_clean = [choice["message"]["content"] for choice in response["choices"]]
     response_clean = [choice.message.content for choice in response.choices]
     if n == 1:
@@ -137,68 +173,715 @@ def ask_gpt(client, model, messages: list, temperature, n):
         **response.usage.__dict__
     )
 
-def get_prompt_from_openai(client:None, model:str, data: str|dict, temperature: float, n:int, seed=None, max_num_retry=5, flag_use_original=False, flag_return_text_only=False):
+
+def get_messages_from_data(data: str|list):
+    """Wrap the prompt text as a user message, or use the given messages as is"""
+    if isinstance(data, str):
+        return [{"role": "user", "content": data}]
+    return data
+
+
+def get_text_from_response(response, n:int):
+    """Extract the content text(s) from the chat completion response"""
+    if n == 1:
+        return response.choices[0].message.content
+    return [choice.message.content for choice in response.choices]
+
+
+def get_usage_from_response(response):
+    """Token usage of the chat completion response (or the dict returned by ask_gpt), including the prompt tokens served from the provider's prompt cache.
+    """
+    if isinstance(response, dict):
+        prompt_tokens, completion_tokens = response.get('prompt_tokens'), response.get('completion_tokens')
+        prompt_tokens_details = response.get('prompt_tokens_details')
+    else:
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return None
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        prompt_tokens_details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(prompt_tokens_details, dict):
+        cached_tokens = prompt_tokens_details.get('cached_tokens')
+    else:
+        cached_tokens = getattr(prompt_tokens_details, 'cached_tokens', None)
+    return {
+        "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0,
+        "cached_tokens": cached_tokens or 0,
+    }
+
+
+class RetryPolicy():
+    """Retry policy for OpenAI requests: exponential backoff with full jitter, honoring Retry-After headers.
+    max_num_retry is the maximum number of attempts, same as the argument of get_prompt_from_openai.
+    """
+    def __init__(self, max_num_retry:int=5, base_delay:float=1.0, max_delay:float=60.0, rng:random.Random=None):
+        self.max_num_retry = max_num_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = rng if rng is not None else random.Random()
+
+    def is_retryable(self, error:Exception):
+        """Only transient API errors are retried: rate limits, connection errors, timeouts and 5xx responses.
+        4xx other than 429 and errors that are not API errors (e.g. a malformed response) would fail again with the same request.
+        """
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code >= 500
+        return False
+
+    def should_retry(self, error:Exception, num_retry:int):
+        return self.is_retryable(error) and num_retry + 1 < self.max_num_retry
+
+    def get_retry_after(self, error:Exception):
+        """Seconds to wait from the retry-after-ms or Retry-After header of the error response, None if not provided.
+        """
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        retry_after_ms = headers.get('retry-after-ms')
+        if retry_after_ms is not None:
+            try:
+                return float(retry_after_ms) / 1000
+            except ValueError:
+                pass
+        retry_after = headers.get('retry-after')
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            ## HTTP date format
+            return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def get_delay(self, num_retry:int, error:Exception=None):
+        """Full jitter: uniform in [0, min(max_delay, base_delay * 2^num_retry)], at least the Retry-After of the error.
+        """
+        backoff = self.rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** num_retry)))
+        retry_after = self.get_retry_after(error) if error is not None else None
+        if retry_after is not None:
+            ## small jitter on top of Retry-After so that waiting clients do not retry at the same moment
+            return min(retry_after, self.max_delay) + self.rng.uniform(0, self.base_delay)
+        return backoff
+
+
+class TokenBucketRateLimiter():
+    """Token bucket rate limiter, usable from threads and coroutines.
+    rate_per_minute tokens are refilled per minute up to capacity, each request acquires one or more tokens.
+    """
+    def __init__(self, rate_per_minute:float, capacity:float=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.last_refill_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self, amount:float):
+        """Take amount tokens if available, otherwise return the seconds to wait before trying again.
+        """
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill_time) * self.rate_per_second)
+            self.last_refill_time = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate_per_second
+
+    def acquire(self, amount:float=1):
+        while True:
+            wait_time = self._reserve(amount)
+            if wait_time <= 0:
+                return
+            time.sleep(wait_time)
+
+    async def acquire_async(self, amount:float=1):
+        while True:
+            wait_time = self._reserve(amount)
+            if wait_time <= 0:
+                return
+            await asyncio.sleep(wait_time)
+
+
+_global_rate_limiter = None
+_global_rate_limiter_lock = threading.Lock()
+
+def get_global_rate_limiter():
+    """Rate limiter shared by all agents in the process, configured by MAGESQL_OPENAI_REQUESTS_PER_MINUTE. None if not configured.
+    """
+    global _global_rate_limiter
+    if _global_rate_limiter is None and os.getenv('MAGESQL_OPENAI_REQUESTS_PER_MINUTE'):
+        with _global_rate_limiter_lock:
+            if _global_rate_limiter is None:
+                _global_rate_limiter = TokenBucketRateLimiter(float(os.getenv('MAGESQL_OPENAI_REQUESTS_PER_MINUTE')))
+    return _global_rate_limiter
+
+def set_global_rate_limiter(rate_limiter:TokenBucketRateLimiter):
+    global _global_rate_limiter
+    _global_rate_limiter = rate_limiter
+
+
+class OpenAIRequestStats():
+    """Thread-safe counters of OpenAI requests, retries and latency for monitoring.
+    """
+    def __init__(self, max_num_latencies:int=1000):
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_success = 0
+        self.num_failures = 0
+        self.num_retries = 0
+        self.error_type2count = defaultdict(int)
+        self.total_latency = 0.0
+        self.latencies = deque(maxlen=max_num_latencies) ## recent latencies of successful requests
+        self.total_prompt_tokens = 0
+        self.total_cached_tokens = 0
+        self.total_completion_tokens = 0
+
+    def record_retry(self, error:Exception):
+        with self.lock:
+            self.num_retries += 1
+            self.error_type2count[type(error).__name__] += 1
+
+    def record_result(self, latency:float, flag_success:bool, error:Exception=None):
+        with self.lock:
+            self.num_requests += 1
+            if flag_success:
+                self.num_success += 1
+                self.total_latency += latency
+                self.latencies.append(latency)
+            else:
+                self.num_failures += 1
+                if error is not None:
+                    self.error_type2count[type(error).__name__] += 1
+
+    def record_usage(self, usage:dict):
+        if not usage:
+            return
+        with self.lock:
+            self.total_prompt_tokens += usage["prompt_tokens"]
+            self.total_cached_tokens += usage["cached_tokens"]
+            self.total_completion_tokens += usage["completion_tokens"]
+
+    def get_stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                "num_requests": self.num_requests,
+                "num_success": self.num_success,
+                "num_failures": self.num_failures,
+                "num_retries": self.num_retries,
+                "error_type2count": dict(self.error_type2count),
+                "avg_latency": self.total_latency / self.num_success if self.num_success else None,
+                "total_prompt_tokens": self.total_prompt_tokens,
+                "total_cached_tokens": self.total_cached_tokens,
+                "total_completion_tokens": self.total_completion_tokens,
+                "cached_token_ratio": self.total_cached_tokens / self.total_prompt_tokens if self.total_prompt_tokens else None,
+            }
+        for percentile in [50, 95, 99]:
+            stats[f"p{percentile}_latency"] = latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))] if latencies else None
+        return stats
+
+
+openai_request_stats = OpenAIRequestStats()
+
+def get_openai_request_stats():
+    return openai_request_stats.get_stats()
+
+
+class LLMResponseCache():
+    """On-disk SQLite cache of LLM responses keyed by a hash of (model, messages, temperature, n, seed).
+    The messages are hashed as sent, only the leading/trailing whitespace of their contents is stripped, since inner whitespace (e.g. newlines in a schema or a query) can change the response.
+    Only deterministic requests (temperature 0) are cached, entries expire after ttl_seconds, and the least recently used entries are evicted beyond max_entries.
+    """
+    def __init__(self, cache_path:str, ttl_seconds:float=7*24*3600, max_entries:int=100000):
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.conn.execute("CREATE TABLE IF NOT EXISTS llm_response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_time REAL NOT NULL, last_access_time REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access_time ON llm_response_cache (last_access_time)")
+        self.conn.commit()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_bypasses = 0
+        self.num_evictions = 0
+
+    @property
+    def conn(self):
+        """SQLite connection of the current process, reopened after a fork (e.g. gunicorn workers of a preloaded app) since a connection must not be shared across processes.
+        """
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    @staticmethod
+    def is_cacheable(temperature:float):
+        return temperature == 0
+
+    @staticmethod
+    def normalize_messages(messages:list):
+        return [{key: value.strip() if isinstance(value, str) else value for key, value in message.items()} for message in messages]
+
+    def get_key(self, model:str, messages:list, temperature:float, n:int, seed=None, **kwargs):
+        """kwargs are extra options that change the format of the response, e.g. flag_return_text_only
+        """
+        key_data = {
+            "model": model,
+            "messages": self.normalize_messages(messages),
+            "temperature": temperature,
+            "n": n,
+            "seed": seed,
+            **kwargs
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key:str):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created_time FROM llm_response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.num_misses += 1
+                cache_request_counter.inc(cache="llm_response", result="miss")
+                return None
+            self.conn.execute("UPDATE llm_response_cache SET last_access_time = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.num_hits += 1
+        cache_request_counter.inc(cache="llm_response", result="hit")
+        return json.loads(row[0])
+
+    def set(self, key:str, value):
+        try:
+            value_text = json.dumps(value)
+        except TypeError:
+            ## only json serializable responses (e.g. text only) are cached
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO llm_response_cache (key, value, created_time, last_access_time) VALUES (?, ?, ?, ?)", (key, value_text, now, now))
+            self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now:float):
+        cursor = self.conn.execute("DELETE FROM llm_response_cache WHERE created_time < ?", (now - self.ttl_seconds,))
+        self.num_evictions += cursor.rowcount
+        num_entries = self.conn.execute("SELECT COUNT(*) FROM llm_response_cache").fetchone()[0]
+        if num_entries > self.max_entries:
+            cursor = self.conn.execute(
+                "DELETE FROM llm_response_cache WHERE key IN (SELECT key FROM llm_response_cache ORDER BY last_access_time LIMIT ?)",
+                (num_entries - self.max_entries,)
+            )
+            self.num_evictions += cursor.rowcount
+
+    def record_bypass(self):
+        with self.lock:
+            self.num_bypasses += 1
+
+    def get_stats(self):
+        with self.lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                "num_hits": self.num_hits,
+                "num_misses": self.num_misses,
+                "num_bypasses": self.num_bypasses,
+                "num_evictions": self.num_evictions,
+                "hit_rate": self.num_hits / num_lookups if num_lookups else None,
+            }
+
+
+_global_response_cache = None
+
+def get_global_response_cache():
+    """Response cache shared in the process, enabled by MAGESQL_LLM_CACHE_PATH. None if not configured.
+    """
+    global _global_response_cache
+    if _global_response_cache is None and os.getenv('MAGESQL_LLM_CACHE_PATH'):
+        _global_response_cache = LLMResponseCache(os.getenv('MAGESQL_LLM_CACHE_PATH'))
+    return _global_response_cache
+
+def set_global_response_cache(response_cache:LLMResponseCache):
+    global _global_response_cache
+    _global_response_cache = response_cache
+
+
+def get_cache_key(response_cache:LLMResponseCache, model:str, messages:list, temperature:float, n:int, seed, flag_use_original:bool, flag_return_text_only:bool):
+    """Return the cache key of the request, None if the request should bypass the cache"""
+    if response_cache is None:
+        return None
+    if not response_cache.is_cacheable(temperature):
+        response_cache.record_bypass()
+        return None
+    return response_cache.get_key(model, messages, temperature, n, seed, flag_use_original=flag_use_original, flag_return_text_only=flag_return_text_only)
+
+
+def print_openai_error(error:Exception, num_retry:int):
+    if isinstance(error, openai.APIConnectionError):
+        print("The server could not be reached")
+        print(error.__cause__)  # an underlying Exception, likely raised within httpx.
+    elif isinstance(error, openai.RateLimitError):
+        print("A 429 status code was received; we should back off a bit.")
+    elif isinstance(error, openai.APIStatusError):
+        print("Another non-200-range status code was received")
+        print(error.status_code)
+        print(error.response)
+    elif isinstance(error, json.decoder.JSONDecodeError):
+        print(f"JSONDecodeError", end="\n")
+    else:
+        print(f"Repeat for the {num_retry} times for exception: {error}", end="\n")
+
+
+def create_chat_completion(client, model:str, messages:list, temperature:float, n:int, seed=None, flag_use_original=False, flag_return_text_only=False, flag_return_usage=False):
+    """Return the response, and its token usage (see get_usage_from_response) if flag_return_usage.
+    """
+    usage = None
+    if flag_use_original:
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            n=n,
+            seed=seed,
+            # extra_headers={"x-indeed-redact-allow": "*"}
+        )
+        usage = get_usage_from_response(response)
+        if flag_return_text_only:
+            response = get_text_from_response(response, n)
+    else:
+        ## transaction in text2sql
+        response = ask_gpt(client, model, messages, temperature, n, seed)
+        usage = get_usage_from_response(response)
+        response['response'] = [response['response']]
+        if flag_return_text_only:
+            response = response['response']
+    if flag_return_usage:
+        return response, usage
+    return response
+
+
+async def create_chat_completion_async(client, model:str, messages:list, temperature:float, n:int, seed=None, flag_use_original=False, flag_return_text_only=False, flag_return_usage=False):
+    """Return the response, and its token usage (see get_usage_from_response) if flag_return_usage.
+    """
+    usage = None
+    if flag_use_original:
+        response = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            n=n,
+            seed=seed,
+        )
+        usage = get_usage_from_response(response)
+        if flag_return_text_only:
+            response = get_text_from_response(response, n)
+    else:
+        ## transaction in text2sql
+        response = await ask_gpt_async(client, model, messages, temperature, n, seed)
+        usage = get_usage_from_response(response)
+        response['response'] = [response['response']]
+        if flag_return_text_only:
+            response = response['response']
+    if flag_return_usage:
+        return response, usage
+    return response
+
+
+def get_prompt_from_openai(client:None, model:str, data: str|dict, temperature: float, n:int, seed=None, max_num_retry=5, flag_use_original=False, flag_return_text_only=False, retry_policy:RetryPolicy=None, rate_limiter:TokenBucketRateLimiter=None, response_cache:LLMResponseCache=None, flag_return_usage=False):
     """Get prompt from OpenAI API
+    Retries follow the retry policy (exponential backoff with full jitter by default), requests wait on the global rate limiter if configured.
+    Deterministic requests are answered from the response cache (or the global response cache if configured) when possible.
+    If flag_return_usage, return (response, usage) where usage has the prompt, completion and provider-cached prompt tokens, usage is None for cache hits and failures.
     """
     if client is None:
         client = init_openai_client() ## TODO input args if env variables are not set
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_num_retry=max_num_retry)
+    if rate_limiter is None:
+        rate_limiter = get_global_rate_limiter()
+    if response_cache is None:
+        response_cache = get_global_response_cache()
+    messages = get_messages_from_data(data)
+    cache_key = get_cache_key(response_cache, model, messages, temperature, n, seed, flag_use_original, flag_return_text_only)
+    if cache_key is not None:
+        response = response_cache.get(cache_key)
+        if response is not None:
+            return (response, None) if flag_return_usage else response
     num_retry = 0
-    response = None
-    while num_retry < max_num_retry:
+    start_time = time.perf_counter()
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
         try:
-            if isinstance(data, str):
-                messages = [{"role": "user", "content": data}]
-            else:
-                messages = data
-            if flag_use_original:
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    n=n,
-                    seed=seed,
-                    # extra_headers={"x-indeed-redact-allow": "*"}
-                )
-                if flag_return_text_only:
-                    if n == 1:
-                        response = response.choices[0].message.content
-                    else:
-                        response = [choice.message.content for choice in response.choices]
-            else:
-                ## transaction in text2sql
-                response = ask_gpt(client, model, messages, temperature, n, seed)
-                response['response'] = [response['response']]
-                if flag_return_text_only:
-                    response = response['response']
+            response, usage = create_chat_completion(client, model, messages, temperature, n, seed, flag_use_original, flag_return_text_only, flag_return_usage=True)
             break
-        except openai.APIConnectionError as e:
-            print("The server could not be reached")
-            print(e.__cause__)  # an underlying Exception, likely raised within httpx.
-            num_retry += 1
-            time.sleep(1)
-        except openai.RateLimitError as e:
-            print("A 429 status code was received; we should back off a bit.")
+        except Exception as e:
+            print_openai_error(e, num_retry + 1)
+            llm_error_counter.inc(error_type=type(e).__name__)
+            if not retry_policy.should_retry(e, num_retry):
+                if retry_policy.is_retryable(e):
+                    print("Failed to get a response after maximum retries.")
+                openai_request_stats.record_result(time.perf_counter() - start_time, flag_success=False, error=e)
+                return (None, None) if flag_return_usage else None
+            openai_request_stats.record_retry(e)
+            time.sleep(retry_policy.get_delay(num_retry, e))
             num_retry += 1
-            time.sleep(1)
-        except openai.APIStatusError as e:
-            print("Another non-200-range status code was received")
-            print(e.status_code)
-            print(e.response)
+    ## bookkeeping of the successful request, outside of the retried block so that its errors do not trigger another request
+    openai_request_stats.record_result(time.perf_counter() - start_time, flag_success=True)
+    openai_request_stats.record_usage(usage)
+    llm_request_latency_histogram.observe(time.perf_counter() - start_time, model=model)
+    record_usage_metrics(model, usage)
+    if cache_key is not None:
+        response_cache.set(cache_key, response)
+    return (response, usage) if flag_return_usage else response
+
+
+async def get_prompt_from_openai_async(client:None, model:str, data: str|dict, temperature: float, n:int, seed=None, max_num_retry=5, flag_use_original=False, flag_return_text_only=False, retry_policy:RetryPolicy=None, rate_limiter:TokenBucketRateLimiter=None, response_cache:LLMResponseCache=None, flag_return_usage=False):
+    """Get prompt from OpenAI API with the async client, same retry semantics as get_prompt_from_openai without blocking the event loop
+    """
+    if client is None:
+        client = init_async_openai_client()
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_num_retry=max_num_retry)
+    if rate_limiter is None:
+        rate_limiter = get_global_rate_limiter()
+    if response_cache is None:
+        response_cache = get_global_response_cache()
+    messages = get_messages_from_data(data)
+    cache_key = get_cache_key(response_cache, model, messages, temperature, n, seed, flag_use_original, flag_return_text_only)
+    if cache_key is not None:
+        response = response_cache.get(cache_key)
+        if response is not None:
+            return (response, None) if flag_return_usage else response
+    num_retry = 0
+    start_time = time.perf_counter()
+    while True:
+        if rate_limiter is not None:
+            await rate_limiter.acquire_async()
+        try:
+            response, usage = await create_chat_completion_async(client, model, messages, temperature, n, seed, flag_use_original, flag_return_text_only, flag_return_usage=True)
+            break
+        except Exception as e:
+            print_openai_error(e, num_retry + 1)
+            llm_error_counter.inc(error_type=type(e).__name__)
+            if not retry_policy.should_retry(e, num_retry):
+                if retry_policy.is_retryable(e):
+                    print("Failed to get a response after maximum retries.")
+                openai_request_stats.record_result(time.perf_counter() - start_time, flag_success=False, error=e)
+                return (None, None) if flag_return_usage else None
+            openai_request_stats.record_retry(e)
+            await asyncio.sleep(retry_policy.get_delay(num_retry, e))
             num_retry += 1
-            time.sleep(1)
-        except json.decoder.JSONDecodeError:
-            # json decoder error doesn't need to retry
-            print(f"JSONDecodeError", end="\n")
-            return None
+    ## bookkeeping of the successful request, outside of the retried block so that its errors do not trigger another request
+    openai_request_stats.record_result(time.perf_counter() - start_time, flag_success=True)
+    openai_request_stats.record_usage(usage)
+    llm_request_latency_histogram.observe(time.perf_counter() - start_time, model=model)
+    record_usage_metrics(model, usage)
+    if cache_key is not None:
+        response_cache.set(cache_key, response)
+    return (response, usage) if flag_return_usage else response
+
+async def stream_chat_completion_async(client, model:str, messages:list, temperature:float, seed=None):
+    """Async generator of the text deltas of a streamed chat completion (n=1), the usage of the request (see get_usage_from_response) is yielded last as a dict.
+    """
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        n=1,
+        seed=seed,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+        ## with include_usage, the last chunk has no choices and the usage of the whole request
+        if getattr(chunk, 'usage', None) is not None:
+            yield get_usage_from_response(chunk)
+
+
+async def get_prompt_from_openai_stream_async(client:None, model:str, data: str|dict, temperature: float, seed=None, max_num_retry=5, retry_policy:RetryPolicy=None, rate_limiter:TokenBucketRateLimiter=None, response_cache:LLMResponseCache=None, output:dict=None):
+    """Stream the response text of the prompt with the OpenAI streaming API: async generator of the text deltas, as soon as the tokens arrive.
+    Same retry, rate limit and response cache semantics as get_prompt_from_openai_async (with flag_use_original and flag_return_text_only, n=1),
+    except that a request is only retried until its first token is yielded, an error after that is raised. A cached response is yielded as one delta.
+    If output is given, it receives the full response text ("response") and the usage ("usage", None for cache hits) once the stream ends.
+    """
+    if client is None:
+        client = init_async_openai_client()
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_num_retry=max_num_retry)
+    if rate_limiter is None:
+        rate_limiter = get_global_rate_limiter()
+    if response_cache is None:
+        response_cache = get_global_response_cache()
+    if output is None:
+        output = {}
+    messages = get_messages_from_data(data)
+    ## same key as the non streamed request, so both share the cached responses
+    cache_key = get_cache_key(response_cache, model, messages, temperature, 1, seed, True, True)
+    if cache_key is not None:
+        response = response_cache.get(cache_key)
+        if response is not None:
+            output.update(response=response, usage=None)
+            yield response
+            return
+    num_retry = 0
+    start_time = time.perf_counter()
+    while True:
+        if rate_limiter is not None:
+            await rate_limiter.acquire_async()
+        deltas = []
+        try:
+            usage = None
+            async for delta in stream_chat_completion_async(client, model, messages, temperature, seed):
+                if isinstance(delta, dict):
+                    usage = delta
+                    continue
+                deltas.append(delta)
+                yield delta
+            break
         except Exception as e:
+            print_openai_error(e, num_retry + 1)
+            llm_error_counter.inc(error_type=type(e).__name__)
+            ## the tokens already yielded cannot be taken back, so a stream broken midway is not retried
+            if deltas or not retry_policy.should_retry(e, num_retry):
+                if retry_policy.is_retryable(e) and not deltas:
+                    print("Failed to get a response after maximum retries.")
+                openai_request_stats.record_result(time.perf_counter() - start_time, flag_success=False, error=e)
+                raise
+            openai_request_stats.record_retry(e)
+            await asyncio.sleep(retry_policy.get_delay(num_retry, e))
             num_retry += 1
-            print(f"Repeat for the {num_retry} times for exception: {e}", end="\n")
-            time.sleep(1)
-    else:
-        # If we exhaust max_num_retry, log that outcome
-        print("Failed to get a response after maximum retries.")
-        return None
-    return response
+    response = "".join(deltas)
+    openai_request_stats.record_result(time.perf_counter() - start_time, flag_success=True)
+    openai_request_stats.record_usage(usage)
+    llm_request_latency_histogram.observe(time.perf_counter() - start_time, model=model)
+    record_usage_metrics(model, usage)
+    if cache_key is not None:
+        response_cache.set(cache_key, response)
+    output.update(response=response, usage=usage)
+
+
+def load_prompt_records(file_path:str):
+    """Load prompts from a json list or line by line json file, e.g. the prompt files at get_default_output_file_path of demonstration selectors.
+    Each record is a prompt text or a dict with the prompt under key "prompt" or "prompt_text".
+    """
+    try:
+        records = load_json_records(file_path)
+    except json.decoder.JSONDecodeError:
+        records = load_line_by_line_json(file_path)
+    return records
+
+
+def get_default_response_file_path(prompt_file_path:str, model:str):
+    """Default checkpoint file to store the responses of a prompt file
+    """
+    root, _ = os.path.splitext(prompt_file_path)
+    return f"{root}_{model}_responses.json"
+
+
+def normalize_prompt_record(record, idx:int):
+    """Convert a prompt record to a dict with idx and prompt, idx is used to resume from the checkpoint
+    """
+    if isinstance(record, str):
+        return {"idx": idx, "prompt": record}
+    prompt = record.get("prompt", record.get("prompt_text"))
+    if prompt is None:
+        raise ValueError(f"Prompt not found in record {idx}, expected key 'prompt' or 'prompt_text'")
+    return {"idx": record.get("idx", idx), "prompt": prompt}
+
+
+def estimate_num_tokens(messages:list, model:str, max_completion_tokens:int=200):
+    """Estimate the number of tokens of a request for the tokens-per-minute limit"""
+    try:
+        num_prompt_tokens = num_tokens_from_messages(messages, model=model)
+    except NotImplementedError:
+        num_prompt_tokens = num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301")
+    return num_prompt_tokens + max_completion_tokens
+
+
+async def run_prompts_in_batch_async(prompts, output_file_path:str, client=None, model:str='gpt-4', temperature:float=0.0, n:int=1, seed=None, max_concurrency:int=8, requests_per_minute:float=None, tokens_per_minute:float=None, max_completion_tokens:int=200, max_num_retry:int=5):
+    """Run an iterable of prompts through the LLM with bounded concurrency, under requests-per-minute and tokens-per-minute limits.
+    Every response is appended to output_file_path as soon as it arrives, records already answered in the file are skipped, so the run resumes after a crash.
+    Return the responses of all the prompts ordered by idx.
+    """
+    if client is None:
+        client = init_async_openai_client()
+    idx2result = {}
+    if os.path.exists(output_file_path):
+        for record in load_line_by_line_json(output_file_path):
+            if record.get("response") is not None:
+                idx2result[record["idx"]] = record
+        print(f"Resume from checkpoint {output_file_path} with {len(idx2result)} finished prompts")
+    request_rate_limiter = TokenBucketRateLimiter(requests_per_minute) if requests_per_minute else get_global_rate_limiter()
+    token_rate_limiter = TokenBucketRateLimiter(tokens_per_minute) if tokens_per_minute else None
+    retry_policy = RetryPolicy(max_num_retry=max_num_retry)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    num_finished = 0
+
+    async def process(record:dict):
+        nonlocal num_finished
+        try:
+            messages = get_messages_from_data(record["prompt"])
+            if token_rate_limiter is not None:
+                await token_rate_limiter.acquire_async(estimate_num_tokens(messages, model, max_completion_tokens))
+            response = await get_prompt_from_openai_async(
+                client,
+                model=model,
+                data=messages,
+                temperature=temperature,
+                n=n,
+                seed=seed,
+                flag_use_original=True,
+                flag_return_text_only=True,
+                retry_policy=retry_policy,
+                rate_limiter=request_rate_limiter
+            )
+            result = {"idx": record["idx"], "prompt": record["prompt"], "response": response}
+            ## append from the event loop thread, so lines of concurrent requests do not interleave
+            save_line_by_line_json([result], output_file_path, flag_append=True)
+            idx2result[record["idx"]] = result
+            num_finished += 1
+            if num_finished % 100 == 0:
+                print(f"Finished {num_finished} prompts")
+        finally:
+            semaphore.release()
+
+    tasks = []
+    for i, record in enumerate(prompts):
+        record = normalize_prompt_record(record, i)
+        if record["idx"] in idx2result:
+            continue
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(process(record)))
+    await asyncio.gather(*tasks)
+    num_failed = sum(1 for x in idx2result.values() if x["response"] is None)
+    print(f"Finished {num_finished} prompts in this run, {num_failed} prompts failed and will be retried on the next run")
+    return [idx2result[idx] for idx in sorted(idx2result)]
+
+
+def run_prompts_in_batch(prompts, output_file_path:str, **kwargs):
+    """Blocking wrapper of run_prompts_in_batch_async for scripts"""
+    return asyncio.run(run_prompts_in_batch_async(prompts, output_file_path, **kwargs))
+
+
+def run_prompt_file_in_batch(prompt_file_path:str, model:str='gpt-4', output_file_path:str=None, **kwargs):
+    """Run all the prompts of a prompt file, checkpointing the responses next to the prompt file by default"""
+    if output_file_path is None:
+        output_file_path = get_default_response_file_path(prompt_file_path, model)
+    prompts = load_prompt_records(prompt_file_path)
+    return run_prompts_in_batch(prompts, output_file_path, model=model, **kwargs)
+
 
 def get_price_from_tokens(num_tokens:int, model:str):
     costs_per_thousand = {
@@ -0,0 +1,71 @@
+"""
+Small DAG executor for the stages of the NL2SQL pipeline.
+Each stage is an async function of the outputs of the stages it depends on, a stage starts as soon as all its dependencies are done,
+so independent stages (e.g. demonstration selection and database routing) run concurrently. Blocking stages should wrap their work with asyncio.to_thread.
+"""
+
+import time
+import asyncio
+
+
+class PipelineStage():
+    def __init__(self, name:str, func, dependencies:list=None, flag_enabled:bool=True):
+        """func is an async function taking the dict of stage name -> output of the finished stages.
+        A disabled stage is skipped and its output is None, the stages depending on it still run.
+        """
+        self.name = name
+        self.func = func
+        self.dependencies = dependencies or []
+        self.flag_enabled = flag_enabled
+
+
+class PipelineDAG():
+    def __init__(self):
+        self.name2stage = {}
+        self.name2error = {} ## exceptions raised by the stages in the last run
+
+    def add_stage(self, name:str, func, dependencies:list=None, flag_enabled:bool=True):
+        if name in self.name2stage:
+            raise ValueError(f"Stage {name} already exists.")
+        for dependency in dependencies or []:
+            ## dependencies must be added first, which also rules out cycles
+            if dependency not in self.name2stage:
+                raise ValueError(f"Dependency {dependency} of stage {name} not found.")
+        self.name2stage[name] = PipelineStage(name, func, dependencies, flag_enabled)
+
+    async def run(self, on_stage_done=None):
+        """Run all stages, return the outputs and the latency (seconds) of each stage, the latency is None for skipped stages.
+        If a stage raises an exception, the other running stages are cancelled and the exception is raised.
+        on_stage_done(name, output, latency) is called as soon as each enabled stage finishes, e.g. to stream the progress of the pipeline.
+        """
+        name2output = {}
+        name2latency = {}
+        name2task = {}
+        self.name2error = {}
+
+        async def run_stage(stage:PipelineStage):
+            if stage.dependencies:
+                await asyncio.gather(*[name2task[x] for x in stage.dependencies])
+            if not stage.flag_enabled:
+                name2output[stage.name] = None
+                name2latency[stage.name] = None
+                return
+            start_time = time.perf_counter()
+            try:
+                name2output[stage.name] = await stage.func(name2output)
+            except Exception as e:
+                self.name2error[stage.name] = e
+                raise
+            name2latency[stage.name] = time.perf_counter() - start_time
+            if on_stage_done is not None:
+                on_stage_done(stage.name, name2output[stage.name], name2latency[stage.name])
+
+        for name, stage in self.name2stage.items():
+            name2task[name] = asyncio.ensure_future(run_stage(stage))
+        try:
+            await asyncio.gather(*name2task.values())
+        except BaseException:
+            for task in name2task.values():
+                task.cancel()
+            raise
+        return name2output, name2latency
@@ -0,0 +1,267 @@
+"""
+Token-budgeted prompt builder shared by the prompt construction agent and the template utils.
+Each section is tokenized once and its token ids are kept, the number of tokens of the joined prompt is
+computed arithmetically from the per-section counts plus a local correction at each separator.
+"""
+
+import logging
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+## number of characters on each side of a separator that are re-encoded to detect merges across the separator
+MERGE_WINDOW_CHARS = 16
+
+## sections are allocated in the order of priority (lower first), overflow options:
+## keep: always keep the whole section, even if it exceeds the budget
+## truncate: cut the tail tokens of the section body to fit the remaining budget
+## drop: drop trailing items of a list section (or the whole text section) to fit the remaining budget
+## the schema is kept whole by default, a truncated schema could lose the tables or columns the query needs, the demonstrations absorb the overflow
+DEFAULT_BUDGET_POLICY = {
+    "instruction": {"priority": 0, "overflow": "keep"},
+    "question": {"priority": 1, "overflow": "keep"},
+    "schema": {"priority": 2, "overflow": "keep"},
+    "demonstrations": {"priority": 3, "overflow": "drop"},
+}
+
+## opt-in policy that cuts the tail of a schema exceeding the budget instead of sending an over-long prompt
+TRUNCATE_SCHEMA_BUDGET_POLICY = {
+    **DEFAULT_BUDGET_POLICY,
+    "schema": {"priority": 2, "overflow": "truncate"},
+}
+
+_name2tokenizer = {}
+
+def get_tokenizer(encoding_name:str="cl100k_base"):
+    """Get the tiktoken encoding, loaded once per process.
+    """
+    if encoding_name not in _name2tokenizer:
+        _name2tokenizer[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return _name2tokenizer[encoding_name]
+
+
+class PromptSection():
+    """A section of the prompt: optional prefix, one or more items and optional suffix joined by the separator.
+    Text sections (instruction, schema, question) have a single item, list sections (demonstrations) have one item per element.
+    """
+    def __init__(self, name:str, items:list, tokenizer, prefix:str=None, suffix:str=None, separator:str="\n\n", is_list:bool=False):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.suffix = suffix
+        self.separator = separator
+        self.is_list = is_list
+        self.items = list(items)
+        self.item_token_ids = [tokenizer.encode(x) for x in self.items]
+        self.prefix_token_ids = tokenizer.encode(prefix) if prefix else None
+        self.suffix_token_ids = tokenizer.encode(suffix) if suffix else None
+        self.num_kept_items = len(self.items)
+        self.num_tokens = None
+
+    def get_parts(self, num_items:int=None):
+        """Return the texts and token ids of the parts to join with the separator, keeping the first num_items items.
+        """
+        if num_items is None:
+            num_items = self.num_kept_items
+        if num_items == 0:
+            return [], []
+        texts, token_ids = [], []
+        if self.prefix:
+            texts.append(self.prefix)
+            token_ids.append(self.prefix_token_ids)
+        texts.extend(self.items[:num_items])
+        token_ids.extend(self.item_token_ids[:num_items])
+        if self.suffix:
+            texts.append(self.suffix)
+            token_ids.append(self.suffix_token_ids)
+        return texts, token_ids
+
+    def get_text(self):
+        texts, _ = self.get_parts()
+        if not texts:
+            return None
+        return self.separator.join(texts)
+
+    def truncate_last_item(self, num_tokens:int):
+        """Keep only the first num_tokens tokens of the last kept item.
+        """
+        idx = self.num_kept_items - 1
+        token_ids = self.item_token_ids[idx][:max(num_tokens, 0)]
+        text = self.tokenizer.decode(token_ids).rstrip("�")
+        if not text:
+            self.num_kept_items = idx
+            return
+        self.items[idx] = text
+        self.item_token_ids[idx] = self.tokenizer.encode(text)
+
+
+class PromptBuilder():
+    """Build a prompt from sections under a token budget.
+    Sections are joined in the order they are added, and the budget is allocated by the priority of the budget policy.
+    """
+    def __init__(self, max_tokens:int=4096, section_separator:str="\n\n", budget_policy:dict=None, tokenizer=None):
+        if tokenizer is None:
+            tokenizer = get_tokenizer()
+        if budget_policy is None:
+            budget_policy = DEFAULT_BUDGET_POLICY
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.section_separator = section_separator
+        self.budget_policy = budget_policy
+        self.sections = []
+        self.separator2num_tokens = {}
+
+    def add_section(self, name:str, text:str, prefix:str=None, suffix:str=None, separator:str="\n\n"):
+        """Add a text section, empty text means the section is skipped (including its prefix and suffix).
+        """
+        section = PromptSection(name, [text] if text else [], self.tokenizer, prefix=prefix, suffix=suffix, separator=separator)
+        self.sections.append(section)
+        return section
+
+    def add_list_section(self, name:str, items:list, prefix:str=None, suffix:str=None, separator:str="\n\n"):
+        """Add a list section (e.g. demonstrations), trailing items could be dropped to fit the budget.
+        """
+        section = PromptSection(name, items or [], self.tokenizer, prefix=prefix, suffix=suffix, separator=separator, is_list=True)
+        self.sections.append(section)
+        return section
+
+    def count_separator_tokens(self, separator:str):
+        if separator not in self.separator2num_tokens:
+            self.separator2num_tokens[separator] = len(self.tokenizer.encode(separator))
+        return self.separator2num_tokens[separator]
+
+    def get_merge_correction(self, left_text:str, right_text:str, separator:str):
+        """Difference between the number of tokens of left + separator + right and the sum of the three encoded separately.
+        BPE could merge the separator with the characters around it (e.g. a trailing newline of left), only a small window around the separator is re-encoded.
+        """
+        tail = left_text[-MERGE_WINDOW_CHARS:]
+        head = right_text[:MERGE_WINDOW_CHARS]
+        joined_tokens = len(self.tokenizer.encode(tail + separator + head))
+        return joined_tokens - len(self.tokenizer.encode(tail)) - self.count_separator_tokens(separator) - len(self.tokenizer.encode(head))
+
+    def count_joined_tokens(self, texts:list, token_ids:list, separator:str):
+        """Number of tokens of separator.join(texts) computed from the token ids of each text.
+        """
+        if not texts:
+            return 0
+        num_tokens = sum(len(x) for x in token_ids) + (len(texts) - 1) * self.count_separator_tokens(separator)
+        for left_text, right_text in zip(texts[:-1], texts[1:]):
+            num_tokens += self.get_merge_correction(left_text, right_text, separator)
+        return num_tokens
+
+    def count_section_tokens(self, section:PromptSection, num_items:int=None):
+        texts, token_ids = section.get_parts(num_items)
+        return self.count_joined_tokens(texts, token_ids, section.separator)
+
+    def fit_list_section(self, section:PromptSection, budget:int):
+        """Keep the leading items of a list section that fit the budget.
+        """
+        if not section.items:
+            return
+        num_sep_tokens = self.count_separator_tokens(section.separator)
+        num_tokens = 0
+        num_items = 0
+        last_text = None
+        if section.prefix:
+            num_tokens = len(section.prefix_token_ids)
+            last_text = section.prefix
+        for item, item_token_ids in zip(section.items, section.item_token_ids):
+            new_num_tokens = num_tokens + len(item_token_ids)
+            if last_text is not None:
+                new_num_tokens += num_sep_tokens + self.get_merge_correction(last_text, item, section.separator)
+            num_tokens_with_suffix = new_num_tokens
+            if section.suffix:
+                num_tokens_with_suffix += num_sep_tokens + len(section.suffix_token_ids) + self.get_merge_correction(item, section.suffix, section.separator)
+            if num_tokens_with_suffix > budget:
+                break
+            num_tokens = new_num_tokens
+            last_text = item
+            num_items += 1
+        if num_items < len(section.items):
+            logger.info(f"Kept {num_items} of {len(section.items)} items in section {section.name} to fit the remaining {budget} tokens.")
+        section.num_kept_items = num_items
+
+    def fit_text_section(self, section:PromptSection, budget:int, overflow:str):
+        num_tokens = self.count_section_tokens(section)
+        if num_tokens <= budget:
+            return
+        num_body_tokens = 0
+        if section.num_kept_items > 0:
+            num_body_tokens = len(section.item_token_ids[section.num_kept_items - 1]) - (num_tokens - budget)
+        if overflow == "truncate" and num_body_tokens > 0:
+            logger.warning(f"Truncated section {section.name} from {num_tokens} tokens to fit the remaining {budget} tokens.")
+            section.truncate_last_item(num_body_tokens)
+            ## decoding and re-encoding the cut could shift a token, cut again if still over the budget
+            if section.num_kept_items > 0 and self.count_section_tokens(section) > budget:
+                section.truncate_last_item(len(section.item_token_ids[section.num_kept_items - 1]) - 1)
+        else:
+            logger.warning(f"Dropped section {section.name} with {num_tokens} tokens, remaining tokens: {budget}")
+            section.num_kept_items = 0
+
+    def allocate_budget(self):
+        """Allocate the token budget across sections by the priority in the budget policy.
+        """
+        default_priority = len(self.budget_policy)
+        ordered_sections = sorted(self.sections, key=lambda x: self.budget_policy.get(x.name, {}).get("priority", default_priority))
+        remaining_tokens = self.max_tokens
+        num_allocated_sections = 0
+        for section in ordered_sections:
+            overflow = self.budget_policy.get(section.name, {}).get("overflow", "keep")
+            separator_tokens = self.count_separator_tokens(self.section_separator) if num_allocated_sections > 0 else 0
+            budget = remaining_tokens - separator_tokens
+            if overflow == "keep":
+                pass
+            elif section.is_list:
+                self.fit_list_section(section, budget)
+            else:
+                self.fit_text_section(section, budget, overflow)
+            section.num_tokens = self.count_section_tokens(section)
+            if section.num_tokens > 0:
+                remaining_tokens -= section.num_tokens + separator_tokens
+                num_allocated_sections += 1
+
+    def build(self):
+        """Return the prompt text and its number of tokens.
+        """
+        self.allocate_budget()
+        texts, token_counts = self.get_built_sections()
+        output_text = self.section_separator.join(texts)
+        num_tokens = self.count_built_tokens(texts, token_counts)
+        if num_tokens > self.max_tokens:
+            logger.warning(f"The prompt has {num_tokens} tokens, which exceeds the maximum tokens {self.max_tokens}")
+        return output_text, num_tokens
+
+    def get_built_sections(self, section_names:set=None):
+        """Texts and numbers of tokens of the non-empty sections after the budget allocation.
+        If section_names is given, only the leading sections with these names are returned.
+        """
+        texts = []
+        token_counts = []
+        for section in self.sections:
+            section_text = section.get_text()
+            if section_text is None:
+                continue
+            if section_names is not None and section.name not in section_names:
+                break
+            texts.append(section_text)
+            token_counts.append(section.num_tokens)
+        return texts, token_counts
+
+    def count_built_tokens(self, texts:list, token_counts:list):
+        num_tokens = sum(token_counts) + max(len(texts) - 1, 0) * self.count_separator_tokens(self.section_separator)
+        for left_text, right_text in zip(texts[:-1], texts[1:]):
+            num_tokens += self.get_merge_correction(left_text, right_text, self.section_separator)
+        return num_tokens
+
+    def get_prefix_num_tokens(self, section_names:set):
+        """Number of tokens of the leading sections with the given names (e.g. the instruction and schema sections that are the same across requests on a database),
+        i.e. the expected length of the prompt prefix shared with other requests. Call after build.
+        """
+        texts, token_counts = self.get_built_sections(section_names)
+        return self.count_built_tokens(texts, token_counts)
+
+    def get_section_num_tokens(self):
+        """Return the number of tokens of each section after the budget allocation.
+        """
+        return {section.name: section.num_tokens for section in self.sections}
@@ -0,0 +1,145 @@
+"""
+Registry of shared read-only resources (datasets, tokenizers, models, schema stores), keyed by kind and path.
+Each resource is loaded once per process and the same instance is injected into every agent that needs it,
+e.g. the Spider dataset used by the demonstration selection agent and by the gold SQL retrieval.
+"""
+
+import os
+import json
+import time
+import threading
+
+
+class ResourceRegistry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key2resource = {}
+        self.key2lock = {}
+        self.key2load_time = {}
+        self.key2num_requests = {}
+
+    def get_key(self, kind:str, path:str):
+        ## normalize the path so that ./datasets/spider and datasets/spider/ share the entry
+        return (kind, os.path.abspath(path) if path else path)
+
+    def get_or_create(self, kind:str, path:str, factory):
+        """Return the resource of (kind, path), created by factory() on the first request (once, even with concurrent requests).
+        """
+        key = self.get_key(kind, path)
+        with self.lock:
+            self.key2num_requests[key] = self.key2num_requests.get(key, 0) + 1
+            if key in self.key2resource:
+                return self.key2resource[key]
+            key_lock = self.key2lock.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.key2resource:
+                start_time = time.perf_counter()
+                resource = factory()
+                with self.lock:
+                    self.key2resource[key] = resource
+                    self.key2load_time[key] = time.perf_counter() - start_time
+            return self.key2resource[key]
+
+    def get_dataset(self, dataset_name:str, dataset_dir_path:str, flag_load_schema:bool=True):
+        def load_dataset():
+            if dataset_name == 'spider':
+                from dataset_classes.spider_dataset import SpiderDataset
+                dataset = SpiderDataset(dataset_dir_path)
+            elif dataset_name == 'WikiSQL':
+                from dataset_classes.wikisql_dataset import WikiSQLDataset
+                dataset = WikiSQLDataset(dataset_dir_path)
+            else:
+                raise ValueError(f"Invalid dataset name {dataset_name}")
+            if flag_load_schema:
+                dataset.load_schema()
+            return dataset
+        return self.get_or_create(f"dataset:{dataset_name}:{int(flag_load_schema)}", dataset_dir_path, load_dataset)
+
+    def get_lexical_router(self, dataset_dir_path:str, question_split_names:tuple=('train',)):
+        """BM25 database router built from the schema and the questions of the given splits of the Spider dataset.
+        """
+        def load_lexical_router():
+            from utils.lexical_routing_utils import LexicalRouter
+            return LexicalRouter.from_dataset(self.get_dataset('spider', dataset_dir_path), question_split_names=question_split_names)
+        return self.get_or_create(f"lexical_router:{','.join(question_split_names)}", dataset_dir_path, load_lexical_router)
+
+    def get_tokenizer(self, model_path:str):
+        """DistilBERT tokenizer saved at model_path (a local directory or a hub model name).
+        """
+        def load_tokenizer():
+            from transformers import DistilBertTokenizer
+            return DistilBertTokenizer.from_pretrained(model_path)
+        return self.get_or_create("tokenizer", model_path, load_tokenizer)
+
+    def get_routing_model(self, model_path:str):
+        """DistilBERT sequence classification model of the database routing, and its label map.
+        """
+        def load_routing_model():
+            from transformers import DistilBertForSequenceClassification
+            model = DistilBertForSequenceClassification.from_pretrained(model_path)
+            model.eval()
+            with open(os.path.join(model_path, "label_map.json"), 'r') as f:
+                label_map = json.load(f)
+            return model, label_map
+        return self.get_or_create("routing_model", model_path, load_routing_model)
+
+    def get_quantized_routing_model(self, model_path:str):
+        """Int8 dynamic quantized copy of the database routing model (CPU only), and its label map.
+        """
+        def load_quantized_routing_model():
+            from utils.database_routing_utils import load_model, quantize_model_dynamic
+            model, _, label_map = load_model(model_path)
+            return quantize_model_dynamic(model), label_map
+        return self.get_or_create("quantized_routing_model", model_path, load_quantized_routing_model)
+
+    def get_onnx_session(self, onnx_path:str, num_threads:int=None):
+        """ONNX Runtime inference session of an exported model, see utils.database_routing_utils.prepare_onnx_model.
+        """
+        def load_onnx_session():
+            from utils.database_routing_utils import load_onnx_session as load_session
+            return load_session(onnx_path, num_threads=num_threads)
+        return self.get_or_create(f"onnx_session:{num_threads}", onnx_path, load_onnx_session)
+
+    def get_encoder_model(self, model_path:str, device=None):
+        """DistilBERT encoder (without a task head) used to embed questions, in eval mode on the device.
+        """
+        def load_encoder_model():
+            from transformers import DistilBertModel
+            model = DistilBertModel.from_pretrained(model_path)
+            if device is not None:
+                model = model.to(device)
+            model.eval()
+            return model
+        return self.get_or_create(f"encoder_model:{device}", model_path, load_encoder_model)
+
+    def get_schema_store(self, cache_schema_path:str):
+        """Mapping of db_id to the list of table schemas, loaded from the schema cache file.
+        """
+        def load_schema_store():
+            with open(cache_schema_path, 'r') as f:
+                return json.load(f)
+        return self.get_or_create("schema_store", cache_schema_path, load_schema_store)
+
+    def get_json(self, file_path:str):
+        def load_json():
+            with open(file_path, 'r') as f:
+                return json.load(f)
+        return self.get_or_create("json", file_path, load_json)
+
+    def get_stats(self):
+        with self.lock:
+            return [
+                {
+                    "kind": key[0],
+                    "path": key[1],
+                    "load_time": self.key2load_time.get(key),
+                    "num_requests": self.key2num_requests.get(key, 0),
+                }
+                for key in self.key2resource
+            ]
+
+
+resource_registry = ResourceRegistry()
+
+def get_resource_registry():
+    return resource_registry
@@ -1,10 +1,16 @@
 from typing import Iterable
 import re
 import os
+import time
 import argparse
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlite3
 
+from utils.metrics_utils import cache_request_counter
+
 def execute_query(queries, db_path=None, curr_cursor=None):
     """Run queries on the database, and return the results.
     The queries can be a single query or a batch of queries. List of results will be return if the input is the latter case.
@@ -86,10 +92,21 @@ def get_cursor_from_path(sqlite_path: str):
     return cursor
 
 
-def exec_on_db_(sqlite_path: str, query: str, flag_replace_cur_year=True):
+def set_query_timeout(cursor, timeout: float = None):
+    """Interrupt the running query of the cursor's connection after timeout seconds, raising sqlite3.OperationalError: interrupted
+    """
+    if timeout is None:
+        return
+    deadline = time.monotonic() + timeout
+    ## the handler is called every 1000 sqlite virtual machine instructions, non-zero return aborts the query
+    cursor.connection.set_progress_handler(lambda: int(time.monotonic() > deadline), 1000)
+
+
+def exec_on_db_(sqlite_path: str, query: str, flag_replace_cur_year=True, timeout: float = None):
     if flag_replace_cur_year:
         query = replace_cur_year(query)
     cursor = get_cursor_from_path(sqlite_path)
+    set_query_timeout(cursor, timeout)
     try:
         cursor.execute(query)
         result = cursor.fetchall()
@@ -102,12 +119,126 @@ def exec_on_db_(sqlite_path: str, query: str, flag_replace_cur_year=True):
         return "exception", e
 
 
+class ReadOnlyConnectionPool():
+    """One read-only sqlite connection per database file, shared across threads with a lock per connection.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.db_path2connection = {}
+        self.pid = os.getpid()
+
+    def get_connection(self, db_path: str):
+        with self.lock:
+            if self.pid != os.getpid():
+                ## connections opened before a fork are not reused in the child process
+                self.db_path2connection = {}
+                self.pid = os.getpid()
+            if db_path not in self.db_path2connection:
+                if not os.path.exists(db_path):
+                    raise FileNotFoundError(f"Database file {db_path} not found.")
+                connection = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True, check_same_thread=False)
+                connection.text_factory = lambda b: b.decode(errors="ignore")
+                self.db_path2connection[db_path] = (connection, threading.Lock())
+            return self.db_path2connection[db_path]
+
+
+readonly_connection_pool = ReadOnlyConnectionPool()
+
+
+def normalize_sql(sql: str) -> str:
+    """Strip the leading/trailing whitespace and the trailing semicolon, used as the cache key of validation results.
+    Inner whitespace is kept as is, joining the lines would comment out the rest of a query after a "--" comment.
+    """
+    return sql.strip().rstrip(";").rstrip()
+
+
+def get_sql_diagnostics(sql: str, error: Exception) -> dict:
+    """Convert a sqlite error into structured diagnostics: error type, unknown table/column name, syntax error location.
+    """
+    error_message = str(error)
+    diagnostics = {
+        "valid": False,
+        "error_type": "error",
+        "error_message": f"{type(error).__name__}: {error_message}",
+        "name": None,
+        "near": None,
+        "position": None,
+    }
+    match = re.match(r"no such (table|column): (.+)", error_message)
+    if match:
+        diagnostics["error_type"] = f"unknown_{match.group(1)}"
+        diagnostics["name"] = match.group(2)
+        return diagnostics
+    match = re.match(r'near "(.*)": syntax error', error_message, re.DOTALL)
+    if match:
+        diagnostics["error_type"] = "syntax_error"
+        diagnostics["near"] = match.group(1)
+        position = sql.find(match.group(1))
+        diagnostics["position"] = position if position >= 0 else None
+        return diagnostics
+    if error_message.startswith("incomplete input"):
+        diagnostics["error_type"] = "syntax_error"
+        diagnostics["position"] = len(sql)
+    return diagnostics
+
+
+class SqlValidationCache():
+    """LRU cache of validation results keyed by (db_path, normalized SQL), see normalize_sql
+    """
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.key2diagnostics = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.key2diagnostics:
+                cache_request_counter.inc(cache="sql_validation", result="miss")
+                return None
+            self.key2diagnostics.move_to_end(key)
+            cache_request_counter.inc(cache="sql_validation", result="hit")
+            return self.key2diagnostics[key]
+
+    def set(self, key, diagnostics: dict):
+        with self.lock:
+            self.key2diagnostics[key] = diagnostics
+            self.key2diagnostics.move_to_end(key)
+            while len(self.key2diagnostics) > self.max_size:
+                self.key2diagnostics.popitem(last=False)
+
+
+sql_validation_cache = SqlValidationCache()
+
+
+def validate_sql(sql: str, db_path: str, flag_replace_cur_year=True) -> dict:
+    """Check whether the SQL query compiles on the database by EXPLAIN QUERY PLAN on a pooled read-only connection, without executing it.
+    Return structured diagnostics, see get_sql_diagnostics. Results are cached per (db_path, normalized SQL).
+    """
+    if flag_replace_cur_year:
+        sql = replace_cur_year(sql)
+    key = (db_path, normalize_sql(sql))
+    diagnostics = sql_validation_cache.get(key)
+    if diagnostics is not None:
+        return diagnostics
+    connection, connection_lock = readonly_connection_pool.get_connection(db_path)
+    with connection_lock:
+        try:
+            connection.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            diagnostics = {"valid": True, "error_type": None, "error_message": None, "name": None, "near": None, "position": None}
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            diagnostics = get_sql_diagnostics(sql, e)
+    sql_validation_cache.set(key, diagnostics)
+    return diagnostics
+
+
 def is_valid(sql, db_path):
-    flag, _ = exec_on_db_(db_path, sql)
-    if flag == "exception":
+    """1 if the SQL query compiles on the database, 0 otherwise. The query is only compiled (EXPLAIN), not executed.
+    """
+    try:
+        diagnostics = validate_sql(sql, db_path)
+    except FileNotFoundError:
         return 0
-    else:
-        return 1
+    return 1 if diagnostics["valid"] else 0
     
 
 def postprocess(query: str) -> str:
@@ -115,23 +246,25 @@ def postprocess(query: str) -> str:
     return query
 
 
-def get_exec_result_from_query(sql, db_path, flag_postprocess=True):
+def get_exec_result_from_query(sql, db_path, flag_postprocess=True, timeout=None):
     """return the execution result of the input SQL query on the database at db_path
     flag: 'result' or 'exception'
     results: list of tuples format
+    timeout: seconds before the query is interrupted, no limit if None
     """
     if flag_postprocess:
         sql = postprocess(sql)
-    flag, result = exec_on_db_(db_path, sql)
+    flag, result = exec_on_db_(db_path, sql, timeout=timeout)
     if flag == "exception":
         return flag, result
     return flag, result
     
 
-def exec_on_db_return_columns(sqlite_path: str, query: str, flag_replace_cur_year=True):
+def exec_on_db_return_columns(sqlite_path: str, query: str, flag_replace_cur_year=True, timeout: float = None):
     if flag_replace_cur_year:
         query = replace_cur_year(query)
     cursor = get_cursor_from_path(sqlite_path)
+    set_query_timeout(cursor, timeout)
     try:
         cursor.execute(query)
         columns = [description[0] for description in cursor.description]
@@ -144,15 +277,48 @@ def exec_on_db_return_columns(sqlite_path: str, query: str, flag_replace_cur_yea
         cursor.connection.close()
         return "exception", e, None
     
-def get_exec_result_from_query_return_columns(sql, db_path, flag_postprocess=True):
+def get_exec_result_from_query_return_columns(sql, db_path, flag_postprocess=True, timeout=None):
     """return the execution result of the input SQL query on the database at db_path
     flag: 'result' or 'exception'
     results: list of tuples format
+    timeout: seconds before the query is interrupted, no limit if None
     """
     if flag_postprocess:
         sql = postprocess(sql)
-    flag, result, columns = exec_on_db_return_columns(db_path, sql)
+    flag, result, columns = exec_on_db_return_columns(db_path, sql, timeout=timeout)
     if flag == "exception":
         return flag, result, None
     return flag, result, columns
-    
+
+
+def get_exec_result_vote_key(result):
+    """Execution results are compared as multisets of rows, so candidates only differing in row order vote together
+    """
+    return tuple(sorted(repr(row) for row in result))
+
+
+def select_sql_by_execution(candidate_sqls: list, db_path: str, timeout: float = 10.0, max_workers: int = None):
+    """Execute the candidate SQL queries concurrently, discard the erroring ones and pick by majority vote of the execution results.
+    Ties are broken by the order of the candidates. Return None if no candidate executes successfully, otherwise a dict with
+    the selected sql, its execution result, the number of valid candidates and the number of votes of the selected result.
+    """
+    ## candidates that do not compile are dropped without executing them
+    candidate_sqls = [x for x in candidate_sqls if x and is_valid(postprocess(x), db_path)]
+    if not candidate_sqls:
+        return None
+    with ThreadPoolExecutor(max_workers=max_workers or len(candidate_sqls)) as executor:
+        exec_results = list(executor.map(lambda sql: get_exec_result_from_query(sql, db_path, timeout=timeout), candidate_sqls))
+    valid_candidates = [(sql, result) for sql, (flag, result) in zip(candidate_sqls, exec_results) if flag == "result"]
+    if not valid_candidates:
+        return None
+    vote_keys = [get_exec_result_vote_key(result) for _, result in valid_candidates]
+    key2votes = Counter(vote_keys)
+    max_votes = max(key2votes.values())
+    for (sql, result), key in zip(valid_candidates, vote_keys):
+        if key2votes[key] == max_votes:
+            return {
+                "sql": sql,
+                "exec_result": result,
+                "num_valid_candidates": len(valid_candidates),
+                "num_votes": max_votes,
+            }
@@ -5,6 +5,7 @@ import sqlite3
 
 from utils.sql_utils import get_sql_for_database
 from utils.correction_utils import creating_schema
+from utils.prompt_builder_utils import PromptBuilder
 
 TEMPLATE = {
     "instruction_section": "",
@@ -25,6 +26,13 @@ TEMPLATE = {
     "max_tokens": 4096
 }
 
+## the instruction and question sections are always kept, demonstrations fill the remaining tokens
+TEMPLATE_BUDGET_POLICY = {
+    "instruction_section": {"priority": 0, "overflow": "keep"},
+    "question_section": {"priority": 1, "overflow": "keep"},
+    "demonstration_section": {"priority": 2, "overflow": "drop"},
+}
+
 def count_tokens(text, tokenizer=None):
     if tokenizer is None:
         tokenizer = tiktoken.get_encoding("cl100k_base")
@@ -207,7 +215,7 @@ def fill_question_body(content_dict:dict, template:dict):
     return template["question_section"]["body"].format(content_dict["question"])
 
 
-def fill_question_section(content_dict:dict, template:dict, remaining_tokens:int=4096, provided_schema:str=None):
+def fill_question_section(content_dict:dict, template:dict, remaining_tokens:int=None, provided_schema:str=None):
     separator = template["question_section"]["seperator"]
     question_texts = []
     if template["question_section"].get("prefix", None):
@@ -222,44 +230,48 @@ def fill_question_section(content_dict:dict, template:dict, remaining_tokens:int
     if template["question_section"].get("suffix", None):
         question_texts.append(template["question_section"]["suffix"])
     res = separator.join(question_texts)
-    num_tokens = count_tokens(res)
-    if num_tokens >= remaining_tokens:
-        print(f"There is no space to fill question section. Current tokens: {num_tokens}, remaining tokens for question section: {remaining_tokens}")
+    if remaining_tokens is not None:
+        num_tokens = count_tokens(res)
+        if num_tokens >= remaining_tokens:
+            print(f"There is no space to fill question section. Current tokens: {num_tokens}, remaining tokens for question section: {remaining_tokens}")
     return res
-    
+
+
+def add_demonstration_section(builder:PromptBuilder, content_dict:dict, template:dict):
+    """Add the demonstration section to the prompt builder, trailing demonstrations are dropped to fit the budget.
+    """
+    if not template["demonstration_section"]:
+        return
+    suffix = template["demonstration_section"]["suffix"]
+    if suffix is not None:
+        suffix = suffix.format(content_dict["question"])
+    builder.add_list_section(
+        "demonstration_section",
+        [format_demonstration(x, template) for x in content_dict["demonstrations"]],
+        prefix=template["demonstration_section"]["prefix"],
+        suffix=suffix,
+        separator=template["demonstration_section"]["seperator"],
+    )
+
+
 def fill_template(content_dict:dict, template:str, valid_sections=None, tokenizer=None, provided_schema=None):
-    if tokenizer is None:
-        tokenizer = tiktoken.get_encoding("cl100k_base")
-    
     if valid_sections is None:
         valid_sections = ["instruction_section", "demonstration_section", "question_section"]
 
-    section2text = {key: None for key in valid_sections}
-
     max_tokens = template["max_tokens"]
-    num_valid_section = 0
-    num_tokens = 0
-    if "instruction_section" in section2text:
-        instruction_section_text = template["instruction_section"]
-        section2text["instruction_section"] = instruction_section_text
-        if instruction_section_text is not None:
-            num_valid_section += 1
-            num_tokens += count_tokens(instruction_section_text)
-    if "question_section" in section2text:
-        question_section_text = fill_question_section(content_dict, template, max_tokens-num_tokens, provided_schema=provided_schema)
-        section2text["question_section"] = question_section_text
-        if question_section_text is not None:
-            num_valid_section += 1
-            num_tokens += count_tokens(question_section_text)
-    num_tokens += max(num_valid_section-1, 0) * count_tokens(template["section_seperator"])
-    if "demonstration_section" in section2text:
-        demonstration_section_text = fill_demonstrations(content_dict, template, max_tokens-num_tokens)
-        section2text["demonstration_section"] = demonstration_section_text
-        if demonstration_section_text is not None:
-            num_valid_section += 1
-            num_tokens += count_tokens(demonstration_section_text)
-    section_seperator = template["section_seperator"]
-    output_text = section_seperator.join([section2text[x] for x in valid_sections if section2text[x] is not None])
-    total_tokens = count_tokens(output_text)
+    builder = PromptBuilder(
+        max_tokens=max_tokens,
+        section_separator=template["section_seperator"],
+        budget_policy=TEMPLATE_BUDGET_POLICY,
+        tokenizer=tokenizer
+    )
+    for section_name in valid_sections:
+        if section_name == "instruction_section":
+            builder.add_section("instruction_section", template["instruction_section"])
+        elif section_name == "question_section":
+            builder.add_section("question_section", fill_question_section(content_dict, template, provided_schema=provided_schema))
+        elif section_name == "demonstration_section":
+            add_demonstration_section(builder, content_dict, template)
+    output_text, total_tokens = builder.build()
     assert total_tokens <= max_tokens, f"total tokens {total_tokens} exceeds the maximum tokens {max_tokens}"
-    return output_text, total_tokens
\ No newline at end of file
+    return output_text, total_tokens